@@ -0,0 +1,152 @@
+#
+# Persistent download cache for the images and packages the build scripts fetch.
+#
+# Entries are keyed by URL plus expected digests and checked before touching the
+# network, so provisioning a second identical board needs no downloads at all.
+# Interrupted downloads are resumed with an HTTP Range request, finished files
+# are verified and then atomically renamed into place, and the least recently
+# used entries are evicted once the cache grows past its size cap.
+#
+import os
+import fcntl
+import hashlib
+import digests
+import requests
+from digests import DigestMismatch
+from urllib.parse import urlparse
+
+DEFAULT_MAX_BYTES = 24 * 1024 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".part"
+
+
+class ArtifactCache:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, url, digest=None):
+        # digest is anything digests.normalize() accepts.  The original file
+        # name is kept as a suffix so tools that look at the extension (.xz,
+        # .gz) still work on cached files.
+        known = ",".join(sorted(f"{algorithm}:{value}" for algorithm, value in digests.normalize(digest)))
+        key = hashlib.sha256(f"{url}\n{known}".encode()).hexdigest()[:32]
+        name = os.path.basename(urlparse(url).path) or "artifact"
+        return os.path.join(self.root, f"{key}-{name}")
+
+    def lookup(self, url, digest=None):
+        path = self.path(url, digest)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def fetch(self, url, digest=None, source=None):
+        # Return the path of a verified local copy of url, downloading it if needed.
+        path = self.lookup(url, digest)
+        if path is not None:
+            print(f"Using cached {os.path.basename(path)}")
+            return path
+        for _ in self.stream(url, digest, source=source):
+            pass
+        return self.path(url, digest)
+
+    def stream(self, url, digest=None, chunk_size=CHUNK_SIZE, source=None):
+        # Yield the contents of url as it arrives while also landing it in the
+        # cache, so a consumer (e.g. the imagepipe download stage) does not
+        # have to wait for the whole file.  source is a mirror to download
+        # url from; the cache entry is still keyed by url.
+        path = self.lookup(url, digest)
+        if path is not None:
+            print(f"Using cached {os.path.basename(path)}")
+            with open(path, "rb") as f:
+                yield from iter(lambda: f.read(chunk_size), b"")
+            return
+
+        path = self.path(url, digest)
+        part = path + PART_SUFFIX
+        os.makedirs(self.root, exist_ok=True)
+        with open(part, "ab+") as f:
+            # Another run fetching the same artifact holds this lock until it
+            # is done; wait for it rather than corrupting its partial file.
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                if os.path.exists(part):
+                    os.remove(part)
+                yield from self.stream(url, digest, chunk_size, source)
+                return
+
+            have = os.fstat(f.fileno()).st_size
+            headers = {"Range": f"bytes={have}-"} if have else {}
+            with requests.get(source or url, stream=True, headers=headers, timeout=60) as response:
+                # 416 means the partial file already holds everything.
+                complete = have and response.status_code == 416
+                if not complete:
+                    if response.status_code >= 400 and not have:
+                        os.remove(part)
+                    response.raise_for_status()
+                    if have and response.status_code != 206:
+                        print(f"{url} does not support resuming, starting over")
+                        f.truncate(0)
+                        have = 0
+
+                hasher = digests.Hasher(digest)
+                f.seek(0)
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    hasher.update(chunk)
+                    yield chunk
+
+                if not complete:
+                    if have:
+                        print(f"Resuming {url} at {have} bytes")
+                    else:
+                        print(f"Downloading {url}")
+                    self.evict(reserve=int(response.headers.get("Content-Length", 0)), keep=part)
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            # Readers following the partial file (fanout.py) see a chunk once it is yielded
+                            f.flush()
+                            hasher.update(chunk)
+                            yield chunk
+
+            f.flush()
+            os.fsync(f.fileno())
+            try:
+                hasher.verify(url)
+            except DigestMismatch:
+                os.remove(part)
+                raise
+            os.replace(part, path)
+        self.evict(keep=path)
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(path):
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self, reserve=0, keep=None):
+        # Drop least recently used entries until reserve more bytes fit under
+        # the cap.  Hits refresh an entry's mtime, so mtime order is LRU order.
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries) + reserve
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if path.endswith(PART_SUFFIX):
+                try:
+                    with open(path, "rb") as f:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+            print(f"Evicting {os.path.basename(path)} from the download cache")
+            os.remove(path)
+            total -= size
@@ -0,0 +1,284 @@
+#
+# Benchmarks for the flashing data path, against stand-in devices.
+#
+# Generates a synthetic disk image of a given size and sparsity (the share of
+# 1 MiB chunks that are all zeros; the rest compress about 2:1, like an OS
+# image), compresses it as gzip, single-threaded xz and multi-block xz, serves
+# them from a local HTTP server and writes them to plain files (or, with
+# --loop, loop devices) standing in for /dev/nvme0n1 and /dev/mtdblock0.
+# Each variant runs in a fresh interpreter so its peak RSS is its own, and
+# reports the throughput of every pipeline stage (download/read, decompress,
+# hash, write) from imagepipe's own stage timings.  The *-direct variants write
+# through directio's O_DIRECT engine (--queue-depth=N writes in flight)
+# instead of the page cache.
+#
+#   python3 bench.py --size=512M --sparsity=0.6
+#   python3 bench.py --save=bench-baseline.json          # record a baseline
+#   python3 bench.py --baseline=bench-baseline.json      # exit 1 on a regression
+#   sudo python3 bench.py --loop --variants=http-xz-mt,spi
+#   sudo python3 bench.py --loop --variants=file-raw,file-raw-direct --queue-depth=8
+#
+# Generated images are kept under ~/flash/bench and reused while the size,
+# sparsity and seed stay the same.
+#
+import os
+import sys
+import json
+import time
+import lzma
+import shutil
+import random
+import hashlib
+import resource
+import threading
+import subprocess
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import imagepipe
+import delta
+import directio
+import spi
+
+WORKDIR = os.path.join(os.path.expanduser("~"), "flash", "bench")
+DEFAULT_SIZE = 256 * 1024 * 1024
+DEFAULT_SPARSITY = 0.5
+SPI_SIZE = 16 * 1024 * 1024
+# A throughput drop (or RSS growth) beyond this fraction of the baseline is a regression.
+TOLERANCE = 0.10
+CHUNK = 1024 * 1024
+VARIANTS = ("file-raw", "file-raw-direct", "http-raw", "http-gz", "http-xz", "http-xz-mt", "http-xz-mt-hash",
+            "http-xz-mt-direct", "delta", "spi", "spi-direct")
+
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def get_option(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg.startswith(f"{name}="):
+            return arg.split("=", 1)[1]
+    return default
+
+
+def synthetic_chunks(size, sparsity, seed):
+    # 1 MiB chunks: zeros with probability sparsity, otherwise half random
+    # bytes and half a repeated pattern.
+    rng = random.Random(seed)
+    pattern = (b"rock5b provisioning benchmark " * (CHUNK // 60 + 1))[:CHUNK // 2]
+    for offset in range(0, size, CHUNK):
+        length = min(CHUNK, size - offset)
+        if rng.random() < sparsity:
+            yield bytes(length)
+        else:
+            yield (rng.randbytes(CHUNK // 2) + pattern)[:length]
+
+
+def generate_images(size, sparsity, seed):
+    # {"raw", "gz", "xz", "xz-mt", "spi": path, "sha256": digest}, generated once per parameter set.
+    directory = os.path.join(WORKDIR, f"images-{size}-{sparsity}-{seed}")
+    manifest_file = os.path.join(directory, "images.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+    os.makedirs(directory, exist_ok=True)
+    print(f"Generating a {size / imagepipe.MIB:.0f} MiB image ({sparsity:.0%} zero chunks) in {directory}")
+    images = {name: os.path.join(directory, f"disk.img{suffix}")
+              for name, suffix in (("raw", ""), ("gz", ".gz"), ("xz", ".xz"), ("xz-mt", ".mt.xz"))}
+    hasher = hashlib.sha256()
+    with open(images["raw"], "wb") as f:
+        for chunk in synthetic_chunks(size, sparsity, seed):
+            hasher.update(chunk)
+            f.write(chunk)
+    images["sha256"] = hasher.hexdigest()
+
+    with open(images["raw"], "rb") as source, open(images["gz"], "wb") as out:
+        subprocess.run(["gzip", "-c", "-6"], stdin=source, stdout=out, check=True)
+    # Single-threaded xz: one block without size fields, decoded sequentially
+    with open(images["raw"], "rb") as source, lzma.open(images["xz"], "wb", preset=1) as out:
+        shutil.copyfileobj(source, out, CHUNK)
+    if shutil.which("xz"):
+        # What xz -T writes: independent blocks the pipeline decodes in parallel
+        with open(images["raw"], "rb") as source, open(images["xz-mt"], "wb") as out:
+            subprocess.run(["xz", "-c", "-1", "-T0", "--block-size=16MiB"], stdin=source, stdout=out, check=True)
+    else:
+        images.pop("xz-mt")
+
+    images["spi"] = os.path.join(directory, "spi.img")
+    with open(images["spi"], "wb") as f:
+        for chunk in synthetic_chunks(SPI_SIZE, 0.3, seed + 1):
+            f.write(chunk)
+
+    with open(manifest_file, "w") as f:
+        json.dump(images, f, indent=2)
+    return images
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stand_in(path, size, loop):
+    # A sparse file of size bytes, attached to a loop device if loop is set.
+    with open(path, "wb") as f:
+        f.truncate(size)
+    if not loop:
+        return path
+    result = subprocess.run(["losetup", "--find", "--show", path], capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+def run_variant(name, config):
+    # Runs in its own interpreter; returns the measurements.
+    images = config["images"]
+    url = lambda image: f"{config['url']}/{os.path.basename(images[image])}"
+    stages = {}
+
+    def observe(pipe):
+        for stats in pipe.stats:
+            stages[stats.name] = {"bytes": stats.bytes, "seconds": round(stats.elapsed, 3),
+                                  "busy": round(stats.busy, 3),
+                                  "mib_s": round(stats.throughput() / imagepipe.MIB, 1)}
+
+    started = time.monotonic()
+    size = os.path.getsize(images["raw"])
+    if name == "spi":
+        with open(images["spi"], "rb") as f:
+            image = f.read()
+        size = len(image)
+        started = time.monotonic()
+        report = spi.diff_flash(image, config["mtd"], block_size=spi.DEFAULT_ERASE_SIZE)
+        stages["diff_flash"] = {"bytes": len(report["changed"]) * report["block_size"]}
+    elif name == "spi-direct":
+        # A full rewrite of the flash, as flash_spi() does without SPI_DIFFERENTIAL
+        size = os.path.getsize(images["spi"])
+        imagepipe.stream_image(images["spi"], config["mtd"], observer=observe,
+                               writer=directio.DirectWriter(config["mtd"], queue_depth=config["queue_depth"]))
+    elif name == "delta":
+        # First flash records the index, the measured second one only compares
+        index_dir = os.path.join(WORKDIR, "delta-index")
+        imagepipe.stream_image(images["raw"], config["nvme"], writer=delta.DeltaWriter(config["nvme"], index_dir))
+        started = time.monotonic()
+        imagepipe.stream_image(images["raw"], config["nvme"], writer=delta.DeltaWriter(config["nvme"], index_dir),
+                               observer=observe)
+    else:
+        location = {"file-raw": images["raw"], "http-raw": url("raw"), "http-gz": url("gz"), "http-xz": url("xz"),
+                    "http-xz-mt": url("xz-mt"), "http-xz-mt-hash": url("xz-mt")}[name.replace("-direct", "")]
+        expect = [images["sha256"]] if name.endswith("-hash") else None
+        writer = None
+        if name.endswith("-direct"):
+            writer = directio.DirectSparseWriter(config["nvme"], queue_depth=config["queue_depth"])
+        imagepipe.stream_image(location, config["nvme"], expect=expect, observer=observe, writer=writer)
+    seconds = time.monotonic() - started
+    return {
+        "seconds": round(seconds, 3),
+        "mib_s": round(size / seconds / imagepipe.MIB, 1) if seconds else 0.0,
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": stages,
+    }
+
+
+def run_child(name, config):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name, json.dumps(config)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Variant {name} failed:\n{result.stdout}{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Regressions of results against baseline, as readable strings.
+    regressions = []
+    for name, result in results["variants"].items():
+        before = baseline.get("variants", {}).get(name)
+        if before is None:
+            continue
+        if result["mib_s"] < before["mib_s"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['mib_s']} MiB/s, baseline {before['mib_s']} MiB/s")
+        if result["peak_rss_mib"] > before["peak_rss_mib"] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mib']} MiB, baseline {before['peak_rss_mib']} MiB")
+        for stage, stats in result["stages"].items():
+            old = before["stages"].get(stage, {})
+            if "mib_s" in stats and old.get("mib_s") and stats["mib_s"] < old["mib_s"] * (1 - tolerance):
+                regressions.append(f"{name} {stage}: {stats['mib_s']} MiB/s, baseline {old['mib_s']} MiB/s")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'variant':<18}{'MiB/s':>9}{'seconds':>9}{'RSS MiB':>9}  stages (MiB/s while busy)")
+    for name, result in results["variants"].items():
+        stages = ", ".join(f"{stage} {stats['mib_s']}" for stage, stats in result["stages"].items() if "mib_s" in stats)
+        print(f"{name:<18}{result['mib_s']:>9}{result['seconds']:>9}{result['peak_rss_mib']:>9}  {stages}")
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        print(json.dumps(run_variant(sys.argv[2], json.loads(sys.argv[3]))))
+        return
+
+    size = parse_size(get_option("--size", str(DEFAULT_SIZE)))
+    sparsity = float(get_option("--sparsity", DEFAULT_SPARSITY))
+    seed = int(get_option("--seed", 1))
+    loop = "--loop" in sys.argv
+    queue_depth = int(get_option("--queue-depth", directio.QUEUE_DEPTH))
+    variants = get_option("--variants", ",".join(VARIANTS)).split(",")
+    unknown = set(variants) - set(VARIANTS)
+    if unknown:
+        print(f"Unknown variants {', '.join(sorted(unknown))}, expected some of {', '.join(VARIANTS)}")
+        exit(1)
+
+    images = generate_images(size, sparsity, seed)
+    if "xz-mt" not in images:
+        print("xz is not installed, skipping the multi-block xz variants")
+        variants = [name for name in variants if not name.startswith("http-xz-mt")]
+    server = serve(os.path.dirname(images["raw"]))
+    nvme = stand_in(os.path.join(WORKDIR, "nvme0n1.img"), size, loop)
+    mtd = stand_in(os.path.join(WORKDIR, "mtdblock0.img"), SPI_SIZE, loop)
+    config = {"images": images, "url": f"http://127.0.0.1:{server.server_address[1]}", "nvme": nvme, "mtd": mtd,
+              "queue_depth": queue_depth}
+    results = {"size": size, "sparsity": sparsity, "seed": seed, "loop": loop, "queue_depth": queue_depth,
+               "variants": {}}
+    try:
+        for name in variants:
+            print(f"Running {name}")
+            results["variants"][name] = run_child(name, config)
+    finally:
+        server.shutdown()
+        if loop:
+            for device in (nvme, mtd):
+                subprocess.run(["losetup", "--detach", device], check=True)
+    print_results(results)
+
+    save = get_option("--save")
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {save}")
+
+    baseline_file = get_option("--baseline")
+    if baseline_file:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if (baseline.get("size"), baseline.get("sparsity"), baseline.get("seed")) != (size, sparsity, seed):
+            print(f"{baseline_file} was recorded with another image size, sparsity or seed, not comparing")
+            return
+        regressions = compare(results, baseline, float(get_option("--tolerance", TOLERANCE)))
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit(1)
+        print(f"No regressions against {baseline_file}")
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,26 @@
 # This script is a port of the shell script in this repository with the same filename.  
 # execute with sudo, or as root.  
 # -y switch should accept defaults and perform a silent install.
+# --stream downloads, decompresses and writes the OS image in one concurrent pass.
+# --targets=/dev/nvme*n1,/dev/sda flashes one image to several disks at once (comma separated, globs allowed).
+# --build-golden=PATH applies the customization once to an image file via a loop device;
+# --golden=PATH then flashes that image and only writes the per-board network config.
+# --package-proxy=URL points apt and pip in the chroot at a shared caching proxy (python3 pkgcache.py serve).
+# --profile=FILE reads images, packages and a per-board disk/interface/IP list from a TOML/YAML
+# profile instead of prompting (see example-profile.toml).
+# --report=PATH writes the per-stage timings (JSON lines) somewhere other than ~/flash/reports;
+# --prometheus=PATH also exports them as a node_exporter textfile.
+# --fanout=http://HOST:PORT streams the OS image from a fan-out server on the LAN
+# (python3 fanout.py serve), so a rack of boards downloads it from the internet only once.
+# --delta rewrites only the parts of each disk that changed since it was last flashed
+# (image upgrades across a fleet), reading back everything it writes.
+# A failed run is journaled under ~/flash/journal: running it again with the same settings skips
+# the steps that completed and still verify.  --restart ignores the journal.
+# Image and SPI writes use O_DIRECT with several writes in flight, tuned per device by probe.py
+# (--queue-depth=N and --write-block-size=BYTES override it); --buffered writes through the page cache.
+# A [devicetree] patch in the profile (see dtpatch.py) installs a patched DTB or overlay under /boot.
+# The stages run as a dependency graph (taskgraph.py): --flash-spi also reflashes the SPI bootloader
+# while the image is written, and --sequential runs them one at a time.
 #
 # This script attempts to automate many of the steps necessary to flash a Radxa Rock 5b
 # SBC with an m.2 disk present in the underside M.2 slot.
@@ -12,23 +32,49 @@ import os
 import re
 import sys
 import glob
+import time
 import hashlib
 import requests
 import subprocess
+import targets
+import imagepipe
+import artifacts
+import fetch
+import digests
+import spi
+import golden
+import pkgcache
+import manifest
+import delta
+import directio
+import probe
+import fanout
+import journal
+import chroot
+import gpt
+import dtpatch
+import report
+import taskgraph
 from urllib.parse import urlparse
 from pathlib import Path
 from getpass import getpass
 
 ZERO_KNOWN_MD5 = "ac581b250fda7a10d07ad11884a16834"
 ZERO_KNOWN_MD5_UNZIPPED = "2c7ab85a893283e98c931e9511add182"
+# Optional stronger digests, checked next to the MD5s when set. Bare hex or "sha256:..."/"blake2b:..."
+ZERO_KNOWN_SHA256 = ""
+ZERO_KNOWN_SHA256_UNZIPPED = ""
 ZERO_IMAGE_URL = "https://dl.radxa.com/rock5/sw/images/others/zero.img.gz"
 ZERO_IMAGE_FILENAME = os.path.basename(ZERO_IMAGE_URL)
 
 #BOOTLOADER_KNOWN_MD5 = "1b83982a5979008b4407552152732156"
 #BOOTLOADER_IMAGE_URL = "https://github.com/huazi-yg/rock5b/releases/download/rock5b/rkspi_loader.img"
-BOOTLOADER_IMAGE_URL = https://dl.radxa.com/rock5/sw/images/loader/rock-5b/release/rock-5b-spi-image-gd1cf491-20240523.img
+BOOTLOADER_IMAGE_URL = "https://dl.radxa.com/rock5/sw/images/loader/rock-5b/release/rock-5b-spi-image-gd1cf491-20240523.img"
 BOOTLOADER_KNOWN_MD5 = "cf53d06b3bfaaf51bbb6f25896da4b3a"
+BOOTLOADER_KNOWN_SHA256 = ""
 BOOTLOADER_FILENAME = os.path.basename(BOOTLOADER_IMAGE_URL)
+# Only rewrite the SPI erase blocks that differ from the bootloader image (no zero.img pass)
+SPI_DIFFERENTIAL = True
 
 REQUIRED_PACKAGES = "inetutils-tools curl docker.io python3 python3-pip netplan.io ufw"
 PYTHON_PIP_PACKAGES = "mysql.connector pillow google google.api google.cloud"
@@ -40,6 +86,7 @@ REQUIRED_PACKAGES_PREINSTALL = "curl"
 #UBUNTU_IMAGE_URL = "https://github.com/Joshua-Riek/ubuntu-rockchip/releases/download/v2.3.2/ubuntu-24.04-preinstalled-desktop-arm64-rock-5b.img.xz"
 UBUNTU_IMAGE_URL =  "https://github.com/Joshua-Riek/ubuntu-rockchip/releases/download/v2.3.2/ubuntu-24.04-preinstalled-server-arm64-rock-5b-plus.img.xz"
 UBUNTU_IMAGE = os.path.basename(UBUNTU_IMAGE_URL)
+UBUNTU_IMAGE_KNOWN_SHA256 = ""
 
 DISK = "/dev/nvme0n1"
 BOOTPART = "/dev/nvme0n1p1"
@@ -55,6 +102,38 @@ kernel_headers = None
 kernel_libc_dev = None
 
 WORKDIR = os.path.join(os.path.expanduser("~"), "flash")
+# Extra space added to the root filesystem of a golden image for the packages installed into it
+GOLDEN_IMAGE_HEADROOM = 4 * 1024 * 1024 * 1024
+ARTIFACT_CACHE = artifacts.ArtifactCache(os.path.join(WORKDIR, "cache"))
+# Alternative download locations: primary URL -> mirror URLs, in order of preference
+ARTIFACT_MIRRORS = {}
+PACKAGE_CACHE = pkgcache.PackageCache(os.path.join(WORKDIR, "packages"))
+# --delta: only rewrite the chunks that differ from the image each disk was last flashed with
+DELTA = False
+DELTA_INDEX_DIR = os.path.join(WORKDIR, "delta")
+# Image and flash writes bypass the host's page cache (O_DIRECT) with WRITE_QUEUE_DEPTH writes of
+# WRITE_BLOCK_SIZE in flight; --buffered writes through the page cache one request at a time instead.
+# None: probed per device and cached by model and serial under PROBE_DIR (probe.py)
+DIRECT_IO = True
+WRITE_BLOCK_SIZE = None
+WRITE_QUEUE_DEPTH = None
+PROBE_DIR = os.path.join(WORKDIR, "probe")
+# --fanout=URL: stream the OS image from a fan-out server on the LAN (python3 fanout.py serve), which
+# downloads it once for every board flashing at the same time
+FANOUT = None
+# Completed steps of interrupted runs, so a rerun picks up where it failed (--restart ignores them)
+JOURNAL_DIR = os.path.join(WORKDIR, "journal")
+RESTART = False
+JOURNALS = {}
+# Device tree patch (dtpatch.py): the edits in DT_PATCH are applied to DT_SOURCE and the result
+# is installed as DT_OUTPUT under the target's /boot ("dtb", or "overlay" for a DTBO).  Empty: no patching.
+DT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rk3588-rock-5b-plus.dts")
+DT_PATCH = ""
+DT_MODE = "dtb"
+DT_OUTPUT = "dtbs/rockchip/rk3588-rock-5b-plus.dtb"
+DT_CACHE_DIR = os.path.join(WORKDIR, "dt")
+# Stage timings of every run, one JSON object per line (--report=PATH, --prometheus=PATH)
+REPORT = report.Report(os.path.join(WORKDIR, "reports", f"run-{time.strftime('%Y%m%dT%H%M%S')}.jsonl"))
 
 def confirm_overwrite(auto, disk):
     if auto == "-y":
@@ -198,13 +277,13 @@ def update_packages():
     export_cmd = f"export DISTRO=focal-stable"
     wget_cmd = ["wget", "-O", "-", f"apt.radxa.com/focal-stable/public.key"]
     apt_key_cmd = ["apt-key", "add", "-"]
-    subprocess.run(f"{export_cmd} && {' '.join(wget_cmd)} | {' '.join(apt_key_cmd)}", shell=True, check=True)
+    REPORT.run("update_packages.apt_key", f"{export_cmd} && {' '.join(wget_cmd)} | {' '.join(apt_key_cmd)}", shell=True, check=True)
 
     print("Updating package list")
-    subprocess.run(["apt", "update", "-y"], check=True)
+    REPORT.run("update_packages.apt_update", ["apt", "update", "-y"], check=True)
 
     print("Grabbing required packages")
-    subprocess.run(["apt", "install", "-y"] + REQUIRED_PACKAGES_PREINSTALL.split(), check=True)
+    REPORT.run("update_packages.apt_install", ["apt", "install", "-y"] + REQUIRED_PACKAGES_PREINSTALL.split(), check=True)
 
 def download_file(url, save_path):
     response = requests.get(url, stream=True)
@@ -221,162 +300,623 @@ def md5sum(file_path):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
-def flash_spi():
-    print("Grabbing bootloader zero fill file (recommended prior to SPI reflash)")
-    subprocess.run(["wget", "-O", f"{WORKDIR}/{ZERO_IMAGE_FILENAME}", ZERO_IMAGE_URL], check=True)
-
-    zero_md5 = subprocess.run(["md5sum", f"{WORKDIR}/zero.img.gz"], capture_output=True, check=True, text=True).stdout.split()[0]
-    if zero_md5 != ZERO_KNOWN_MD5:
-        print("MD5 values do not match, halting")
+def fetch_artifact(url, known_digests=None):
+    try:
+        cached = ARTIFACT_CACHE.lookup(url, known_digests) is not None
+        with REPORT.stage("download", artifact=os.path.basename(urlparse(url).path), cached=cached) as step:
+            path = ARTIFACT_CACHE.fetch(url, known_digests)
+            step.bytes = os.path.getsize(path)
+        return path
+    except digests.DigestMismatch as e:
+        print(e)
+        print("Digest values do not match, halting")
         exit(1)
 
-    print("MD5 sum matched, unpacking and testing again")
-    subprocess.run(["gzip", "-vd", f"{WORKDIR}/zero.img.gz"], check=True)
-
-    zero_md5_unzipped = subprocess.run(["md5sum", f"{WORKDIR}/zero.img"], capture_output=True, check=True, text=True).stdout.split()[0]
-    if zero_md5_unzipped != ZERO_KNOWN_MD5_UNZIPPED:
-        print("MD5 values do not match, halting")
-        exit(1)
-
-    print("MD5 matches, proceeding with bootloader")
-    subprocess.run(["wget", "-O", f"{WORKDIR}/{BOOTLOADER_FILENAME}", BOOTLOADER_IMAGE_URL], check=True)
+def prefetch(stream=False, spi=False, image=True, debs=True, name="prefetch"):
+    # Download everything the run needs at once, each from its fastest mirror.
+    # The stages below then find it all in ARTIFACT_CACHE.  run() fetches the
+    # image and the rest (image=False) as separate tasks, so the kernel debs
+    # and the bootloader download while the image is being written.
+    global kernel_package, kernel_headers, kernel_libc_dev
+    wanted = []
+    if spi:
+        wanted.append(fetch.Artifact(BOOTLOADER_IMAGE_URL, [BOOTLOADER_KNOWN_MD5, BOOTLOADER_KNOWN_SHA256],
+                                     ARTIFACT_MIRRORS.get(BOOTLOADER_IMAGE_URL, ())))
+        if not SPI_DIFFERENTIAL:
+            wanted.append(fetch.Artifact(ZERO_IMAGE_URL, [ZERO_KNOWN_MD5, ZERO_KNOWN_SHA256],
+                                         ARTIFACT_MIRRORS.get(ZERO_IMAGE_URL, ())))
+    if image and imagepipe.is_url(UBUNTU_IMAGE_URL) and not stream:
+        # --stream downloads the image while writing it instead
+        wanted.append(fetch.Artifact(UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256, ARTIFACT_MIRRORS.get(UBUNTU_IMAGE_URL, ())))
+    for package in (kernel_package, kernel_headers, kernel_libc_dev) if debs else ():
+        if package and imagepipe.is_url(package):
+            wanted.append(fetch.Artifact(package, mirrors=ARTIFACT_MIRRORS.get(package, ())))
+    if not wanted:
+        return
 
-    bootloader_md5 = subprocess.run(["md5sum", f"{WORKDIR}/{BOOTLOADER_FILENAME}"], capture_output=True, check=True, text=True).stdout.split()[0]
-    if bootloader_md5 != BOOTLOADER_KNOWN_MD5:
-        print("MD5 values do not match, halting")
-        exit(1)
+    print(f"Fetching {len(wanted)} artifacts concurrently")
+    local = {}
+    with REPORT.stage(f"{name}.download") as step:
+        for url, result in fetch.fetch_all(ARTIFACT_CACHE, wanted).items():
+            if isinstance(result, Exception):
+                print(f"Prefetching {url} failed, it will be retried when it is needed: {result}")
+            else:
+                local[url] = result
+                step.bytes += os.path.getsize(result)
+    # Kernel debs given as URLs are installed from their downloaded copies
+    kernel_package, kernel_headers, kernel_libc_dev = (local.get(package, package) for package in
+                                                       (kernel_package, kernel_headers, kernel_libc_dev))
+
+def flash_spi(dry_run=False):
+    # Downloads are hashed as they arrive and the flash is read back exactly once: at the end, or
+    # in differential mode by diff_flash() itself, which compares every erase block and reads the
+    # rewritten ones back.
+    # Returns the bootloader image, also from a dry run (which writes nothing, so is never journaled).
+    print("Grabbing m.2 enabled bootloader")
+    bootloader_image = fetch_artifact(BOOTLOADER_IMAGE_URL, [BOOTLOADER_KNOWN_MD5, BOOTLOADER_KNOWN_SHA256])
 
     print("MD5 verification successful, proceeding with flash")
     if not os.path.exists("/dev/mtdblock0"):
         print("No flash block device found, halting")
         exit(1)
 
-    print("Found: /dev/mtdblock0, flashing zero.img (this takes approximately 193 seconds)...")
-    subprocess.run(["dd", f"if={WORKDIR}/zero.img", "of=/dev/mtdblock0"], check=True)
-
-    block_md5 = subprocess.run(["md5sum", "/dev/mtdblock0"], capture_output=True, check=True, text=True).stdout.split()[0]
-    if block_md5 != zero_md5_unzipped:
-        print("MD5 of zero.img differs from /dev/mdtblock0, exiting")
-        exit(1)
-
-    print("MD5 validated, flashing m.2 enabled bootloader (this also takes approximately 193 seconds)...")
-    subprocess.run(["dd", f"if={WORKDIR}/{BOOTLOADER_FILENAME}", "of=/dev/mtdblock0"], check=True)
+    if SPI_DIFFERENTIAL:
+        print("Found: /dev/mtdblock0, comparing it with the bootloader erase block by erase block...")
+        with open(bootloader_image, "rb") as f, REPORT.stage("flash_spi.diff") as step:
+            spi_report = spi.diff_flash(f.read(), "/dev/mtdblock0", dry_run=dry_run)
+            step.bytes = spi_report["blocks"] * spi_report["block_size"]
+        spi.print_report(spi_report)
+        if dry_run:
+            return bootloader_image
+    else:
+        print("Grabbing bootloader zero fill file (recommended prior to SPI reflash)")
+        zero_image_gz = fetch_artifact(ZERO_IMAGE_URL, [ZERO_KNOWN_MD5, ZERO_KNOWN_SHA256])
+
+        # zero.img is unpacked and hashed on its way to the flash
+        print("Found: /dev/mtdblock0, flashing zero.img (this takes approximately 193 seconds)...")
+        try:
+            imagepipe.stream_image(zero_image_gz, "/dev/mtdblock0", writer=flash_writer("/dev/mtdblock0"),
+                                   expect=[ZERO_KNOWN_MD5_UNZIPPED, ZERO_KNOWN_SHA256_UNZIPPED],
+                                   observer=lambda pipe: REPORT.add_pipeline("flash_spi.zero", pipe))
+        except digests.DigestMismatch as e:
+            print(e)
+            print("MD5 of unpacked zero.img does not match, halting")
+            exit(1)
+
+        print("Flashing m.2 enabled bootloader (this also takes approximately 193 seconds)...")
+        imagepipe.stream_image(bootloader_image, "/dev/mtdblock0", writer=flash_writer("/dev/mtdblock0"),
+                               observer=lambda pipe: REPORT.add_pipeline("flash_spi.bootloader", pipe))
 
     subprocess.run(["sync"], check=True)
 
-    spi_block_md5 = subprocess.run(["md5sum", "/dev/mtdblock0"], capture_output=True, check=True, text=True).stdout.split()[0]
-    if spi_block_md5 != BOOTLOADER_KNOWN_MD5:
-        print("MD5 of bootloader differs from /dev/mtdblock0, exiting")
-        exit(1)
-
+    if not SPI_DIFFERENTIAL:
+        print("Reading back /dev/mtdblock0 to verify the bootloader")
+        try:
+            with REPORT.stage("flash_spi.verify") as step:
+                step.bytes = os.path.getsize(bootloader_image)
+                digests.verify_device("/dev/mtdblock0", step.bytes, [BOOTLOADER_KNOWN_MD5, BOOTLOADER_KNOWN_SHA256])
+        except digests.DigestMismatch as e:
+            print(e)
+            print("MD5 of bootloader differs from /dev/mtdblock0, exiting")
+            exit(1)
     print("Flash complete. This device should now boot from a bootable M.2 PCIE drive")
+    return bootloader_image
 
-def install_os():
+def install_os(target, stream=False):
     print("Installing operating system")
     print("Checking for M.2 block device")
-    if not os.path.exists(DISK):
-        print(f"Unable to locate {DISK}, exiting")
+    if not os.path.exists(target.disk):
+        print(f"Unable to locate {target.disk}, exiting")
         exit(1)
 
-    print(f"Found {DISK}")
-    subprocess.run(["fdisk", "-l", DISK], check=True)
-
-    print("Nice, downloading operating system")
-    subprocess.run(["wget", "-O", f"{WORKDIR}/{UBUNTU_IMAGE}", UBUNTU_IMAGE_URL], check=True)
-
-    print("Super, writing operating system to disk")
-    with subprocess.Popen(["xzcat", f"{WORKDIR}/{UBUNTU_IMAGE}"], stdout=subprocess.PIPE) as xzcat_process:
-        subprocess.run(["dd", f"of={DISK}", "bs=1M", "status=progress"], stdin=xzcat_process.stdout, check=True)
+    print(f"Found {target.disk}")
+    subprocess.run(["fdisk", "-l", target.disk], check=True)
+    observer = lambda pipe: REPORT.add_pipeline("install_os", pipe, disk=target.disk)
+    writer = image_writer(target.disk)
+    # Size and digest of what is written, for the journal (installed_outputs)
+    written = journal.ImageDigest()
+
+    if not imagepipe.is_url(UBUNTU_IMAGE_URL):
+        print(f"Nice, writing {UBUNTU_IMAGE_URL} to disk (zero regions are skipped)")
+        imagepipe.stream_image(UBUNTU_IMAGE_URL, target.disk, observer=observer, writer=writer, tap=written)
+    elif FANOUT:
+        print(f"Nice, streaming operating system from {FANOUT} straight to disk")
+        imagepipe.stream_image(UBUNTU_IMAGE_URL, target.disk, source=lambda _: fanout.stream(FANOUT, UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256),
+                               observer=observer, writer=writer, tap=written)
+    elif stream:
+        print("Nice, streaming operating system straight to disk")
+        imagepipe.stream_image(UBUNTU_IMAGE_URL, target.disk, source=lambda _: ARTIFACT_CACHE.stream(UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256),
+                               observer=observer, writer=writer, tap=written)
+    else:
+        print("Nice, downloading operating system")
+        image = fetch_artifact(UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256)
 
-    print("Fixing partitions to 100% of usable space")
-    gdisk_commands = "x\ne\nw\nY\n"
-    subprocess.run(["gdisk", DISK], input=gdisk_commands, text=True, check=True)
-    subprocess.run(["partprobe"], check=True)
-    subprocess.run(["parted", DISK, "--script", "--", "resizepart", "2", "100%"], check=True)
-    subprocess.run(["e2fsck", "-f", ROOTPART], check=True)
-    subprocess.run(["resize2fs", ROOTPART], check=True)
+        print("Super, writing operating system to disk (zero regions are skipped)")
+        imagepipe.stream_image(image, target.disk, observer=observer, writer=writer, tap=written)
 
+    with REPORT.stage("fix_partitions", disk=target.disk):
+        fix_partitions(target)
     print("Drive fixed up, finished installing OS")
+    return written
+
+def host_journals():
+    # One journal per host task: they run concurrently, and redoing one must
+    # not forget the other (a journal drops everything recorded after a redone step).
+    packages = journal.Journal(os.path.join(JOURNAL_DIR, "host-packages.json"),
+                               {"preinstall": REQUIRED_PACKAGES_PREINSTALL}, RESTART)
+    spi = journal.Journal(os.path.join(JOURNAL_DIR, "host-spi.json"),
+                          {"bootloader": [BOOTLOADER_IMAGE_URL, BOOTLOADER_KNOWN_MD5, BOOTLOADER_KNOWN_SHA256]}, RESTART)
+    return packages, spi
+
+def journal_for(target):
+    # One journal per disk, shared by every stage of this run
+    if target.disk not in JOURNALS:
+        settings = {
+            "image": [UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256],
+            "packages": [REQUIRED_PACKAGES, PYTHON_PIP_PACKAGES],
+            "kernel": [kernel_package, kernel_headers, kernel_libc_dev],
+            "target": [target.disk, target.bootpart, target.rootpart, target.interface, target.ipaddress, target.gateway],
+        }
+        JOURNALS[target.disk] = journal.Journal(os.path.join(JOURNAL_DIR, f"{target.name}.json"), settings, RESTART)
+    return JOURNALS[target.disk]
+
+def packages_installed(outputs):
+    result = subprocess.run(["dpkg-query", "-W", "-f=${Status}\n"] + REQUIRED_PACKAGES_PREINSTALL.split(),
+                            capture_output=True, text=True)
+    return result.returncode == 0 and all(line.endswith(" installed") for line in result.stdout.splitlines())
+
+def spi_outputs(bootloader_image):
+    return {"size": os.path.getsize(bootloader_image), "sha256": journal.file_digest(bootloader_image)}
+
+def spi_flashed(outputs):
+    try:
+        digests.verify_device("/dev/mtdblock0", outputs["size"], outputs["sha256"])
+        return True
+    except digests.DigestMismatch:
+        return False
+
+def partition_table_outputs(target):
+    return {"partition_table": journal.partition_table_digest(target.disk)}
+
+def installed_outputs(target, written):
+    # The partition table install_os (with fix_partitions) left, and the size and digest of the image
+    # it wrote past that table, hashed on the way to the disk
+    return dict(partition_table_outputs(target), **written.outputs())
+
+def install_verified(target, outputs):
+    # Like spi_flashed(): the disk is read back and compared with what install_os wrote.  Only while
+    # install_os is the last step recorded, though; from the first mount on (disk_mounted) the later
+    # steps change the disk and the partition table has to do.
+    if partition_table_outputs(target)["partition_table"] != outputs["partition_table"]:
+        return False
+    if list(journal_for(target).steps)[-1] != "install_os":
+        return True
+    skip = outputs.get("skip", journal.PARTITION_TABLE_BYTES)
+    return journal.image_digest(target.disk, outputs["size"], skip) == outputs["sha256"]
+
+def install_done(target):
+    return journal_for(target).done("install_os", lambda outputs: install_verified(target, outputs))
+
+def disk_mounted(target):
+    # Recorded before a target is first mounted: from then on it no longer matches the written image.
+    progress = journal_for(target)
+    if "mounted" not in progress.steps:
+        progress.record("mounted")
+
+def image_writer(disk):
+    # Delta mode: compare with the chunk digests recorded when the disk was last flashed.
+    if DELTA:
+        return delta.DeltaWriter(disk, DELTA_INDEX_DIR, image=UBUNTU_IMAGE_URL)
+    if DIRECT_IO:
+        # The disk is about to be overwritten, so its end can serve for a calibration write
+        block_size, queue_depth, alignment = write_tuning(disk, calibrate=True)
+        return directio.DirectSparseWriter(disk, block_size=block_size, queue_depth=queue_depth, alignment=alignment)
+    return imagepipe.SparseWriter(disk)
+
+def flash_writer(device):
+    # Every byte of a flash image is written, zeros included.
+    if DIRECT_IO:
+        block_size, queue_depth, alignment = write_tuning(device)
+        return directio.DirectWriter(device, block_size=block_size, queue_depth=queue_depth, alignment=alignment)
+    return imagepipe.DeviceWriter(device)
+
+def write_tuning(device, calibrate=False):
+    # (block size, queue depth, alignment) for device; --write-block-size/--queue-depth override the probe.
+    with REPORT.stage("probe", disk=device):
+        tuning = probe.tune(device, calibrate and not DELTA, PROBE_DIR)
+    print(probe.describe(tuning))
+    return WRITE_BLOCK_SIZE or tuning["block_size"], WRITE_QUEUE_DEPTH or tuning["queue_depth"], tuning["alignment"]
+
+def fix_partitions(target):
+    print("Fixing partitions to 100% of usable space")
+    # Backup GPT header to the end of the disk and partition 2 to fill it, in one edit.  The
+    # filesystem is grown online once it is mounted (grow_root_filesystem), which needs no e2fsck -f.
+    with REPORT.stage("fix_partitions.gpt", disk=target.disk):
+        old_last, new_last = gpt.grow(target.disk, 2)
+    print(f"Partition 2 now ends at sector {new_last} (was {old_last})")
+
+def install_os_batch(batch, stream=False):
+    print(f"Installing operating system to {len(batch)} disks")
+    present = []
+    for target in batch:
+        if os.path.exists(target.disk):
+            present.append(target)
+        else:
+            print(f"Unable to locate {target.disk}, skipping it")
+    if not present:
+        print("No target disks found, exiting")
+        exit(1)
 
-def customize_os():
-    print("Mounting chroot environment")
-    subprocess.run(["mount", ROOTPART, "/mnt"], check=True)
-    subprocess.run(["mount", BOOTPART, "/mnt/boot"], check=True)
-    subprocess.run(["mount", "--bind", "/dev", "/mnt/dev"], check=True)
-    subprocess.run(["mount", "--bind", "/dev/pts", "/mnt/dev/pts"], check=True)
-    subprocess.run(["mount", "--bind", "/proc", "/mnt/proc"], check=True)
-    subprocess.run(["mount", "--bind", "/sys", "/mnt/sys"], check=True)
-    subprocess.run(["cp", "/etc/resolv.conf", "/mnt/etc/resolv.conf"], check=True)
-
-    print("Disabling cloud-init network configuration")
-    cloud_init_net_cfg = "network: {config: disabled}"
-    with open("/mnt/etc/cloud/cloud.cfg.d/99-disable-network-config.cfg", "w") as f:
-        f.write(cloud_init_net_cfg)
-    
-    print("Chrooting to configure target operating system")
-    chroot_script = f"""\
-apt update -y
-apt upgrade -y
-apt install {REQUIRED_PACKAGES} -y
-python3 -m pip install {PYTHON_PIP_PACKAGES}
-if [ "{{IPADDRESS}}" = "dhcp" ]; then
-  cat <<EOB > /etc/netplan/01-dhcp.yaml
+    resumed = [target for target in present if install_done(target)]
+    present = [target for target in present if target not in resumed]
+    if not present:
+        return resumed
+    for target in present:
+        journal_for(target).forget("install_os")
+
+    if not imagepipe.is_url(UBUNTU_IMAGE_URL):
+        location = UBUNTU_IMAGE_URL
+        source = None
+    elif FANOUT:
+        print(f"Nice, streaming operating system from {FANOUT} straight to every disk")
+        location = UBUNTU_IMAGE_URL
+        source = lambda _: fanout.stream(FANOUT, UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256)
+    elif stream:
+        print("Nice, streaming operating system straight to every disk")
+        location = UBUNTU_IMAGE_URL
+        source = lambda _: ARTIFACT_CACHE.stream(UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256)
+    else:
+        print("Nice, downloading operating system")
+        location = fetch_artifact(UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256)
+        source = None
+
+    print("Super, decompressing once and writing to every disk")
+    written = journal.ImageDigest()
+    results = imagepipe.stream_to_targets(location, [target.disk for target in present], source=source,
+                                          observer=lambda pipe: REPORT.add_pipeline("install_os", pipe),
+                                          make_writer=image_writer, tap=written)
+    succeeded = []
+    for target in present:
+        if results[target.disk] is None:
+            succeeded.append(target)
+        else:
+            print(f"{target.disk}: write failed: {results[target.disk]}")
+
+    installed = targets.for_each(succeeded, lambda target: timed("fix_partitions", fix_partitions, target),
+                                 "fix_partitions")
+    for target in installed:
+        journal_for(target).record("install_os", installed_outputs(target, written))
+    print(f"Finished installing OS on {len(installed) + len(resumed)} of {len(batch)} disks")
+    return resumed + installed
+
+def customize_os(target, network=True):
+    # Everything runs through one chroot session: the mounts and the shell are
+    # set up once and always torn down again, also when a step fails.
+    disk_mounted(target)
+    with chroot.ChrootSession(target, REPORT) as session:
+        grow_root_filesystem(target)
+
+        progress = journal_for(target)
+        try:
+            # Inside the try: a bind that fails halfway is still taken down
+            print("Binding host package cache into the chroot")
+            PACKAGE_CACHE.bind(target)
+
+            print("Disabling cloud-init network configuration")
+            cloud_init_net_cfg = "network: {config: disabled}"
+            with open(target.path("etc/cloud/cloud.cfg.d/99-disable-network-config.cfg"), "w") as f:
+                f.write(cloud_init_net_cfg)
+
+            print("Chrooting to configure target operating system")
+            # One session command per step so each step shows up in the run report
+            chroot_steps = [
+                ("apt_update", "apt update -y"),
+                ("apt_upgrade", "apt upgrade -y"),
+                ("apt_install", f"apt install {REQUIRED_PACKAGES} -y"),
+                ("pip_install", f"python3 -m pip install {PYTHON_PIP_PACKAGES}"),
+                ("enable_docker", "systemctl enable docker.service"),
+            ]
+            print ("Running chroot script")
+            for step, command in chroot_steps:
+                progress.run(f"customize_os.{step}", lambda: session.run(command, f"customize_os.{step}"))
+            print ("Done with chroot script")
+
+            if network:
+                write_netplan(target)
+
+            # Custom kernel debs in one dpkg transaction, so their triggers
+            # (initramfs, ...) run once; reinstalled on a rerun only if a file changed
+            packages = {name: package for name, package in (("kernel_package", kernel_package),
+                                                            ("kernel_headers", kernel_headers),
+                                                            ("kernel_libc_dev", kernel_libc_dev)) if package}
+            if packages:
+                progress.run("customize_os.kernel_debs", lambda: install_debs(session, packages.values()),
+                             verify=lambda outputs: outputs == {name: journal.file_digest(package)
+                                                                for name, package in packages.items()},
+                             outputs=lambda _: {name: journal.file_digest(package) for name, package in packages.items()})
+
+            # Last, so a kernel package can't replace the patched device tree
+            if DT_PATCH:
+                destination = target.path("boot", DT_OUTPUT)
+                progress.run("customize_os.devicetree", lambda: install_device_tree(target, destination),
+                             verify=lambda outputs: outputs["key"] == dtpatch.build_key(DT_SOURCE, DT_PATCH, DT_MODE)
+                             and outputs["sha256"] == journal.file_digest(destination),
+                             outputs=lambda _: {"key": dtpatch.build_key(DT_SOURCE, DT_PATCH, DT_MODE),
+                                                "sha256": journal.file_digest(destination)})
+        finally:
+            PACKAGE_CACHE.unbind(target)
+
+def install_device_tree(target, destination):
+    with REPORT.stage("customize_os.devicetree", disk=target.disk):
+        dtpatch.install(DT_SOURCE, DT_PATCH, destination, DT_MODE, DT_CACHE_DIR)
+
+def install_debs(session, packages):
+    copied = [session.copy_in(package) for package in packages]
+    try:
+        session.run(f"dpkg -i {' '.join(copied)}", "customize_os.dpkg")
+    finally:
+        session.run(f"rm -f {' '.join(copied)}", "customize_os.dpkg_cleanup", check=False)
+
+def grow_root_filesystem(target):
+    # Online resize into the space fix_partitions() gave partition 2; a no-op once it fills it.
+    REPORT.run("grow_root_filesystem", ["resize2fs", target.rootpart], check=True, labels={"disk": target.disk})
+
+def customize_installed(graph, customize, target):
+    # A batch disk whose image write failed is left alone; True once customized.
+    if target not in graph.result("install_os"):
+        print(f"{target.disk} was not installed, not customizing it")
+        return False
+    customize(target)
+    journal_for(target).clear()
+    return True
+
+def timed(name, action, target):
+    with REPORT.stage(name, disk=target.disk):
+        return action(target)
+
+def write_netplan(target):
+    if target.ipaddress == "dhcp":
+        netplan_file = target.path("etc/netplan/01-dhcp.yaml")
+        netplan_cfg = f"""\
 network:
   version: 2
   renderer: networkd
   ethernets:
-    {{INET_INTERFACE}}:
+    {target.interface}:
       dhcp4: yes
-EOB
-else
-  cat <<EOB > /etc/netplan/01-static-ip.yaml
+"""
+    else:
+        netplan_file = target.path("etc/netplan/01-static-ip.yaml")
+        netplan_cfg = f"""\
 network:
   version: 2
   renderer: networkd
   ethernets:
-    {INET_INTERFACE}:
+    {target.interface}:
       addresses:
-        - {IPADDRESS}
-      gateway4: {GATEWAY}
-EOB
-fi
-systemctl enable docker.service
+        - {target.ipaddress}
+      gateway4: {target.gateway}
 """
-    print ("Running chroot script")
-    subprocess.run(["chroot", "/mnt", "/bin/bash"], input=chroot_script, text=True, check=True)
-    print ("Done with chroot script")
-
-    # Handle kernel_package
-    if kernel_package:
-        kernel_package_basename = os.path.basename(kernel_package)
-        subprocess.run(["cp", kernel_package, f"/mnt/{kernel_package_basename}"], check=True)
-        subprocess.run(["chroot", "/mnt", "/bin/bash", "-c", f"dpkg -i /{kernel_package_basename}"], check=True)
-        subprocess.run(["rm", f"/mnt/{kernel_package_basename}"], check=True)
-
-    # Handle kernel_headers
-    if kernel_headers:
-        kernel_headers_basename = os.path.basename(kernel_headers)
-        subprocess.run(["cp", kernel_headers, f"/mnt/{kernel_headers_basename}"], check=True)
-        subprocess.run(["chroot", "/mnt", "/bin/bash", "-c", f"dpkg -i /{kernel_headers_basename}"], check=True)
-        subprocess.run(["rm", f"/mnt/{kernel_headers_basename}"], check=True)
-
-    if kernel_libc_dev:
-        kernel_libc_dev_basename = os.path.basename(kernel_libc_dev)
-        subprocess.run(["cp", kernel_libc_dev, f"/mnt/{kernel_libc_dev_basename}"], check=True)
-        subprocess.run(["chroot", "/mnt", "/bin/bash", "-c", f"dpkg -i /{kernel_libc_dev_basename}"], check=True)
-        subprocess.run(["rm", f"/mnt/{kernel_libc_dev_basename}"], check=True)
+    print(f"Writing {netplan_file}")
+    with open(netplan_file, "w") as f:
+        f.write(netplan_cfg)
+
+def configure_network(target):
+    # All a board flashed from a golden image still needs: its own network configuration.
+    disk_mounted(target)
+    os.makedirs(target.mountpoint, exist_ok=True)
+    subprocess.run(["mount", target.rootpart, target.mountpoint], check=True)
+    try:
+        grow_root_filesystem(target)
+        write_netplan(target)
+    finally:
+        subprocess.run(["umount", target.mountpoint], check=True)
+
+def build_golden_image(output):
+    # Apply customize_os() once to an image file through a loop device, so boards only need the write.
+    print(f"Building pre-customized image {output}")
+    golden.check_chroot_arch()
+    if imagepipe.is_url(UBUNTU_IMAGE_URL):
+        image = fetch_artifact(UBUNTU_IMAGE_URL, UBUNTU_IMAGE_KNOWN_SHA256)
+    else:
+        image = UBUNTU_IMAGE_URL
+    imagepipe.stream_image(image, output)
+    golden.grow_image(output, GOLDEN_IMAGE_HEADROOM)
+
+    loop_device = golden.attach(output)
+    target = targets.Target(loop_device, mountpoint=os.path.join(WORKDIR, "golden"))
+    # The image was just streamed fresh, so whatever an earlier build journaled
+    # for this loop device says nothing about it: customize it in full.
+    progress = journal_for(target)
+    progress.clear()
+    try:
+        fix_partitions(target)
+        customize_os(target, network=False)
+    finally:
+        progress.clear()
+        golden.unmount(target.mountpoint)
+        golden.detach(loop_device)
+    print(f"Golden image ready, flash it with --golden={output}")
+
+def get_option(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg.startswith(f"{name}="):
+            return arg.split("=", 1)[1]
+    return default
+
+def default_target():
+    return targets.Target(DISK, BOOTPART, ROOTPART, TARGET_DIRECTORY, INET_INTERFACE, IPADDRESS, GATEWAY)
+
+def batch_targets(devices):
+    # Every disk gets its own mount point so the chroot stages can run side by side.
+    # A single static IP can't be shared, so batch boards come up on DHCP.
+    return [targets.Target(device, mountpoint=os.path.join(TARGET_DIRECTORY, os.path.basename(device)),
+                           interface=INET_INTERFACE)
+            for device in devices]
+
+def profile_defaults():
+    return {
+        "image_url": UBUNTU_IMAGE_URL, "image_sha256": UBUNTU_IMAGE_KNOWN_SHA256,
+        "zero_url": ZERO_IMAGE_URL, "zero_md5": ZERO_KNOWN_MD5, "zero_md5_unzipped": ZERO_KNOWN_MD5_UNZIPPED,
+        "zero_sha256": ZERO_KNOWN_SHA256, "zero_sha256_unzipped": ZERO_KNOWN_SHA256_UNZIPPED,
+        "bootloader_url": BOOTLOADER_IMAGE_URL, "bootloader_md5": BOOTLOADER_KNOWN_MD5,
+        "bootloader_sha256": BOOTLOADER_KNOWN_SHA256,
+        "apt_packages": REQUIRED_PACKAGES, "pip_packages": PYTHON_PIP_PACKAGES,
+        "kernel_package": kernel_package, "kernel_headers": kernel_headers, "kernel_libc_dev": kernel_libc_dev,
+        "interface": INET_INTERFACE,
+        "image_mirrors": ARTIFACT_MIRRORS.get(UBUNTU_IMAGE_URL, []),
+        "zero_mirrors": ARTIFACT_MIRRORS.get(ZERO_IMAGE_URL, []),
+        "bootloader_mirrors": ARTIFACT_MIRRORS.get(BOOTLOADER_IMAGE_URL, []),
+        "dt_source": DT_SOURCE, "dt_patch": DT_PATCH, "dt_mode": DT_MODE, "dt_output": DT_OUTPUT,
+    }
+
+def apply_profile(profile):
+    # The profile replaces get_inputs(): copy it over the module settings and return its boards as targets.
+    global ZERO_IMAGE_URL, ZERO_KNOWN_MD5, ZERO_KNOWN_MD5_UNZIPPED, ZERO_KNOWN_SHA256, ZERO_KNOWN_SHA256_UNZIPPED
+    global BOOTLOADER_IMAGE_URL, BOOTLOADER_KNOWN_MD5, BOOTLOADER_KNOWN_SHA256
+    global REQUIRED_PACKAGES, PYTHON_PIP_PACKAGES
+    global UBUNTU_IMAGE_URL, UBUNTU_IMAGE, UBUNTU_IMAGE_KNOWN_SHA256
+    global kernel_package, kernel_headers, kernel_libc_dev
+    global DT_SOURCE, DT_PATCH, DT_MODE, DT_OUTPUT
+
+    UBUNTU_IMAGE_URL = profile.image_url
+    UBUNTU_IMAGE = os.path.basename(UBUNTU_IMAGE_URL)
+    UBUNTU_IMAGE_KNOWN_SHA256 = profile.image_sha256
+    ZERO_IMAGE_URL = profile.zero_url
+    ZERO_KNOWN_MD5 = profile.zero_md5
+    ZERO_KNOWN_MD5_UNZIPPED = profile.zero_md5_unzipped
+    ZERO_KNOWN_SHA256 = profile.zero_sha256
+    ZERO_KNOWN_SHA256_UNZIPPED = profile.zero_sha256_unzipped
+    BOOTLOADER_IMAGE_URL = profile.bootloader_url
+    BOOTLOADER_KNOWN_MD5 = profile.bootloader_md5
+    BOOTLOADER_KNOWN_SHA256 = profile.bootloader_sha256
+    REQUIRED_PACKAGES = " ".join(profile.apt_packages)
+    PYTHON_PIP_PACKAGES = " ".join(profile.pip_packages)
+    kernel_package = profile.kernel_package
+    kernel_headers = profile.kernel_headers
+    kernel_libc_dev = profile.kernel_libc_dev
+    ARTIFACT_MIRRORS[UBUNTU_IMAGE_URL] = profile.image_mirrors
+    ARTIFACT_MIRRORS[ZERO_IMAGE_URL] = profile.zero_mirrors
+    ARTIFACT_MIRRORS[BOOTLOADER_IMAGE_URL] = profile.bootloader_mirrors
+    DT_SOURCE = profile.dt_source
+    DT_PATCH = profile.dt_patch
+    DT_MODE = profile.dt_mode
+    DT_OUTPUT = profile.dt_output
+    return profile.targets(TARGET_DIRECTORY)
 
 def main():
     auto = '-y' in sys.argv
+    stream = '--stream' in sys.argv
+    REPORT.path = get_option("--report", REPORT.path)
+    REPORT.prometheus_path = get_option("--prometheus")
+    try:
+        run(auto, stream)
+    finally:
+        REPORT.summary()
+        REPORT.write_prometheus()
+
+def run(auto, stream):
+    global UBUNTU_IMAGE_URL, DELTA, RESTART, DIRECT_IO, WRITE_BLOCK_SIZE, WRITE_QUEUE_DEPTH, FANOUT
+
+    DELTA = '--delta' in sys.argv
+    DIRECT_IO = '--buffered' not in sys.argv
+    FANOUT = get_option("--fanout")
+    if get_option("--write-block-size"):
+        WRITE_BLOCK_SIZE = int(get_option("--write-block-size"))
+    if get_option("--queue-depth"):
+        WRITE_QUEUE_DEPTH = int(get_option("--queue-depth"))
+    RESTART = '--restart' in sys.argv
+    targets_option = get_option("--targets")
+    devices = targets.expand_devices(targets_option) if targets_option else []
+
+    if targets_option is not None and not devices:
+        print(f"No target devices matched {targets_option}, exiting")
+        exit(1)
 
-    confirm_overwrite(auto, DISK)
-    get_inputs(auto)
-    confirm_variables(auto)
+    profile_path = get_option("--profile")
+    batch = None
+    if profile_path:
+        try:
+            batch = apply_profile(manifest.load(profile_path, profile_defaults()))
+        except manifest.ProfileError as e:
+            print(e)
+            exit(1)
+        devices = [target.disk for target in batch]
+
+    golden_output = get_option("--build-golden")
+    if golden_output:
+        if not profile_path:
+            get_inputs(auto)
+        confirm_variables(auto)
+        with REPORT.stage("build_golden_image"):
+            build_golden_image(golden_output)
+        return
+
+    golden_image = get_option("--golden")
+    if golden_image:
+        UBUNTU_IMAGE_URL = golden_image
+    customize = configure_network if golden_image else customize_os
+
+    # Concurrent chroots can't share one apt archive directory, so a batch shares a local caching proxy.
+    PACKAGE_CACHE.proxy = get_option("--package-proxy")
+    if devices and not PACKAGE_CACHE.proxy:
+        proxy = pkgcache.CachingProxy(os.path.join(WORKDIR, "packages", "proxy"), port=0, host="127.0.0.1")
+        PACKAGE_CACHE.proxy = proxy.start()
 
-    update_packages()
-    # flash_spi()
-    install_os()
-    customize_os()
+    if not profile_path:
+        get_inputs(auto)
+    confirm_variables(auto)
+    if devices:
+        batch = batch or batch_targets(devices)
+    # Only after get_inputs(), which may pick another DISK.  A disk an interrupted run already
+    # installed keeps its partition table so that run can be resumed.
+    for target in batch or [default_target()]:
+        if "install_os" in journal_for(target).steps:
+            print(f"Resuming the interrupted run on {target.disk}, leaving its partition table alone")
+        else:
+            confirm_overwrite(auto, target.disk)
+
+    host_packages, host_spi = host_journals()
+    flash = '--flash-spi' in sys.argv
+    graph = taskgraph.TaskGraph(REPORT, max_parallel=1 if '--sequential' in sys.argv else None)
+    # The SPI flash, the target disks and the host's own packages are independent of each other;
+    # only the tasks on one device wait for each other.
+    graph.add("fetch_image", lambda: prefetch(stream, debs=False, name="fetch_image"), outputs=["image"])
+    graph.add("prefetch", lambda: prefetch(spi=flash, image=False), outputs=["kernel_debs", "bootloader"])
+    graph.add("update_packages",
+              lambda: host_packages.run("update_packages", update_packages, verify=packages_installed), locks=["apt"])
+    if flash:
+        graph.add("flash_spi", lambda: host_spi.run("flash_spi", flash_spi, verify=spi_flashed, outputs=spi_outputs),
+                  inputs=["bootloader"], locks=["/dev/mtdblock0"])
+    if devices:
+        graph.add("install_os", lambda: install_os_batch(batch, stream), inputs=["image"],
+                  locks=[target.disk for target in batch])
+        for target in batch:
+            graph.add(f"{customize.__name__} {target.disk}",
+                      lambda target=target: customize_installed(graph, customize, target),
+                      inputs=["kernel_debs"], after=["install_os"], locks=[target.disk],
+                      stage=customize.__name__, disk=target.disk)
+    else:
+        target = default_target()
+        install = lambda: journal_for(target).run("install_os", lambda: install_os(target, stream),
+                                                  verify=lambda outputs: install_verified(target, outputs),
+                                                  outputs=lambda written: installed_outputs(target, written))
+        graph.add("install_os", install, inputs=["image"], locks=[target.disk], disk=target.disk)
+        graph.add(customize.__name__, lambda: customize(target), inputs=["kernel_debs"], after=["install_os"],
+                  locks=[target.disk], disk=target.disk)
+    try:
+        results = graph.run()
+    finally:
+        graph.summary()
+    if devices:
+        customized = sum(1 for target in batch if results[f"{customize.__name__} {target.disk}"])
+        print(f"Provisioned {customized} of {len(devices)} disks")
+        if customized < len(devices):
+            return
+    else:
+        journal_for(target).clear()
+    host_packages.clear()
+    host_spi.clear()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,160 @@
+#
+# Long-lived chroot session for customizing a mounted target.
+#
+# customize_os() used to start a new `chroot ... /bin/bash -c` for every
+# step, set up its mounts with one subprocess call each and never took them
+# down, not even when a step failed.  A ChrootSession mounts the target once,
+# keeps a single bash running inside it and feeds it commands.  Each command
+# runs in a subshell with stdin from /dev/null, and its exit status comes back
+# over a pipe of its own, so the command's output still goes straight to the
+# console.  Leaving the `with` block, normally or through an exception, stops
+# the shell and unmounts everything, innermost first.
+#
+#   with ChrootSession(target) as session:
+#       session.run("apt update -y")
+#       session.run_batch([("apt_upgrade", "apt upgrade -y"), ("ls", "ls /boot")])
+#
+import os
+import uuid
+import shutil
+import subprocess
+
+SHELL_EXIT_TIMEOUT = 60
+
+
+class ChrootCommandFailed(Exception):
+    def __init__(self, name, command, returncode):
+        super().__init__(f"{name} ({command}) failed with exit code {returncode}")
+        self.name = name
+        self.command = command
+        self.returncode = returncode
+
+
+class ChrootSession:
+    def __init__(self, target, report=None, labels=None):
+        # report: optional report.Report, each command is timed as a stage of it.
+        self.target = target
+        self.report = report
+        self.labels = labels or {"disk": target.disk}
+        self.mounted = []
+        self.shell = None
+        self.status = None
+        self.status_fd = None
+
+    def __enter__(self):
+        try:
+            self.mount()
+            self.start()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _mount(self, arguments, mountpoint):
+        os.makedirs(mountpoint, exist_ok=True)
+        if os.path.ismount(mountpoint):
+            # Left behind by an interrupted run: reuse it, and take it down with the rest
+            print(f"{mountpoint} is already mounted, reusing it")
+        else:
+            subprocess.run(["mount"] + arguments + [mountpoint], check=True)
+        self.mounted.append(mountpoint)
+
+    def mount(self):
+        target = self.target
+        print(f"Mounting {target.rootpart} and its chroot environment at {target.mountpoint}")
+        self._mount([target.rootpart], target.mountpoint)
+        self._mount([target.bootpart], target.path("boot"))
+        for source in ("/dev", "/dev/pts", "/proc", "/sys"):
+            self._mount(["--bind", source], target.path(source.lstrip("/")))
+        # Name resolution inside the chroot; replaces a dangling systemd-resolved symlink
+        resolv = target.path("etc/resolv.conf")
+        if os.path.islink(resolv):
+            os.unlink(resolv)
+        shutil.copyfile("/etc/resolv.conf", resolv)
+
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ, DEBIAN_FRONTEND="noninteractive")
+        try:
+            self.shell = subprocess.Popen(["chroot", self.target.mountpoint, "/bin/bash", "--noprofile", "--norc"],
+                                          stdin=subprocess.PIPE, pass_fds=(write_fd,), env=env, text=True)
+        finally:
+            os.close(write_fd)
+        self.status = os.fdopen(read_fd)
+        self.status_fd = write_fd
+
+    def run(self, command, name=None, check=True):
+        # Run command in the chroot; returns its exit code.
+        name = name or command
+        if self.report is not None:
+            with self.report.stage(name, **self.labels):
+                returncode = self._run(command)
+        else:
+            returncode = self._run(command)
+        if check and returncode != 0:
+            raise ChrootCommandFailed(name, command, returncode)
+        return returncode
+
+    def _run(self, command):
+        if self.shell is None or self.shell.poll() is not None:
+            raise Exception(f"The chroot shell in {self.target.mountpoint} is not running")
+        token = uuid.uuid4().hex
+        self.shell.stdin.write(f"(\n{command}\n) </dev/null; echo \"{token} $?\" >&{self.status_fd}\n")
+        self.shell.stdin.flush()
+        line = self.status.readline()
+        if not line:
+            raise Exception(f"The chroot shell in {self.target.mountpoint} exited unexpectedly")
+        received, returncode = line.split()
+        if received != token:
+            raise Exception(f"Out of sync with the chroot shell in {self.target.mountpoint}")
+        return int(returncode)
+
+    def run_batch(self, commands, check=True):
+        # commands: [(name, command)], run in order.  Returns {name: exit code};
+        # with check, the first failure raises and the rest don't run.
+        results = {}
+        for name, command in commands:
+            results[name] = self.run(command, name, check)
+        return results
+
+    def copy_in(self, path, directory="tmp"):
+        # Copy a host file into the target; returns its path inside the chroot.
+        os.makedirs(self.target.path(directory), exist_ok=True)
+        shutil.copyfile(path, self.target.path(directory, os.path.basename(path)))
+        return "/" + os.path.join(directory, os.path.basename(path))
+
+    def stop(self):
+        if self.shell is None:
+            return
+        try:
+            if self.shell.poll() is None:
+                self.shell.stdin.write("exit\n")
+                self.shell.stdin.close()
+                self.shell.wait(timeout=SHELL_EXIT_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.shell.kill()
+            self.shell.wait()
+        finally:
+            self.status.close()
+            self.shell = None
+
+    def unmount(self):
+        # Everything that was mounted, innermost first.  A busy mount is
+        # detached lazily rather than left behind.
+        for mountpoint in reversed(self.mounted):
+            if not os.path.ismount(mountpoint):
+                continue
+            if subprocess.run(["umount", mountpoint]).returncode != 0:
+                print(f"Unable to unmount {mountpoint}, detaching it lazily")
+                subprocess.run(["umount", "--lazy", mountpoint])
+        self.mounted = []
+
+    def close(self):
+        try:
+            self.stop()
+        finally:
+            self.unmount()
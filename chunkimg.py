@@ -0,0 +1,425 @@
+#
+# Seekable chunked disk images (.cimg).
+#
+# An .img.xz or .img.gz can only be read from the start: checking, comparing
+# or resuming a write halfway through the image means decoding everything
+# before it.  A .cimg holds the same image cut into fixed-size chunks, each
+# compressed on its own (a zstd frame, or an xz stream when the zstandard
+# package isn't installed), with a trailer index recording every chunk's
+# file offset, compressed size, length, sha256 and whether it is all zeros.
+#
+#   header   magic, version, codec, chunk size
+#   frames   per chunk: a frame header (compressed size, length, zero flag,
+#            sha256) followed by the compressed chunk; all-zero chunks are
+#            stored as a header alone
+#   end      a frame header with compressed size END
+#   index    one entry per chunk: file offset of its frame, then the frame
+#            header fields
+#   trailer  index offset, chunk count, image size and sha256, index CRC, magic
+#
+# The frame headers make the file decodable as a plain stream (imagepipe
+# picks .cimg by extension): chunks are decoded on every core and checked
+# against their digest, and zero chunks are never decoded at all.  The index
+# makes it seekable, locally or over HTTP with Range requests, so a write can
+# resume at any chunk and a disk can be compared chunk by chunk without
+# decoding anything.
+#
+#   python3 chunkimg.py repack ubuntu.img.xz ubuntu.cimg [--chunk-size=4M] [--codec=xz]
+#   python3 chunkimg.py info|verify ubuntu.cimg
+#   python3 chunkimg.py compare ubuntu.cimg /dev/nvme0n1
+#   python3 chunkimg.py write ubuntu.cimg /dev/nvme0n1 [--from=CHUNK | --resume]
+#
+import os
+import sys
+import lzma
+import stat
+import zlib
+import struct
+import hashlib
+import itertools
+import collections
+import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import imagepipe
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"RK5BCIMG"
+VERSION = 1
+SUFFIX = ".cimg"
+CHUNK_SIZE = 4 * 1024 * 1024
+# Pieces the compressed file is read or downloaded in
+READ_SIZE = 1024 * 1024
+HEADER = struct.Struct("<8sHH4sQ")
+FRAME = struct.Struct("<IIB3x32s")
+ENTRY = struct.Struct("<QIIB3x32s")
+TRAILER = struct.Struct("<QQQ32sI8s")
+END = 0xFFFFFFFF
+ZERO = 0x01
+CODECS = ("zstd", "xz")
+ZSTD_LEVEL = 10
+XZ_PRESET = 6
+
+
+def is_chunked(name):
+    return name.lower().endswith(SUFFIX)
+
+
+def default_codec():
+    return "zstd" if zstandard is not None else "xz"
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def _need_codec(codec):
+    if codec not in CODECS:
+        raise Exception(f"Unknown chunk codec {codec}, expected one of {', '.join(CODECS)}")
+    if codec == "zstd" and zstandard is None:
+        raise Exception("This image is zstd compressed, which needs the zstandard package (pip install zstandard)")
+
+
+def compress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return lzma.compress(data, preset=XZ_PRESET)
+
+
+def decompress(codec, data, length):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=length)
+    return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+class Chunk:
+    __slots__ = ("index", "offset", "size", "length", "flags", "digest")
+
+    def __init__(self, index, offset, size, length, flags, digest):
+        self.index = index
+        self.offset = offset
+        self.size = size
+        self.length = length
+        self.flags = flags
+        self.digest = digest
+
+    @property
+    def zero(self):
+        return bool(self.flags & ZERO)
+
+
+def decode_chunk(codec, chunk, data):
+    # The chunk's contents from its compressed bytes, checked against its digest.
+    if chunk.zero:
+        return bytes(chunk.length)
+    out = decompress(codec, data, chunk.length)
+    if len(out) != chunk.length or hashlib.sha256(out).digest() != chunk.digest:
+        raise Exception(f"Chunk {chunk.index} does not match its digest")
+    return out
+
+
+def _regroup(pieces, size):
+    # Fixed-size pieces from arbitrarily sized ones; the last may be shorter.
+    buf = bytearray()
+    for piece in pieces:
+        buf += piece
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def _pack(codec, data):
+    # (compressed bytes, flags, sha256) of one chunk, on a worker thread.
+    if data.count(0) == len(data):
+        return b"", ZERO, hashlib.sha256(data).digest()
+    return compress(codec, data), 0, hashlib.sha256(data).digest()
+
+
+def repack(location, output, chunk_size=CHUNK_SIZE, codec=None, workers=None):
+    # Write location (a raw, .xz or .gz image, local or http) as a .cimg.
+    codec = codec or default_codec()
+    _need_codec(codec)
+    workers = workers or default_workers()
+    name = urlparse(location).path if imagepipe.is_url(location) else location
+    source = imagepipe.http_source(location) if imagepipe.is_url(location) else imagepipe.file_source(location)
+    decoder = imagepipe.Decoder(name)
+
+    def decoded():
+        for data in source(None):
+            yield from decoder.feed(data)
+        decoder.finish()
+
+    entries = []
+    image_hash = hashlib.sha256()
+    tmp = f"{output}.{os.getpid()}.tmp"
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cimg")
+    pending = collections.deque()
+    try:
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, codec.encode().ljust(4, b"\0"), chunk_size))
+
+            def flush(future, length):
+                packed, flags, digest = future.result()
+                entries.append(ENTRY.pack(f.tell(), len(packed), length, flags, digest))
+                f.write(FRAME.pack(len(packed), length, flags, digest))
+                f.write(packed)
+
+            for data in _regroup(decoded(), chunk_size):
+                image_hash.update(data)
+                pending.append((pool.submit(_pack, codec, data), len(data)))
+                while len(pending) > workers * 2:
+                    flush(*pending.popleft())
+            while pending:
+                flush(*pending.popleft())
+
+            f.write(FRAME.pack(END, 0, 0, bytes(32)))
+            index = b"".join(entries)
+            index_offset = f.tell()
+            f.write(index)
+            size = sum(ENTRY.unpack(entry)[2] for entry in entries)
+            f.write(TRAILER.pack(index_offset, len(entries), size, image_hash.digest(), zlib.crc32(index), MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    print(f"Repacked {location} into {len(entries)} chunks of {chunk_size // 1024} KiB ({codec}), "
+          f"{sum(ENTRY.unpack(entry)[3] & ZERO for entry in entries)} of them zero, {os.path.getsize(output)} bytes")
+    return output
+
+
+def frames(chunks):
+    # (Chunk, compressed bytes) for each frame of a .cimg read as a stream.
+    # Chunk.offset is not known here and left None.
+    buf = bytearray()
+    chunks = iter(chunks)
+
+    def fill(size):
+        while len(buf) < size:
+            data = next(chunks, None)
+            if data is None:
+                raise Exception("Chunked image ended unexpectedly")
+            buf.extend(data)
+
+    fill(HEADER.size)
+    magic, version, _, _, _ = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Not a chunked image (bad header)")
+    del buf[:HEADER.size]
+    index = 0
+    while True:
+        fill(FRAME.size)
+        size, length, flags, digest = FRAME.unpack_from(buf)
+        del buf[:FRAME.size]
+        if size == END:
+            return
+        fill(size)
+        yield Chunk(index, None, size, length, flags, digest), bytes(buf[:size])
+        del buf[:size]
+        index += 1
+
+
+def codec_of(header):
+    magic, version, _, codec, chunk_size = HEADER.unpack(header[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Not a chunked image (bad header)")
+    codec = codec.rstrip(b"\0").decode()
+    _need_codec(codec)
+    return codec, chunk_size
+
+
+def pieces(chunks, workers=None):
+    # Decoded pieces of a .cimg stream, in order, for imagepipe.  Chunks are
+    # decoded and verified on a thread pool; zero chunks are never decoded.
+    workers = workers or default_workers()
+    chunks = iter(chunks)
+    head = b""
+    while len(head) < HEADER.size:
+        data = next(chunks, None)
+        if data is None:
+            raise Exception("Chunked image ended unexpectedly")
+        head += data
+    codec, chunk_size = codec_of(head)
+    zeros = memoryview(bytes(chunk_size))
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cimg")
+    pending = collections.deque()
+    try:
+        for chunk, data in frames(itertools.chain([head], chunks)):
+            pending.append(zeros[:chunk.length] if chunk.zero else pool.submit(decode_chunk, codec, chunk, data))
+            while len(pending) > workers * 2:
+                item = pending.popleft()
+                yield item if isinstance(item, memoryview) else item.result()
+        while pending:
+            item = pending.popleft()
+            yield item if isinstance(item, memoryview) else item.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ChunkedImage:
+    # Random access to a .cimg, local or over HTTP (Range requests).
+    def __init__(self, location):
+        self.location = location
+        self.url = imagepipe.is_url(location)
+        self.fd = None if self.url else os.open(location, os.O_RDONLY)
+        self.session = requests.Session() if self.url else None
+        self.codec, self.chunk_size = codec_of(self.read(0, HEADER.size))
+        self.file_size = self._file_size()
+        trailer = self.read(self.file_size - TRAILER.size, TRAILER.size)
+        index_offset, count, self.size, self.digest, crc, magic = TRAILER.unpack(trailer)
+        if magic != MAGIC:
+            raise Exception(f"{location} has no chunk index (truncated?)")
+        index = self.read(index_offset, count * ENTRY.size)
+        if zlib.crc32(index) != crc:
+            raise Exception(f"{location}: chunk index CRC mismatch")
+        self.chunks = [Chunk(number, *ENTRY.unpack_from(index, number * ENTRY.size)) for number in range(count)]
+        self.end = index_offset - FRAME.size
+
+    def _file_size(self):
+        if not self.url:
+            return os.fstat(self.fd).st_size
+        response = self.session.head(self.location, allow_redirects=True, timeout=60)
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+
+    def read(self, offset, length):
+        if not self.url:
+            return os.pread(self.fd, length, offset)
+        response = self.session.get(self.location, headers={"Range": f"bytes={offset}-{offset + length - 1}"},
+                                    timeout=60)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise Exception(f"{self.location} does not support Range requests")
+        return response.content
+
+    def body(self, start=0, chunk_size=READ_SIZE):
+        # The file as a stream that begins at chunk start: the header, then
+        # the frames from there on.  Feeds pieces() for a resumed write.
+        yield self.read(0, HEADER.size)
+        offset = self.chunks[start].offset if start < len(self.chunks) else self.end
+        if not self.url:
+            while offset < self.file_size:
+                data = os.pread(self.fd, min(chunk_size, self.file_size - offset), offset)
+                offset += len(data)
+                yield data
+            return
+        with self.session.get(self.location, headers={"Range": f"bytes={offset}-"}, stream=True,
+                              timeout=60) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunk_size=chunk_size)
+
+    def chunk(self, number):
+        # Decoded contents of one chunk.
+        chunk = self.chunks[number]
+        data = b"" if chunk.zero else self.read(chunk.offset + FRAME.size, chunk.size)
+        return decode_chunk(self.codec, chunk, data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.session is not None:
+            self.session.close()
+
+
+def verify(location, workers=None):
+    # Decode and check every chunk, then the whole-image digest.
+    image = ChunkedImage(location)
+    try:
+        hasher = hashlib.sha256()
+        for piece in pieces(image.body(), workers):
+            hasher.update(piece)
+        if hasher.digest() != image.digest:
+            raise Exception(f"{location}: image digest mismatch")
+        return image.size
+    finally:
+        image.close()
+
+
+def compare(location, device, workers=None):
+    # Numbers of the chunks that differ between the image and device, from
+    # the index digests alone: nothing is decoded.
+    image = ChunkedImage(location)
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        def differs(chunk):
+            data = os.pread(fd, chunk.length, chunk.index * image.chunk_size)
+            return hashlib.sha256(data).digest() != chunk.digest
+
+        with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+            return [chunk.index for chunk, changed in zip(image.chunks, pool.map(differs, image.chunks)) if changed]
+    finally:
+        os.close(fd)
+        image.close()
+
+
+def write(location, target, start=0, writer=None, observer=None, workers=None):
+    # Write the image to target from chunk start on, e.g. to resume an
+    # interrupted write.  Returns the imagepipe Pipeline.
+    image = ChunkedImage(location)
+    try:
+        if start and writer is None and not (os.path.exists(target) and stat.S_ISBLK(os.stat(target).st_mode)):
+            # SparseWriter starts a regular file over, which would drop the chunks before start
+            writer = imagepipe.DeviceWriter(target)
+        print(f"Writing {location} to {target} from chunk {start} of {len(image.chunks)}")
+        return imagepipe.stream_image(location, target, chunk_size=image.chunk_size, source=lambda _: image.body(start),
+                                      writer=writer, observer=observer, workers=workers,
+                                      offset=start * image.chunk_size)
+    finally:
+        image.close()
+
+
+def first_difference(location, device, workers=None):
+    # The chunk a resumed write has to start at.
+    changed = compare(location, device, workers)
+    return changed[0] if changed else None
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    command = args[0] if args else None
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    if command == "repack" and len(args) == 3:
+        text = options.get("chunk-size", str(CHUNK_SIZE))
+        units = {"K": 1024, "M": 1024 ** 2}
+        chunk_size = int(text[:-1]) * units[text[-1].upper()] if text[-1].upper() in units else int(text)
+        repack(args[1], args[2], chunk_size, options.get("codec"))
+    elif command == "info" and len(args) == 2:
+        image = ChunkedImage(args[1])
+        zero = sum(chunk.zero for chunk in image.chunks)
+        print(f"{args[1]}: {image.size} bytes in {len(image.chunks)} chunks of {image.chunk_size // 1024} KiB "
+              f"({image.codec}), {zero} zero, sha256 {image.digest.hex()}")
+        image.close()
+    elif command == "verify" and len(args) == 2:
+        print(f"{args[1]}: {verify(args[1])} bytes verified")
+    elif command == "compare" and len(args) == 3:
+        changed = compare(args[1], args[2])
+        print(f"{len(changed)} chunks differ{': ' + ', '.join(map(str, changed)) if changed else ''}")
+    elif command == "write" and len(args) == 3:
+        start = int(options.get("from", 0))
+        if "--resume" in sys.argv:
+            start = first_difference(args[1], args[2])
+            if start is None:
+                print(f"{args[2]} already holds {args[1]}")
+                return
+        write(args[1], args[2], start)
+    else:
+        print(f"usage: {sys.argv[0]} repack IMAGE OUTPUT.cimg [--chunk-size=4M] [--codec=zstd|xz]")
+        print(f"       {sys.argv[0]} info|verify IMAGE.cimg")
+        print(f"       {sys.argv[0]} compare IMAGE.cimg DEVICE")
+        print(f"       {sys.argv[0]} write IMAGE.cimg DEVICE [--from=CHUNK | --resume]")
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#
+# Delta reflashing against the image a disk was last flashed with.
+#
+# DeltaWriter keeps a flat index of per-chunk digests for every disk it has
+# written: one JSON file per disk, named after its WWID/serial so the index
+# follows the disk from slot to slot.  When a board moves to a new image
+# release, each decoded chunk is hashed and compared with that index:
+#   - the digest differs from the recorded one: the chunk changed, write it
+#   - the digest matches: the chunk should already be on the disk.  The board
+#     has been booted and customized since, so the chunk is read back and
+#     only rewritten if the disk no longer holds it (a read is much cheaper
+#     than a write and doesn't wear the flash)
+#   - the chunk is all zeros: BLKZEROOUT on a block device, as SparseWriter
+# Chunks without a recorded digest (first run, different image size) are
+# compared against the disk the same way.  Everything written is read back
+# from the media on close, and only then is the new index saved.
+#
+import os
+import re
+import json
+import stat
+import fcntl
+import struct
+import hashlib
+import imagepipe
+
+DIGEST_SIZE = 16
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def is_zero(view):
+    return all(zero for _, _, zero in imagepipe.zero_runs(view))
+
+
+def _safe_name(value):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value).strip("_")
+
+
+def device_id(path):
+    # A name for the disk behind path that survives moving it to another slot.
+    real = os.path.realpath(path)
+    name = os.path.basename(real)
+    if stat.S_ISBLK(os.stat(real).st_mode):
+        for attribute in ("wwid", "device/wwid", "device/serial"):
+            try:
+                with open(f"/sys/class/block/{name}/{attribute}") as f:
+                    value = _safe_name(f.read())
+            except OSError:
+                continue
+            if value:
+                return value
+    return _safe_name(real)
+
+
+def index_path(index_dir, path):
+    return os.path.join(index_dir, f"{device_id(path)}.json")
+
+
+def load_index(path, size, chunk_size):
+    # The recorded digests, or None if there are none usable for this layout.
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("size") != size or index.get("chunk_size") != chunk_size:
+        return None
+    return index
+
+
+def save_index(path, index):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+
+class DeltaWriter(imagepipe.DeviceWriter):
+    # close() reads back every chunk it wrote, and the rest were compared with the disk already
+    verifies = True
+
+    def __init__(self, path, index_dir, image=None, chunk_size=imagepipe.CHUNK_SIZE):
+        # Reads as well as writes, so not DeviceWriter's O_WRONLY.
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.block_device = stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        self.chunk_size = chunk_size
+        self.image = image
+        self.index_file = index_path(index_dir, path)
+        self.size = imagepipe.device_size(self.fd)
+        previous = load_index(self.index_file, self.size, chunk_size)
+        self.previous = previous["digests"] if previous else []
+        self.digests = []
+        self.written = []
+        self.changed = 0
+        self.unchanged = 0
+        self.repaired = 0
+        self.zeroed = 0
+
+        # Whatever happens from here on, the old index no longer describes the disk.
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
+
+    def write(self, block):
+        if block.offset % self.chunk_size or block.length > self.chunk_size:
+            raise Exception(f"{self.path}: delta writes need {self.chunk_size} byte aligned chunks")
+        view = block.view()
+        number = block.offset // self.chunk_size
+        digest = chunk_digest(view)
+        self.digests.append(digest)
+        if len(self.digests) != number + 1:
+            raise Exception(f"{self.path}: chunk {number} arrived out of order")
+
+        if self.block_device and is_zero(view):
+            fcntl.ioctl(self.fd, imagepipe.BLKZEROOUT, struct.pack("QQ", block.offset, block.length))
+            self.zeroed += 1
+            return
+
+        recorded = self.previous[number] if number < len(self.previous) else None
+        if recorded is not None and recorded != digest:
+            self.changed += 1
+        elif chunk_digest(os.pread(self.fd, block.length, block.offset)) == digest:
+            self.unchanged += 1
+            return
+        elif recorded is not None:
+            # The index said unchanged, but the disk was modified since (customize_os, resize2fs, ...)
+            self.repaired += 1
+        else:
+            self.changed += 1
+        imagepipe.pwrite_all(self.fd, view, block.offset)
+        self.written.append((block.offset, block.length, digest))
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.fsync(self.fd)
+        # Read what was written back from the media, not the page cache.
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        for offset, length, digest in self.written:
+            if chunk_digest(os.pread(self.fd, length, offset)) != digest:
+                raise Exception(f"{self.path}: chunk at {offset:#x} did not read back as written")
+        if not self.block_device:
+            self.size = os.fstat(self.fd).st_size
+        super().close()
+        save_index(self.index_file, {
+            "device": self.path,
+            "image": self.image,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "digests": self.digests,
+        })
+
+    def summary(self):
+        total = len(self.digests)
+        written = sum(length for _, length, _ in self.written)
+        return (f"rewrote {len(self.written)} of {total} chunks ({written / imagepipe.MIB:.0f} MiB, "
+                f"{self.repaired} modified since the last flash), {self.unchanged} unchanged, {self.zeroed} zeroed")
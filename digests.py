@@ -0,0 +1,114 @@
+#
+# Digest helpers shared by the download cache, the image pipeline and flash_spi().
+#
+# Expected digests are written either as a bare hex string, whose length picks
+# the algorithm (32 = MD5, 64 = SHA-256, 128 = BLAKE2b), or as "algorithm:hex",
+# e.g. "blake2b:..." or "sha256:...".  Everything here hashes data while it is
+# already moving through memory so no file has to be read a second time.
+#
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 4 * 1024 * 1024
+READ_WORKERS = 4
+
+_BY_LENGTH = {32: "md5", 64: "sha256", 128: "blake2b"}
+
+
+class DigestMismatch(Exception):
+    pass
+
+
+def parse(expected):
+    # Returns (algorithm, lower case hex digest)
+    expected = expected.strip()
+    if ":" in expected:
+        algorithm, value = expected.split(":", 1)
+        algorithm = algorithm.lower().replace("-", "")
+    else:
+        value = expected
+        algorithm = _BY_LENGTH.get(len(value))
+        if algorithm is None:
+            raise Exception(f"Cannot tell which algorithm produced digest {expected}")
+    hashlib.new(algorithm)
+    return algorithm, value.lower()
+
+
+def normalize(expected):
+    # Accept None, a single digest or a list of digests; empty entries are
+    # treated as "not known" and dropped.
+    if not expected:
+        return []
+    if isinstance(expected, str):
+        expected = [expected]
+    return [parse(value) for value in expected if value]
+
+
+class Hasher:
+    # Computes every algorithm in `expected` (plus any `extra` ones) in one
+    # pass over the data.
+    def __init__(self, expected=None, extra=()):
+        self.expected = normalize(expected)
+        algorithms = [algorithm for algorithm, _ in self.expected] + list(extra)
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    def hexdigest(self, algorithm):
+        return self.hashes[algorithm].hexdigest()
+
+    def verify(self, what):
+        for algorithm, value in self.expected:
+            actual = self.hexdigest(algorithm)
+            if actual != value:
+                raise DigestMismatch(f"{what}: expected {algorithm.upper()} {value}, got {actual}")
+
+
+def tee(chunks, hasher):
+    # Pass chunks through unchanged while feeding them to hasher.
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+def _read_range(fd, offset, length):
+    data = os.pread(fd, length, offset)
+    while len(data) < length:
+        more = os.pread(fd, length - len(data), offset + len(data))
+        if not more:
+            raise Exception(f"Device ended at {offset + len(data)} bytes, expected {offset + length}")
+        data += more
+    return data
+
+
+def read_device(path, length, hasher, workers=READ_WORKERS, chunk_size=CHUNK_SIZE):
+    # Read the first length bytes of a device exactly once, bypassing cached
+    # pages so the data really comes back off the media.  Several chunks are
+    # read concurrently (slow SPI/NVMe readback is latency bound) and fed to
+    # the hasher in order.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for offset in range(0, length, chunk_size):
+                pending.append(pool.submit(_read_range, fd, offset, min(chunk_size, length - offset)))
+                if len(pending) >= workers * 2:
+                    hasher.update(pending.popleft().result())
+            while pending:
+                hasher.update(pending.popleft().result())
+    finally:
+        os.close(fd)
+    return hasher
+
+
+def device_digest(path, length, algorithm="sha256", workers=READ_WORKERS):
+    return read_device(path, length, Hasher(extra=[algorithm]), workers).hexdigest(algorithm)
+
+
+def verify_device(path, length, expected, workers=READ_WORKERS):
+    read_device(path, length, Hasher(expected), workers).verify(path)
@@ -0,0 +1,200 @@
+#
+# O_DIRECT block writer with several writes in flight.
+#
+# DeviceWriter and SparseWriter write through the host's page cache one
+# pwrite at a time: a multi-gigabyte image fills the SD card host's memory
+# with pages nobody reads again, and the drive only ever sees one request.
+# DirectIO opens the target with O_DIRECT and keeps queue_depth writes of up
+# to block_size bytes in flight, one worker thread each (pwrite releases the
+# GIL).  Data is copied into a fixed pool of page-aligned buffers, so the
+# pipeline's ring buffer is released as soon as the copy is done.  Pieces
+# that don't start and end on the alignment boundary go through a normal
+# buffered descriptor instead.  close() waits for every write and fsyncs,
+# which makes the drive flush its own write cache.
+#
+# DirectWriter and DirectSparseWriter are drop-in replacements for
+# imagepipe.DeviceWriter and imagepipe.SparseWriter:
+#
+#   imagepipe.stream_image(url, "/dev/nvme0n1", writer=DirectSparseWriter("/dev/nvme0n1", queue_depth=8))
+#
+# bench.py's *-direct variants measure them against the same stand-ins as the
+# buffered writers.
+#
+import os
+import mmap
+import stat
+import errno
+import fcntl
+import queue
+import struct
+import threading
+import imagepipe
+
+BLOCK_SIZE = 1024 * 1024
+QUEUE_DEPTH = 4
+# Never below a page: a page written through the cache must not share
+# sectors with one written around it.
+ALIGNMENT = mmap.PAGESIZE
+BLKSSZGET = 0x1268
+
+
+def device_alignment(fd):
+    # Offsets and lengths of O_DIRECT writes must be multiples of the logical block size.
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        return max(ALIGNMENT, struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, b"\0" * 4))[0])
+    return ALIGNMENT
+
+
+class DirectIO:
+    # alignment raises the device's own O_DIRECT alignment, e.g. to the flash erase size.
+    def __init__(self, path, block_size=BLOCK_SIZE, queue_depth=QUEUE_DEPTH, alignment=None):
+        if block_size % ALIGNMENT or queue_depth < 1:
+            raise Exception(f"block_size must be a multiple of {ALIGNMENT} and queue_depth at least 1")
+        self.path = path
+        self.block_size = block_size
+        self.queue_depth = queue_depth
+        self.direct = True
+        try:
+            self.fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # tmpfs and a few other filesystems refuse O_DIRECT
+            print(f"{path} does not support O_DIRECT, writing through the page cache")
+            self.fd = os.open(path, os.O_WRONLY)
+            self.direct = False
+        self.alignment = max(device_alignment(self.fd), alignment or 0)
+        self.error = None
+        self.buffers = queue.Queue()
+        for _ in range(queue_depth):
+            self.buffers.put(mmap.mmap(-1, block_size))
+        self.requests = queue.Queue()
+        self.workers = [threading.Thread(target=self._work, name=f"directio-{index}", daemon=True)
+                        for index in range(queue_depth)]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            buf, length, offset = request
+            try:
+                if self.error is None:
+                    imagepipe.pwrite_all(self.fd, memoryview(buf)[:length], offset)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.buffers.put(buf)
+                self.requests.task_done()
+
+    def aligned(self, view, offset):
+        # (head, middle, tail) lengths of view: middle starts and ends on the alignment.
+        start = -offset % self.alignment
+        if start >= len(view):
+            return len(view), 0, 0
+        middle = (len(view) - start) // self.alignment * self.alignment
+        return start, middle, len(view) - start - middle
+
+    def submit(self, view, offset):
+        # Queue the aligned part of view at offset; returns once it is copied.
+        # The caller writes the unaligned head and tail itself (see aligned()).
+        for start in range(0, len(view), self.block_size):
+            if self.error is not None:
+                raise self.error
+            piece = view[start:start + self.block_size]
+            buf = self.buffers.get()
+            buf[:len(piece)] = piece
+            self.requests.put((buf, len(piece), offset + start))
+
+    def wait(self):
+        self.requests.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.abort()
+
+    def abort(self):
+        if self.fd is None:
+            return
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        for _ in range(self.queue_depth):
+            self.buffers.get().close()
+        os.close(self.fd)
+        self.fd = None
+
+
+class DirectMixin:
+    # Sends the writer's data through a DirectIO engine on the same path; its
+    # own descriptor still does everything else (zeroout, truncate, fsync).
+    def init_direct(self, block_size, queue_depth, alignment):
+        try:
+            self.engine = DirectIO(self.path, block_size, queue_depth, alignment)
+        except BaseException:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def write_data(self, view, offset):
+        head, middle, tail = self.engine.aligned(view, offset)
+        if head:
+            imagepipe.pwrite_all(self.fd, view[:head], offset)
+        if middle:
+            self.engine.submit(view[head:head + middle], offset + head)
+        if tail:
+            imagepipe.pwrite_all(self.fd, view[head + middle:], offset + head + middle)
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.flush_pending()
+            self.engine.close()
+        except BaseException:
+            self.abort()
+            raise
+        # The fsync in here flushes the device cache for the direct writes too
+        super().close()
+
+    def flush_pending(self):
+        pass
+
+    def abort(self):
+        self.engine.abort()
+        super().abort()
+
+    def direct_summary(self):
+        return (f"{'O_DIRECT' if self.engine.direct else 'buffered'}, {self.engine.queue_depth} x "
+                f"{self.engine.block_size // 1024} KiB in flight")
+
+
+class DirectWriter(DirectMixin, imagepipe.DeviceWriter):
+    # Writes every byte, like DeviceWriter (the SPI flash must get its zeros).
+    def __init__(self, path, block_size=BLOCK_SIZE, queue_depth=QUEUE_DEPTH, alignment=None):
+        super().__init__(path)
+        self.init_direct(block_size, queue_depth, alignment)
+
+    def summary(self):
+        return self.direct_summary()
+
+
+class DirectSparseWriter(DirectMixin, imagepipe.SparseWriter):
+    # SparseWriter's zero handling, with the data written directly.
+    def __init__(self, path, mode=None, block_size=BLOCK_SIZE, queue_depth=QUEUE_DEPTH, alignment=None):
+        super().__init__(path, mode)
+        self.init_direct(block_size, queue_depth, alignment)
+
+    def flush_pending(self):
+        # A trailing zero run may still turn into a write
+        self._flush_zero()
+
+    def summary(self):
+        return f"{imagepipe.SparseWriter.summary(self)}, {self.direct_summary()}"
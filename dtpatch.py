@@ -0,0 +1,204 @@
+#
+# Declarative device tree patches, built into a DTB or an overlay.
+#
+# Instead of editing rk3588-rock-5b-plus.dts by hand and rebuilding it outside
+# the scripts, the changes live in a small TOML file:
+#
+#   # Enable the M.2 slot's PCIe controller
+#   [[edit]]
+#   node = "pcie2x1l0"                  # path, alias or label
+#   set = { status = "okay", num-lanes = 1 }
+#
+#   [[edit]]
+#   node = "/ethernet@fe1c0000"
+#   delete = ["snps,reset-gpio"]        # properties to drop
+#
+#   [[edit]]
+#   node = "/leds/provisioned"
+#   create = true                       # create the node (and missing parents)
+#   set = { gpios = ["&gpio0", 5, 0], label = "provisioned" }
+#
+#   [[edit]]
+#   node = "/em05-modem"
+#   remove = true                       # drop the node
+#
+# Values: a string, a list of strings (string list), an integer or a list of
+# integers (32-bit cells, where "&label" or "&/path" items are phandles), or
+# true for an empty property.
+#
+# build() applies the edits to the parsed source and emits either the whole
+# patched tree as a DTB, or an overlay (DTBO) holding only the changes; an
+# overlay can't delete anything.  Built files are cached under the device tree
+# cache directory keyed by the hashes of the source, the patch file and the
+# output mode, so an unchanged tree is neither re-parsed nor re-emitted.
+#
+#   python3 dtpatch.py rk3588-rock-5b-plus.dts board.toml out.dtb [--overlay]
+#
+import os
+import sys
+import shutil
+import hashlib
+import dts
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11 (Ubuntu 22.04 ships 3.10)
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Part of the build cache key: bump when the output for the same inputs changes.
+BUILD_VERSION = 1
+EDIT_KEYS = {"node", "set", "delete", "create", "remove"}
+MODES = ("dtb", "overlay")
+
+
+def load_edits(path):
+    if tomllib is None:
+        raise Exception(f"Reading {path} needs Python 3.11 or the tomli package (pip install tomli)")
+    with open(path, "rb") as f:
+        data = tomllib.load(f)
+    edits = data.get("edit", [])
+    for index, edit in enumerate(edits, 1):
+        unknown = set(edit) - EDIT_KEYS
+        if unknown:
+            raise Exception(f"{path}: edit {index} has unknown keys {', '.join(sorted(unknown))}")
+        if "node" not in edit:
+            raise Exception(f"{path}: edit {index} has no node")
+    return edits
+
+
+def chunks(value, where):
+    # A TOML value as dts Property chunks.
+    if value is True:
+        return []
+    if isinstance(value, str):
+        return [("str", value)]
+    if isinstance(value, int) and not isinstance(value, bool):
+        return [("cells", 32, [value])]
+    if isinstance(value, list) and value and all(isinstance(item, str) and not item.startswith("&") for item in value):
+        return [("str", item) for item in value]
+    if isinstance(value, list) and all(isinstance(item, int) or (isinstance(item, str) and item.startswith("&"))
+                                       for item in value):
+        return [("cells", 32, [("ref", item if not item.startswith("&/") else item[1:]) if isinstance(item, str)
+                               else item for item in value])]
+    raise Exception(f"{where}: unsupported value {value!r}")
+
+
+def apply(tree, edits):
+    # Apply edits to tree in place.
+    for index, edit in enumerate(edits, 1):
+        where = f"edit {index} ({edit['node']})"
+        node = tree.node(edit["node"])
+        if node is None:
+            if not edit.get("create") or not edit["node"].startswith("/"):
+                raise Exception(f"{where}: no such node")
+            node = tree.root
+            for part in edit["node"].strip("/").split("/"):
+                node = node.child(part, create=True)
+        if edit.get("remove"):
+            if node.parent is None:
+                raise Exception(f"{where}: can't remove the root node")
+            del node.parent.children[node.name]
+            continue
+        for name in edit.get("delete", []):
+            node.properties.pop(name, None)
+        for name, value in edit.get("set", {}).items():
+            node.properties[name] = dts.Property(name, chunks(value, f"{where}: {name}"))
+    tree.index()
+    return tree
+
+
+def overlay(tree, edits):
+    # An overlay holding the edits, one fragment per existing target node.
+    # References resolve to the base tree's phandles, which is what the board
+    # boots with when its DTB was built from the same source.
+    result = dts.DeviceTree()
+    result.plugin = True
+    fragments = {}
+    for index, edit in enumerate(edits, 1):
+        where = f"edit {index} ({edit['node']})"
+        if edit.get("remove") or edit.get("delete"):
+            raise Exception(f"{where}: an overlay can't delete nodes or properties, build a DTB instead")
+        node = tree.node(edit["node"])
+        missing = []
+        if node is None:
+            if not edit.get("create") or not edit["node"].startswith("/"):
+                raise Exception(f"{where}: no such node")
+            # Create under the nearest node the base tree has
+            parts = edit["node"].strip("/").split("/")
+            while node is None:
+                missing.insert(0, parts.pop())
+                node = tree.by_path("/".join(parts)) if parts else tree.root
+        if node.path not in fragments:
+            fragment = result.root.child(f"fragment@{len(fragments)}", create=True)
+            fragment.properties["target-path"] = dts.Property("target-path", [("str", node.path)])
+            fragments[node.path] = fragment.child("__overlay__", create=True)
+        target = fragments[node.path]
+        for part in missing:
+            target = target.child(part, create=True)
+        for name, value in edit.get("set", {}).items():
+            prop = dts.Property(name, chunks(value, f"{where}: {name}"))
+            for chunk in prop.chunks:
+                if chunk[0] == "cells":
+                    for position, cell in enumerate(chunk[2]):
+                        if isinstance(cell, tuple):
+                            referenced = tree.node(cell[1])
+                            if referenced is None or referenced.phandle is None:
+                                raise Exception(f"{where}: {name} must reference a node of the base tree "
+                                                f"that has a phandle, not {cell[1]}")
+                            chunk[2][position] = referenced.phandle
+            target.properties[name] = prop
+    return result
+
+
+def build_key(source, patch, mode):
+    digest = hashlib.sha256(f"{BUILD_VERSION} {mode}".encode())
+    for path in (source, patch):
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def build(source, patch, mode="dtb", cache_dir=dts.CACHE_DIR):
+    # Path of the built DTB/DTBO for source + patch, built only if the cache
+    # doesn't have it yet.
+    if mode not in MODES:
+        raise Exception(f"Unknown device tree output {mode}, expected one of {', '.join(MODES)}")
+    key = build_key(source, patch, mode)
+    output = os.path.join(cache_dir, f"{key}.{'dtbo' if mode == 'overlay' else 'dtb'}")
+    if os.path.exists(output):
+        print(f"Device tree for {os.path.basename(patch)} unchanged, using {output}")
+        return output
+    tree = dts.load(source, cache_dir)
+    edits = load_edits(patch)
+    blob = dts.to_dtb(overlay(tree, edits) if mode == "overlay" else apply(tree, edits))
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, output)
+    print(f"Built {mode} from {os.path.basename(source)} + {os.path.basename(patch)} ({len(blob)} bytes)")
+    return output
+
+
+def install(source, patch, destination, mode="dtb", cache_dir=dts.CACHE_DIR):
+    # Build (or reuse) the patched device tree and copy it to destination.
+    built = build(source, patch, mode, cache_dir)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copyfile(built, destination)
+    print(f"Installed {destination}")
+    return destination
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 3:
+        print(f"usage: {sys.argv[0]} SOURCE.dts PATCH.toml OUTPUT [--overlay]")
+        exit(1)
+    install(args[0], args[1], args[2], "overlay" if "--overlay" in sys.argv else "dtb")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,699 @@
+#
+# Device tree source parser with an indexed, cached in-memory tree.
+#
+# Parses .dts files, both dtc output (like rk3588-rock-5b-plus.dts, where
+# every reference is a raw phandle number) and hand-written source with
+# labels and &references, into Node/Property objects, and indexes them:
+#   - phandle table: phandle number -> node
+#   - labels (from the source and from __symbols__) and /aliases
+#   - path lookup, where a unit address may be left out if it is unambiguous
+#   - reverse references: which properties point at a given node
+# Decompiled source has no type information, so which cells are phandles is
+# worked out per property: specifier lists like clocks or *-gpios are walked
+# using the #<x>-cells of each provider, phandle lists like pinctrl-0 or
+# remote-endpoint take every cell, and vendor properties (rockchip,grf, ...)
+# count when every cell is a known phandle.
+#
+# Parsing the ~12.7k line board file takes a noticeable fraction of a second,
+# so the result is pickled to a flat, compact form under the cache directory,
+# keyed by the sha256 of the source; later loads of the same file skip it.
+# to_dtb() writes a tree out as a flattened device tree blob, as dtc would.
+#
+#   python3 dts.py rk3588-rock-5b-plus.dts node pcie2x1l0
+#   python3 dts.py rk3588-rock-5b-plus.dts phandle 0x22
+#   python3 dts.py rk3588-rock-5b-plus.dts refs /pinctrl/pcie30x1/pcie30x1m1-pins
+#   python3 dts.py rk3588-rock-5b-plus.dts compatible rockchip,rk3588-pcie
+#
+import os
+import re
+import sys
+import pickle
+import struct
+import hashlib
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), "flash", "dt")
+CACHE_VERSION = 1
+
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_END = 9
+
+TOKEN = re.compile(r"""
+    (?P<skip>\s+|/\*.*?\*/|//[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<bytes>\[[0-9a-fA-F\s]*\])
+  | (?P<directive>/[a-z0-9-]+/)
+  | (?P<ref>&\{[^}]*\}|&[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<label>[A-Za-z_][A-Za-z0-9_]*:)
+  | (?P<punct>[{}<>;=,()/])
+  | (?P<word>[A-Za-z0-9,._+*#?@-]+)
+""", re.S | re.X)
+
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0", "\\": "\\", '"': '"', "'": "'", "a": "\a", "b": "\b",
+           "f": "\f", "v": "\v"}
+
+# Specifier lists: phandle followed by #<x>-cells of the provider it points at.
+SPECIFIERS = {
+    "clocks": "#clock-cells",
+    "assigned-clocks": "#clock-cells",
+    "assigned-clock-parents": "#clock-cells",
+    "resets": "#reset-cells",
+    "phys": "#phy-cells",
+    "power-domains": "#power-domain-cells",
+    "pwms": "#pwm-cells",
+    "dmas": "#dma-cells",
+    "iommus": "#iommu-cells",
+    "mboxes": "#mbox-cells",
+    "interconnects": "#interconnect-cells",
+    "io-channels": "#io-channel-cells",
+    "thermal-sensors": "#thermal-sensor-cells",
+    "sound-dai": "#sound-dai-cells",
+    "nvmem-cells": "#nvmem-cell-cells",
+    "cooling-device": "#cooling-cells",
+    "interrupts-extended": "#interrupt-cells",
+    "gpios": "#gpio-cells",
+}
+
+# Properties whose every cell is a phandle.
+PHANDLE_LISTS = {"interrupt-parent", "memory-region", "remote-endpoint", "phy-handle", "operating-points-v2",
+                 "cpu", "cpus", "next-level-cache", "cpu-idle-states", "connect", "pm_qos", "trip",
+                 "dais", "mbi-parent", "msi-parent"}
+
+
+class Property:
+    def __init__(self, name, chunks=None, labels=None):
+        # chunks: ("str", text), ("cells", bits, [int or ("ref", target)]),
+        # ("bytes", data) or ("path", target), in source order.
+        self.name = name
+        self.chunks = chunks or []
+        self.labels = labels or []
+
+    def data(self):
+        # The property value as it appears in a DTB.  References must have
+        # been resolved (DeviceTree does that once everything is parsed).
+        out = b""
+        for chunk in self.chunks:
+            kind = chunk[0]
+            if kind == "str":
+                out += chunk[1].encode("utf-8", "surrogateescape") + b"\0"
+            elif kind == "cells":
+                size = {8: "B", 16: "H", 32: "I", 64: "Q"}[chunk[1]]
+                for value in chunk[2]:
+                    if isinstance(value, tuple):
+                        raise Exception(f"Property {self.name}: unresolved reference {value[1]}")
+                    out += struct.pack(f">{size}", value & ((1 << chunk[1]) - 1))
+            elif kind == "bytes":
+                out += chunk[1]
+            else:
+                raise Exception(f"Property {self.name}: unresolved reference {chunk[1]}")
+        return out
+
+    def cells(self):
+        # All 32-bit cells of the property, as one list.
+        values = []
+        for chunk in self.chunks:
+            if chunk[0] != "cells" or chunk[1] != 32:
+                return None
+            values.extend(chunk[2])
+        return values
+
+    def strings(self):
+        data = self.data()
+        if not data.endswith(b"\0"):
+            return None
+        return [item.decode("utf-8", "replace") for item in data[:-1].split(b"\0")]
+
+    def string(self):
+        strings = self.strings()
+        return strings[0] if strings else None
+
+    def __repr__(self):
+        return f"<Property {self.name}>"
+
+
+class Node:
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.properties = {}
+        self.children = {}
+        self.labels = []
+
+    @property
+    def path(self):
+        if self.parent is None:
+            return "/"
+        parent = self.parent.path
+        return f"{parent}{self.name}" if parent == "/" else f"{parent}/{self.name}"
+
+    @property
+    def base_name(self):
+        return self.name.split("@", 1)[0]
+
+    def get(self, name):
+        return self.properties.get(name)
+
+    def cells(self, name):
+        prop = self.properties.get(name)
+        return prop.cells() if prop else None
+
+    def cell(self, name, default=None):
+        values = self.cells(name)
+        return values[0] if values else default
+
+    def strings(self, name):
+        prop = self.properties.get(name)
+        return prop.strings() if prop else []
+
+    def string(self, name):
+        prop = self.properties.get(name)
+        return prop.string() if prop else None
+
+    @property
+    def phandle(self):
+        return self.cell("phandle", self.cell("linux,phandle"))
+
+    @property
+    def status(self):
+        return self.string("status") or "okay"
+
+    @property
+    def enabled(self):
+        return self.status in ("okay", "ok")
+
+    @property
+    def compatible(self):
+        return self.strings("compatible")
+
+    def child(self, name, create=False):
+        node = self.children.get(name)
+        if node is None and create:
+            node = self.children[name] = Node(name, self)
+        return node
+
+    def walk(self):
+        yield self
+        for child in self.children.values():
+            yield from child.walk()
+
+    def __repr__(self):
+        return f"<Node {self.path}>"
+
+
+class Parser:
+    def __init__(self, text, source="<dts>"):
+        self.source = source
+        self.tokens = []
+        pos = 0
+        for match in TOKEN.finditer(text):
+            if match.start() != pos:
+                break
+            pos = match.end()
+            if match.lastgroup != "skip":
+                self.tokens.append((match.lastgroup, match.group(), match.start()))
+        if pos != len(text):
+            raise self._error_at(text, pos, "unexpected character")
+        self.text = text
+        self.pos = 0
+
+    def _error_at(self, text, offset, message):
+        line = text.count("\n", 0, offset) + 1
+        return Exception(f"{self.source}:{line}: {message}")
+
+    def error(self, message):
+        offset = self.tokens[self.pos][2] if self.pos < len(self.tokens) else len(self.text)
+        return self._error_at(self.text, offset, message)
+
+    def peek(self, ahead=0):
+        if self.pos + ahead < len(self.tokens):
+            return self.tokens[self.pos + ahead]
+        return (None, None, len(self.text))
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise self.error("unexpected end of file")
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, text, _ = self.next()
+        if text != value:
+            self.pos -= 1
+            raise self.error(f"expected '{value}', found '{text}'")
+
+    def labels(self):
+        labels = []
+        while self.peek()[0] == "label":
+            labels.append(self.next()[1][:-1])
+        return labels
+
+    def parse(self, tree):
+        while self.peek()[0] is not None:
+            kind, text, _ = self.peek()
+            if text in ("/dts-v1/", "/plugin/"):
+                self.next()
+                self.expect(";")
+                if text == "/plugin/":
+                    tree.plugin = True
+                continue
+            if text == "/memreserve/":
+                self.next()
+                tree.memreserve.append((self.number(self.next()[1]), self.number(self.next()[1])))
+                self.expect(";")
+                continue
+            if text == "/delete-node/":
+                self.next()
+                tree.index_labels()
+                node = tree.node(self.reference(self.next()))
+                if node is None or node.parent is None:
+                    raise self.error("can't delete that node")
+                del node.parent.children[node.name]
+                self.expect(";")
+                continue
+            labels = self.labels()
+            kind, text, _ = self.next()
+            if text == "/":
+                node = tree.root
+            elif kind == "ref":
+                tree.index_labels()
+                node = tree.node(self.reference((kind, text, 0)))
+                if node is None:
+                    if not tree.plugin:
+                        raise self.error(f"reference to unknown node {text}")
+                    # An overlay fragment target: kept as a top-level node named after the reference
+                    node = tree.root.child(text, create=True)
+            else:
+                self.pos -= 1
+                raise self.error(f"unexpected '{text}'")
+            node.labels.extend(label for label in labels if label not in node.labels)
+            self.expect("{")
+            self.body(node)
+            self.expect(";")
+
+    def reference(self, token):
+        text = token[1]
+        return text[2:-1] if text.startswith("&{") else "&" + text[1:]
+
+    def number(self, text):
+        try:
+            return int(text, 16) if text.lower().startswith("0x") else int(text, 10)
+        except ValueError:
+            self.pos -= 1
+            raise self.error(f"expected a number, found '{text}'")
+
+    def body(self, node):
+        while True:
+            kind, text, _ = self.peek()
+            if text == "}":
+                self.next()
+                return
+            if text in ("/delete-node/", "/delete-property/"):
+                self.next()
+                name = self.next()[1]
+                self.expect(";")
+                (node.children if text == "/delete-node/" else node.properties).pop(name, None)
+                continue
+            labels = self.labels()
+            kind, name, _ = self.next()
+            if kind != "word" and name != "/":
+                self.pos -= 1
+                raise self.error(f"expected a node or property name, found '{name}'")
+            kind, text, _ = self.next()
+            if text == "{":
+                child = node.child(name, create=True)
+                child.labels.extend(label for label in labels if label not in child.labels)
+                self.body(child)
+                self.expect(";")
+            elif text == ";":
+                node.properties[name] = Property(name, [], labels)
+            elif text == "=":
+                node.properties[name] = Property(name, self.value(), labels)
+                self.expect(";")
+            else:
+                self.pos -= 1
+                raise self.error(f"unexpected '{text}' after {name}")
+
+    def value(self):
+        chunks = []
+        while True:
+            self.labels()
+            kind, text, _ = self.next()
+            if kind == "string":
+                chunks.append(("str", unescape(text[1:-1])))
+            elif kind == "bytes":
+                chunks.append(("bytes", bytes.fromhex(text[1:-1])))
+            elif kind == "ref":
+                chunks.append(("path", self.reference((kind, text, 0))))
+            elif text == "/bits/":
+                bits = self.number(self.next()[1])
+                if bits not in (8, 16, 32, 64):
+                    raise self.error(f"/bits/ {bits} is not supported")
+                self.expect("<")
+                chunks.append(("cells", bits, self.cells()))
+            elif text == "<":
+                chunks.append(("cells", 32, self.cells()))
+            else:
+                self.pos -= 1
+                raise self.error(f"unexpected '{text}' in a property value")
+            self.labels()
+            if self.peek()[1] != ",":
+                return chunks
+            self.next()
+
+    def cells(self):
+        values = []
+        while True:
+            self.labels()
+            kind, text, _ = self.next()
+            if text == ">":
+                return values
+            if kind == "ref":
+                values.append(("ref", self.reference((kind, text, 0))))
+            elif kind == "word":
+                values.append(self.number(text))
+            else:
+                self.pos -= 1
+                raise self.error(f"unexpected '{text}' in a cell list (expressions are not supported)")
+
+
+def unescape(text):
+    out = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char != "\\":
+            out.append(char)
+            index += 1
+            continue
+        escape = text[index + 1]
+        if escape == "x":
+            digits = re.match(r"[0-9a-fA-F]{1,2}", text[index + 2:]).group()
+            out.append(chr(int(digits, 16)))
+            index += 2 + len(digits)
+        elif escape in "01234567" and re.match(r"[0-7]{2,3}", text[index + 1:]):
+            digits = re.match(r"[0-7]{1,3}", text[index + 1:]).group()
+            out.append(chr(int(digits, 8)))
+            index += 1 + len(digits)
+        else:
+            out.append(ESCAPES.get(escape, escape))
+            index += 2
+    return "".join(out)
+
+
+class DeviceTree:
+    def __init__(self):
+        self.root = Node("")
+        self.memreserve = []
+        self.plugin = False
+        self.labels = {}
+        self.phandles = {}
+        self.references = {}
+
+    # Lookup
+
+    @property
+    def aliases(self):
+        node = self.root.child("aliases")
+        if node is None:
+            return {}
+        return {name: prop.string() for name, prop in node.properties.items() if name != "phandle"}
+
+    def by_path(self, path):
+        node = self.root
+        for part in path.strip("/").split("/"):
+            if not part:
+                continue
+            child = node.children.get(part)
+            if child is None and "@" not in part:
+                # Unit address left out: fine as long as only one child has that name
+                matches = [candidate for candidate in node.children.values() if candidate.base_name == part]
+                child = matches[0] if len(matches) == 1 else None
+            if child is None:
+                return None
+            node = child
+        return node
+
+    def node(self, spec):
+        # A path, "&label", a bare label or an alias.  None if nothing matches.
+        if isinstance(spec, Node):
+            return spec
+        if spec.startswith("&"):
+            return self.labels.get(spec[1:])
+        if spec.startswith("/"):
+            return self.by_path(spec)
+        if spec in self.labels:
+            return self.labels[spec]
+        alias = self.aliases.get(spec)
+        if alias is not None:
+            return self.node(alias)
+        return None
+
+    def by_phandle(self, phandle):
+        return self.phandles.get(phandle)
+
+    def referrers(self, spec):
+        # [(node, property name)] pointing at the node.
+        node = self.node(spec)
+        if node is None or node.phandle is None:
+            return []
+        return self.references.get(node.phandle, [])
+
+    def find_compatible(self, compatible):
+        return [node for node in self.root.walk() if compatible in node.compatible]
+
+    # Indexing
+
+    def index(self):
+        # Rebuild the label, phandle and reverse reference tables, resolving
+        # &references and giving referenced nodes a phandle where needed.
+        self.index_labels()
+        self.phandles = {}
+        for node in self.root.walk():
+            phandle = node.phandle
+            if phandle is not None:
+                self.phandles[phandle] = node
+        self._resolve()
+        self.references = {}
+        for node in self.root.walk():
+            for prop in node.properties.values():
+                for phandle in self.phandle_cells(node, prop):
+                    self.references.setdefault(phandle, []).append((node, prop.name))
+
+    def index_labels(self):
+        self.labels = {}
+        for node in self.root.walk():
+            for label in node.labels:
+                self.labels[label] = node
+        symbols = self.root.child("__symbols__")
+        if symbols is not None:
+            for label, prop in symbols.properties.items():
+                node = self.by_path(prop.string() or "")
+                if node is not None:
+                    self.labels.setdefault(label, node)
+
+    def allocate_phandle(self, node):
+        if node.phandle is None:
+            phandle = max(self.phandles, default=0) + 1
+            node.properties["phandle"] = Property("phandle", [("cells", 32, [phandle])])
+            self.phandles[phandle] = node
+        return node.phandle
+
+    def _resolve(self):
+        for node in list(self.root.walk()):
+            for prop in node.properties.values():
+                for index, chunk in enumerate(prop.chunks):
+                    if chunk[0] == "path":
+                        target = self.node(chunk[1])
+                        if target is not None:
+                            prop.chunks[index] = ("str", target.path)
+                    elif chunk[0] == "cells":
+                        for position, value in enumerate(chunk[2]):
+                            if isinstance(value, tuple):
+                                target = self.node(value[1])
+                                if target is not None:
+                                    chunk[2][position] = self.allocate_phandle(target)
+                                elif not self.plugin:
+                                    raise Exception(f"{node.path}: {prop.name} references unknown {value[1]}")
+
+    def _specifier_cells(self, name):
+        if name in SPECIFIERS:
+            return SPECIFIERS[name]
+        if name.endswith("-gpios") or name.endswith("-gpio"):
+            return "#gpio-cells"
+        return None
+
+    def phandle_cells(self, node, prop):
+        # The phandles a property refers to, as far as can be told.
+        name = prop.name
+        if name in ("phandle", "linux,phandle"):
+            return []
+        cells = prop.cells()
+        if not cells or any(isinstance(value, tuple) for value in cells):
+            return []
+        cells_property = self._specifier_cells(name)
+        if cells_property is not None:
+            found = []
+            index = 0
+            while index < len(cells):
+                target = self.phandles.get(cells[index])
+                if target is None:
+                    if cells[index] != 0:
+                        break
+                    # An empty slot in a list of specifiers (<0>)
+                    index += 1
+                    continue
+                found.append(cells[index])
+                index += 1 + target.cell(cells_property, 0)
+            return found
+        if name == "rockchip,pins":
+            # <bank pin function &pinconf> groups
+            return [value for value in cells[3::4] if value in self.phandles]
+        if name in PHANDLE_LISTS or re.fullmatch(r"pinctrl-\d+|.*-supply|.*-handle|.*-phandle", name):
+            return [value for value in cells if value in self.phandles]
+        if "," in name and all(value in self.phandles for value in cells):
+            return cells
+        return []
+
+    # Cached binary form
+
+    def flatten(self):
+        nodes = list(self.root.walk())
+        numbers = {id(node): index for index, node in enumerate(nodes)}
+        return {
+            "version": CACHE_VERSION,
+            "plugin": self.plugin,
+            "memreserve": self.memreserve,
+            "nodes": [(numbers[id(node.parent)] if node.parent is not None else -1, node.name, node.labels,
+                       [(prop.name, prop.chunks, prop.labels) for prop in node.properties.values()])
+                      for node in nodes],
+            "labels": {label: numbers[id(node)] for label, node in self.labels.items()},
+            "phandles": {phandle: numbers[id(node)] for phandle, node in self.phandles.items()},
+            "references": {phandle: [(numbers[id(node)], name) for node, name in refs]
+                           for phandle, refs in self.references.items()},
+        }
+
+    @classmethod
+    def unflatten(cls, data):
+        if data.get("version") != CACHE_VERSION:
+            raise Exception("Device tree cache format changed")
+        tree = cls()
+        tree.plugin = data["plugin"]
+        tree.memreserve = data["memreserve"]
+        nodes = []
+        for parent, name, labels, properties in data["nodes"]:
+            node = tree.root if parent < 0 else Node(name, nodes[parent])
+            if parent >= 0:
+                nodes[parent].children[name] = node
+            node.labels = labels
+            node.properties = {name: Property(name, chunks, prop_labels) for name, chunks, prop_labels in properties}
+            nodes.append(node)
+        tree.labels = {label: nodes[index] for label, index in data["labels"].items()}
+        tree.phandles = {phandle: nodes[index] for phandle, index in data["phandles"].items()}
+        tree.references = {phandle: [(nodes[index], name) for index, name in refs]
+                           for phandle, refs in data["references"].items()}
+        return tree
+
+
+def to_dtb(tree):
+    # Flattened device tree blob, version 17, laid out the way dtc writes it:
+    # header, memory reservations, structure block, strings block.
+    structure = bytearray()
+    strings = bytearray()
+    offsets = {}
+
+    def emit(node):
+        name = node.name.encode()
+        structure.extend(struct.pack(">I", FDT_BEGIN_NODE) + name + bytes(4 - len(name) % 4))
+        for prop in node.properties.values():
+            if prop.name not in offsets:
+                offsets[prop.name] = len(strings)
+                strings.extend(prop.name.encode() + b"\0")
+            data = prop.data()
+            structure.extend(struct.pack(">III", FDT_PROP, len(data), offsets[prop.name]) + data + bytes(-len(data) % 4))
+        for child in node.children.values():
+            emit(child)
+        structure.extend(struct.pack(">I", FDT_END_NODE))
+
+    emit(tree.root)
+    structure.extend(struct.pack(">I", FDT_END))
+    reservations = b"".join(struct.pack(">QQ", address, size) for address, size in tree.memreserve) + bytes(16)
+    header_size = 40
+    struct_offset = header_size + len(reservations)
+    strings_offset = struct_offset + len(structure)
+    header = struct.pack(">10I", FDT_MAGIC, strings_offset + len(strings), struct_offset, strings_offset, header_size,
+                         17, 16, 0, len(strings), len(structure))
+    return header + reservations + bytes(structure) + bytes(strings)
+
+
+def parse(text, source="<dts>"):
+    tree = DeviceTree()
+    Parser(text, source).parse(tree)
+    tree.index()
+    return tree
+
+
+def load(path, cache_dir=CACHE_DIR):
+    # Parse path, or load the cached index of the same source.
+    with open(path, "rb") as f:
+        source = f.read()
+    key = hashlib.sha256(source).hexdigest()
+    cache_file = os.path.join(cache_dir, f"{key}.dtidx") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                return DeviceTree.unflatten(pickle.load(f))
+        except Exception as e:
+            print(f"Ignoring unreadable device tree cache {cache_file}: {e}")
+    tree = parse(source.decode("utf-8", "surrogateescape"), path)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(tree.flatten(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    return tree
+
+
+def describe(tree, node):
+    labels = [label for label, labelled in tree.labels.items() if labelled is node]
+    print(f"{node.path}" + (f" ({', '.join(labels)})" if labels else ""))
+    print(f"  status: {node.status}" + (f", phandle {node.phandle:#x}" if node.phandle is not None else ""))
+    for prop in node.properties.values():
+        strings = prop.strings()
+        cells = prop.cells()
+        if cells is not None and prop.chunks:
+            value = "<" + " ".join(f"{cell:#x}" for cell in cells) + ">"
+        elif strings and all(item.isprintable() for item in strings):
+            value = ", ".join(f'"{item}"' for item in strings)
+        else:
+            value = f"[{prop.data().hex(' ')}]" if prop.chunks else "(empty)"
+        print(f"  {prop.name} = {value}")
+    for node_, name in tree.referrers(node):
+        print(f"  referenced by {node_.path}:{name}")
+
+
+def main():
+    if len(sys.argv) < 4:
+        print(f"usage: {sys.argv[0]} DTS node|phandle|refs|compatible ARG")
+        exit(1)
+    path, command, arg = sys.argv[1:4]
+    tree = load(path)
+    if command == "compatible":
+        for node in tree.find_compatible(arg):
+            print(f"{node.path}: {node.status}")
+        return
+    node = tree.by_phandle(int(arg, 0)) if command == "phandle" else tree.node(arg)
+    if node is None:
+        print(f"No node matches {arg}")
+        exit(1)
+    if command == "refs":
+        for referrer, name in tree.referrers(node):
+            print(f"{referrer.path}: {name}")
+    else:
+        describe(tree, node)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#
+# LAN fan-out of OS images to many boards flashing at once.
+#
+# Reflashing a rack means every board pulling the same multi-gigabyte image
+# from GitHub.  Instead, one host runs
+#
+#   python3 fanout.py serve [PORT] [CACHE_DIR]
+#
+# and the boards run buildM2Ubuntu.py --fanout=http://HOST:PORT.  The first
+# request for an image starts its one upstream download into the server's
+# artifact cache.  Every client, including ones that connect halfway through,
+# reads the cache file as it grows, so the uplink carries each image once no
+# matter how many boards are flashing.  Later requests are served from the
+# cache.  Clients stream straight into imagepipe, verify the image digest
+# at the end and resume with a Range request if the connection drops.
+#
+# UDP multicast would save the LAN bandwidth too, but it needs NAK-based
+# repair and multicast-capable switches.  The uplink is the bottleneck, and
+# HTTP from a shared cache file already takes it to one download.
+#
+#   python3 fanout.py loopback [CLIENTS] [SIZE_MIB]
+#
+# runs the whole setup on 127.0.0.1: a throttled stand-in upstream, a
+# server and CLIENTS client processes.  It reports how many bytes went
+# upstream and checks every client's copy.
+#
+import os
+import sys
+import time
+import hashlib
+import threading
+import subprocess
+import http.server
+import requests
+import digests
+from urllib.parse import urlparse, parse_qs
+from artifacts import ArtifactCache, PART_SUFFIX
+
+DEFAULT_PORT = 3143
+CHUNK_SIZE = 1024 * 1024
+CACHE_MAX_BYTES = 64 * 1024 * 1024 * 1024
+POLL_INTERVAL = 0.5
+# Reconnects a client makes after losing the stream, resuming where it stopped
+RETRIES = 5
+
+
+class Broadcast:
+    # One image download shared by every client.  The download runs in its
+    # own thread through the artifact cache; clients follow the cache's
+    # partial file up to the bytes downloaded so far.
+    def __init__(self, cache, url, digest=None):
+        self.cache = cache
+        self.url = url
+        self.digest = digest
+        self.size = 0
+        self.total = None
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._download, name="fanout-download", daemon=True)
+
+    def start(self):
+        cached = self.cache.lookup(self.url, self.digest)
+        if cached is not None:
+            self.total = os.path.getsize(cached)
+        else:
+            try:
+                response = requests.head(self.url, allow_redirects=True, timeout=60)
+                if response.ok and "Content-Length" in response.headers:
+                    self.total = int(response.headers["Content-Length"])
+            except requests.RequestException:
+                pass
+        self.thread.start()
+        return self
+
+    def _download(self):
+        try:
+            for chunk in self.cache.stream(self.url, self.digest, CHUNK_SIZE):
+                with self.condition:
+                    self.size += len(chunk)
+                    self.condition.notify_all()
+        except Exception as e:
+            print(f"Downloading {self.url} failed: {e}")
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                if self.error is None:
+                    self.total = self.size
+                self.condition.notify_all()
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def _open(self):
+        # The partial file while downloading; it is renamed into place when done.
+        path = self.cache.path(self.url, self.digest)
+        for candidate in (path + PART_SUFFIX, path):
+            try:
+                return os.open(candidate, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+        raise Exception(f"{self.url} is not in the cache")
+
+    def read(self, offset=0):
+        # Yield the image from offset on, waiting for the download as needed.
+        fd = None
+        try:
+            while True:
+                with self.condition:
+                    while self.size <= offset and not self.done:
+                        self.condition.wait(POLL_INTERVAL)
+                    available = self.size
+                if self.error is not None:
+                    raise self.error
+                if offset >= available:
+                    return
+                if fd is None:
+                    fd = self._open()
+                while offset < available:
+                    data = os.pread(fd, min(CHUNK_SIZE, available - offset), offset)
+                    if not data:
+                        raise Exception(f"{self.url}: the cache file ended at {offset} bytes")
+                    offset += len(data)
+                    yield data
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
+class FanoutHandler(http.server.BaseHTTPRequestHandler):
+    # GET /image?url=URL[&digest=DIGEST], with an optional "Range: bytes=N-".
+    def do_GET(self):
+        request = urlparse(self.path)
+        query = parse_qs(request.query)
+        url = query.get("url", [""])[0]
+        if request.path != "/image" or urlparse(url).scheme not in ("http", "https"):
+            self.send_error(404, "Expected /image?url=http(s)://...")
+            return
+        offset = 0
+        if self.headers.get("Range", "").startswith("bytes="):
+            offset = int(self.headers["Range"][len("bytes="):].split("-")[0] or 0)
+
+        broadcast = self.server.broadcast(url, query.get("digest", [""])[0] or None)
+        try:
+            chunks = broadcast.read(offset)
+            # Pull the first chunk before answering so a failed download is a proper status code
+            first = next(chunks, b"")
+        except Exception as e:
+            self.send_error(502, str(e))
+            return
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        if broadcast.total is not None:
+            self.send_header("Content-Length", str(broadcast.total - offset))
+            if offset:
+                self.send_header("Content-Range", f"bytes {offset}-{broadcast.total - 1}/{broadcast.total}")
+        self.end_headers()
+        try:
+            self.wfile.write(first)
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        except Exception as e:
+            # The client went away, or the download failed: drop the connection
+            self.log_error("%s: %s", url, e)
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FanoutServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, port=DEFAULT_PORT, host="0.0.0.0", max_bytes=CACHE_MAX_BYTES):
+        super().__init__((host, port), FanoutHandler)
+        self.cache = ArtifactCache(root, max_bytes)
+        self.broadcasts = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def broadcast(self, url, digest=None):
+        # The running (or finished) Broadcast of url; a failed one is retried.
+        with self.lock:
+            broadcast = self.broadcasts.get((url, digest))
+            if broadcast is None or broadcast.failed:
+                print(f"Fanning out {url}")
+                broadcast = self.broadcasts[(url, digest)] = Broadcast(self.cache, url, digest).start()
+            return broadcast
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{'127.0.0.1' if host == '0.0.0.0' else host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="fanout-server", daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def stream(server, url, digest=None, chunk_size=CHUNK_SIZE, retries=RETRIES):
+    # Yield url as served by the fan-out server at server (http://host:port),
+    # resuming after dropped connections and verifying digest at the end.
+    # Usable as an imagepipe source: source=lambda _: fanout.stream(...)
+    hasher = digests.Hasher(digest)
+    received = 0
+    failures = 0
+    params = {"url": url}
+    if digest:
+        params["digest"] = digest if isinstance(digest, str) else digest[0]
+    while True:
+        headers = {"Range": f"bytes={received}-"} if received else {}
+        try:
+            with requests.get(f"{server}/image", params=params, headers=headers, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                if received and response.status_code != 206:
+                    raise Exception(f"{server} can't resume {url}")
+                expected = response.headers.get("Content-Length")
+                expected = received + int(expected) if expected is not None else None
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    received += len(chunk)
+                    hasher.update(chunk)
+                    yield chunk
+            if expected is None or received >= expected:
+                break
+            raise requests.ConnectionError(f"stream ended at {received} of {expected} bytes")
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            failures += 1
+            if failures > retries:
+                raise
+            print(f"Lost the fan-out stream of {url} at {received} bytes ({e}), resuming")
+            time.sleep(1)
+    hasher.verify(f"{url} (from {server})")
+
+
+class ThrottledHandler(http.server.SimpleHTTPRequestHandler):
+    # The loopback test's stand-in for GitHub: slow, and counting what it sends.
+    rate = 32 * 1024 * 1024
+    sent = 0
+    requests = 0
+
+    def copyfile(self, source, outputfile):
+        type(self).requests += 1
+        for chunk in iter(lambda: source.read(256 * 1024), b""):
+            outputfile.write(chunk)
+            type(self).sent += len(chunk)
+            time.sleep(len(chunk) / self.rate)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def loopback(clients=4, size_mib=128):
+    # Server, throttled upstream and clients on 127.0.0.1.
+    import tempfile
+    import functools
+    root = tempfile.mkdtemp(prefix="fanout-")
+    hasher = hashlib.sha256()
+    with open(os.path.join(root, "disk.img"), "wb") as f:
+        for _ in range(size_mib):
+            chunk = os.urandom(1024 * 1024)
+            hasher.update(chunk)
+            f.write(chunk)
+    digest = hasher.hexdigest()
+
+    upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(ThrottledHandler, directory=root))
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    server = FanoutServer(os.path.join(root, "cache"), port=0, host="127.0.0.1")
+    server_url = server.start()
+    url = f"http://127.0.0.1:{upstream.server_address[1]}/disk.img"
+
+    started = time.monotonic()
+    processes = []
+    for index in range(clients):
+        # Staggered, so some clients join while the download is under way
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), "fetch", server_url, url,
+                                           os.path.join(root, f"client-{index}.img"), digest]))
+        time.sleep(0.5)
+    failed = sum(process.wait() != 0 for process in processes)
+    seconds = time.monotonic() - started
+    server.stop()
+    upstream.shutdown()
+
+    print(f"{clients} clients, {size_mib} MiB image: upstream sent {ThrottledHandler.sent / 1024 ** 2:.0f} MiB "
+          f"in {ThrottledHandler.requests} request(s), LAN {clients * size_mib} MiB, {seconds:.1f}s, "
+          f"{failed} client(s) failed")
+    subprocess.run(["rm", "-rf", root], check=True)
+    return failed == 0 and ThrottledHandler.requests == 1
+
+
+def fetch(server, url, output, digest=None):
+    with open(output, "wb") as f:
+        for chunk in stream(server, url, digest):
+            f.write(chunk)
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "serve":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+        root = sys.argv[3] if len(sys.argv) > 3 else os.path.join(os.path.expanduser("~"), "flash", "cache")
+        server = FanoutServer(root, port)
+        print(f"Image fan-out server listening on port {port}, cache in {root}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
+    elif command == "fetch" and len(sys.argv) in (5, 6):
+        fetch(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5] if len(sys.argv) > 5 else None)
+    elif command == "loopback":
+        ok = loopback(int(sys.argv[2]) if len(sys.argv) > 2 else 4, int(sys.argv[3]) if len(sys.argv) > 3 else 128)
+        exit(0 if ok else 1)
+    else:
+        print(f"usage: {sys.argv[0]} serve [PORT] [CACHE_DIR]")
+        print(f"       {sys.argv[0]} fetch SERVER URL OUTPUT [DIGEST]")
+        print(f"       {sys.argv[0]} loopback [CLIENTS] [SIZE_MIB]")
+        exit(1)
+
+if __name__ == '__main__':
+    main()
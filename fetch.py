@@ -0,0 +1,283 @@
+#
+# Concurrent up-front download of every artifact a provisioning run needs.
+#
+# All artifacts (OS image, SPI images, kernel debs given as URLs) are fetched
+# at the same time into the artifact cache, so the network time of a run is
+# that of the largest one rather than the sum; the later stages then find
+# everything in the cache.  For each artifact:
+#   - every mirror is probed with a one-byte range request, which measures
+#     its latency and tells whether it supports ranges
+#   - mirrors that answer are tried in order of preference, except that a
+#     clearly faster mirror goes first; the others are the failover order
+#   - large files are split into segments fetched over several connections.
+#     A segment that fails is retried a few times before its mirror is given
+#     up for the next one.  Finished segments are synced to disk and recorded
+#     next to the partial file, so a rerun only fetches the rest.  Segments
+#     are hashed in offset order as they complete, while they are still in
+#     the page cache, so the download needs no second pass to verify
+#   - anything small, or from a server without range support, goes through
+#     ArtifactCache.fetch() (one resumable connection)
+# asyncio drives the whole thing; the HTTP requests themselves are plain
+# requests calls run in worker threads.
+#
+# Handy against a local stand-in server:
+#   python3 fetch.py http://127.0.0.1:8000/image.img.xz [MORE_URLS...]
+#
+import os
+import sys
+import json
+import time
+import fcntl
+import asyncio
+import digests
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from artifacts import ArtifactCache, PART_SUFFIX, CHUNK_SIZE
+
+CONNECTIONS = 4
+SEGMENT_SIZE = 16 * 1024 * 1024
+MULTI_CONNECTION_MIN = 64 * 1024 * 1024
+PROBE_TIMEOUT = 10
+# A mirror is only preferred over a higher priority one if it answers this much faster.
+LATENCY_SLACK = 1.5
+SEGMENTS_SUFFIX = ".segments"
+# Attempts at a segment on one mirror before failing over to the next
+SEGMENT_RETRIES = 3
+RETRY_DELAY = 1
+
+
+class Artifact:
+    def __init__(self, url, digest=None, mirrors=()):
+        # url is also the cache key; mirrors are alternative URLs for the
+        # same file, in order of preference.
+        self.url = url
+        self.digest = digest
+        self.mirrors = [url] + [mirror for mirror in mirrors if mirror != url]
+
+
+class Probe:
+    def __init__(self, url, latency, size, ranges):
+        self.url = url
+        self.latency = latency
+        self.size = size
+        self.ranges = ranges
+
+
+def probe(url):
+    # Time to the first byte of a one-byte range request.  None if the mirror
+    # doesn't answer.
+    started = time.monotonic()
+    try:
+        with requests.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=PROBE_TIMEOUT) as response:
+            response.raise_for_status()
+            latency = time.monotonic() - started
+            if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+                size = response.headers["Content-Range"].rsplit("/", 1)[1]
+                return Probe(url, latency, int(size) if size.isdigit() else 0, size.isdigit())
+            return Probe(url, latency, int(response.headers.get("Content-Length", 0)), False)
+    except requests.RequestException as e:
+        print(f"Mirror {url} is unavailable: {e}")
+        return None
+
+
+def rank(probes):
+    # Preference order, but the fastest mirror goes first when the preferred
+    # ones are much slower.  The rest stay in preference order for failover.
+    probes = [probe for probe in probes if probe is not None]
+    if not probes:
+        return []
+    fastest = min(probes, key=lambda probe: probe.latency)
+    first = next(probe for probe in probes if probe.latency <= fastest.latency * LATENCY_SLACK + 0.01)
+    return [first] + [probe for probe in probes if probe is not first]
+
+
+def fetch_segment(url, fd, start, end):
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        if response.status_code != 206 or not response.headers.get("Content-Range", "").startswith(f"bytes {start}-"):
+            raise Exception(f"{url} ignored the range request for bytes {start}-{end - 1}")
+        offset = start
+        # Some servers send everything up to the end of the file; stop at end.
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            chunk = chunk[:end - offset]
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            if offset >= end:
+                break
+    if offset < end:
+        raise Exception(f"{url} ended early at byte {offset}, expected {end}")
+
+
+class SegmentedDownload:
+    # Multi-connection download of one artifact into the cache.
+    def __init__(self, cache, artifact, mirrors, connections):
+        self.cache = cache
+        self.artifact = artifact
+        self.mirrors = [probe.url for probe in mirrors]
+        self.size = mirrors[0].size
+        self.connections = connections
+        self.path = cache.path(artifact.url, artifact.digest)
+        self.part = self.path + ".ranged" + PART_SUFFIX
+        self.segments_file = self.path + SEGMENTS_SUFFIX
+        self.failed = set()
+        self.error = None
+        self.hasher = digests.Hasher(artifact.digest)
+        # Everything before this offset has gone through the hasher
+        self.hashed = 0
+        self.hash_lock = None
+
+    def _load_segments(self):
+        try:
+            with open(self.segments_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if state.get("size") != self.size:
+            return set()
+        return set(state.get("done", []))
+
+    def _save_segments(self, done):
+        tmp = f"{self.segments_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"size": self.size, "done": sorted(done)}, f)
+        os.replace(tmp, self.segments_file)
+
+    def _hash_ready(self, fd, done):
+        # Feed the hasher every finished segment that continues the hashed prefix.
+        while self.hashed < self.size and self.hashed in done:
+            length = min(SEGMENT_SIZE, self.size - self.hashed)
+            for offset in range(self.hashed, self.hashed + length, CHUNK_SIZE):
+                data = os.pread(fd, min(CHUNK_SIZE, self.hashed + length - offset), offset)
+                if not data:
+                    raise Exception(f"{self.part} ended at {offset} bytes, expected {self.size}")
+                self.hasher.update(data)
+            self.hashed += length
+
+    async def _fetch(self, fd, start, end):
+        # One segment, from the first mirror that hasn't failed; retried before failing over.
+        while True:
+            candidates = [url for url in self.mirrors if url not in self.failed]
+            if not candidates:
+                raise Exception(f"All mirrors of {self.artifact.url} failed")
+            for attempt in range(1, SEGMENT_RETRIES + 1):
+                try:
+                    await asyncio.to_thread(fetch_segment, candidates[0], fd, start, end)
+                    return
+                except Exception as e:
+                    if attempt < SEGMENT_RETRIES:
+                        print(f"{candidates[0]}: {e}, retrying bytes {start}-{end - 1}")
+                        await asyncio.sleep(RETRY_DELAY * attempt)
+                    else:
+                        print(f"{candidates[0]}: {e}, failing over")
+            self.failed.add(candidates[0])
+
+    async def _worker(self, fd, pending, done):
+        while pending and self.error is None:
+            start = pending.pop(0)
+            end = min(start + SEGMENT_SIZE, self.size)
+            try:
+                await self._fetch(fd, start, end)
+            except Exception as e:
+                self.error = e
+                return
+            # On disk before it is recorded, so a crash can't resume over a hole
+            await asyncio.to_thread(os.fdatasync, fd)
+            done.add(start)
+            self._save_segments(done)
+            if self.hasher.expected:
+                async with self.hash_lock:
+                    await asyncio.to_thread(self._hash_ready, fd, done)
+
+    async def run(self):
+        os.makedirs(self.cache.root, exist_ok=True)
+        self.cache.evict(reserve=self.size, keep=self.part)
+        fd = os.open(self.part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Wait for another run fetching the same artifact, as ArtifactCache.stream() does.
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            if os.path.exists(self.path):
+                os.remove(self.part)
+                return self.path
+            done = self._load_segments()
+            if not done:
+                os.ftruncate(fd, 0)
+            os.ftruncate(fd, self.size)
+            pending = [start for start in range(0, self.size, SEGMENT_SIZE) if start not in done]
+            if done:
+                print(f"Resuming {self.artifact.url}, {len(pending)} of {len(done) + len(pending)} segments left")
+            else:
+                print(f"Downloading {self.artifact.url} over {self.connections} connections from {self.mirrors[0]}")
+            self.hash_lock = asyncio.Lock()
+            if self.hasher.expected:
+                # Segments finished by an earlier run
+                await asyncio.to_thread(self._hash_ready, fd, done)
+            # Every worker returns before fd is closed, even when one of them gives up.
+            await asyncio.gather(*(self._worker(fd, pending, done) for _ in range(self.connections)))
+            if self.error is not None:
+                raise self.error
+
+            os.fsync(fd)
+            try:
+                self.hasher.verify(self.artifact.url)
+            except digests.DigestMismatch:
+                os.remove(self.part)
+                os.remove(self.segments_file)
+                raise
+            os.replace(self.part, self.path)
+            os.remove(self.segments_file)
+            return self.path
+        finally:
+            os.close(fd)
+
+
+async def fetch_one(cache, artifact, connections=CONNECTIONS):
+    path = cache.lookup(artifact.url, artifact.digest)
+    if path is not None:
+        print(f"Using cached {os.path.basename(path)}")
+        return path
+
+    mirrors = rank(await asyncio.gather(*(asyncio.to_thread(probe, url) for url in artifact.mirrors)))
+    if not mirrors:
+        raise Exception(f"No mirror of {artifact.url} is reachable")
+    best = mirrors[0]
+    if best.ranges and best.size >= MULTI_CONNECTION_MIN and connections > 1:
+        # Only mirrors that agree on the size can share the segments.
+        usable = [mirror for mirror in mirrors if mirror.ranges and mirror.size == best.size]
+        return await SegmentedDownload(cache, artifact, usable, connections).run()
+
+    for mirror in mirrors:
+        try:
+            return await asyncio.to_thread(cache.fetch, artifact.url, artifact.digest, mirror.url)
+        except requests.RequestException as e:
+            print(f"{mirror.url}: {e}, failing over")
+    raise Exception(f"All mirrors of {artifact.url} failed")
+
+
+async def _fetch_all(cache, artifacts, connections):
+    # Enough threads for every connection plus the probes and hashing.
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max(len(artifacts), 1) * (connections + 2), thread_name_prefix="fetch"))
+    results = await asyncio.gather(*(fetch_one(cache, artifact, connections) for artifact in artifacts),
+                                   return_exceptions=True)
+    return {artifact.url: result for artifact, result in zip(artifacts, results)}
+
+
+def fetch_all(cache, artifacts, connections=CONNECTIONS):
+    # Returns {url: local path, or the exception its download failed with}.
+    return asyncio.run(_fetch_all(cache, artifacts, connections))
+
+
+def main():
+    urls = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not urls:
+        print(f"usage: {sys.argv[0]} URL [URL...]")
+        exit(1)
+    cache = ArtifactCache(os.path.join(os.path.expanduser("~"), "flash", "cache"))
+    started = time.monotonic()
+    for url, result in fetch_all(cache, [Artifact(url) for url in urls]).items():
+        print(f"{url}: {result}")
+    print(f"Fetched {len(urls)} artifacts in {time.monotonic() - started:.1f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#
+# Helpers for building a "golden" pre-customized image on a build host.
+#
+# The image file is attached to a loop device with its partitions scanned, so
+# fix_partitions() and customize_os() can run against /dev/loopNp1 and
+# /dev/loopNp2 exactly as they would against an NVMe disk on a board.  The
+# result is streamed to every board afterwards, leaving only the per-board
+# network configuration to be written after flashing.
+#
+import os
+import platform
+import subprocess
+
+QEMU_BINFMT = "/proc/sys/fs/binfmt_misc/qemu-aarch64"
+
+
+def check_chroot_arch():
+    # The chroot runs arm64 binaries.  On an x86 build host that only works
+    # with qemu-user-static registered through binfmt_misc.
+    if platform.machine() in ("aarch64", "arm64"):
+        return
+    if not os.path.exists(QEMU_BINFMT):
+        raise Exception("Building a golden image on a non-arm64 host needs qemu-user-static with binfmt "
+                        "support (apt install qemu-user-static binfmt-support)")
+
+
+def grow_image(path, extra_bytes):
+    # Give the root filesystem room for the packages installed into it.
+    # The file stays sparse, so the headroom costs nothing until it is used.
+    os.truncate(path, os.path.getsize(path) + extra_bytes)
+
+
+def attach(path):
+    result = subprocess.run(["losetup", "--find", "--show", "--partscan", path],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+def detach(loop_device):
+    subprocess.run(["losetup", "--detach", loop_device], check=True)
+
+
+def unmount(mountpoint):
+    # Recursive unmount of a target root including its bind mounts.
+    if os.path.ismount(mountpoint):
+        subprocess.run(["umount", "--recursive", mountpoint], check=True)
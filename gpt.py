@@ -0,0 +1,218 @@
+#
+# Minimal GPT editing: grow the last partition to the end of a larger disk.
+#
+# An image written to a bigger disk leaves its backup GPT header in the middle
+# of the disk and its root partition at the image's size.  fix_partitions()
+# used to repair that with piped gdisk keystrokes, partprobe and parted.  This
+# does it in one in-memory edit instead: read the primary table, move the
+# backup header and entries to the end of the disk, extend the partition to
+# the last usable sector, fix the protective MBR and CRCs, and write both
+# copies.  The kernel is told about the new partition size with BLKPG, which
+# works even while the disk's other partitions are in use.
+#
+# Works the same on a sparse file standing in for a disk:
+#   truncate -s 64G /tmp/disk.img && python3 gpt.py /tmp/disk.img 2 --dry-run
+#
+import os
+import sys
+import ctypes
+import stat
+import uuid
+import zlib
+import fcntl
+import struct
+import imagepipe
+
+SIGNATURE = b"EFI PART"
+# <linux/fs.h>
+BLKSSZGET = 0x1268
+BLKRRPART = 0x125f
+BLKPG = 0x1269
+BLKPG_RESIZE_PARTITION = 3
+
+# Header fields up to and including the entry array CRC
+HEADER_FORMAT = "<8sIIIIQQQQ16sQIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ENTRY_FORMAT = "<16s16sQQQ72s"
+
+
+class Partition:
+    def __init__(self, number, raw):
+        self.number = number
+        self.type_guid, self.guid, self.first_lba, self.last_lba, self.attributes, name = struct.unpack_from(ENTRY_FORMAT, raw)
+        self.name = name.decode("utf-16-le").rstrip("\0")
+
+    @property
+    def used(self):
+        return self.type_guid != bytes(16)
+
+
+class PartitionTable:
+    def __init__(self, data, sector_size=512):
+        # data holds at least the MBR, the primary header and its entries.
+        self.sector_size = sector_size
+        self.mbr = bytearray(data[:sector_size])
+        header = data[sector_size:sector_size + HEADER_SIZE]
+        (signature, self.revision, self.header_size, header_crc, _, self.current_lba, self.backup_lba,
+         self.first_usable, self.last_usable, self.disk_guid, self.entries_lba, self.entry_count,
+         self.entry_size, self.entries_crc) = struct.unpack(HEADER_FORMAT, header)
+        if signature != SIGNATURE:
+            raise Exception("No GPT found (missing EFI PART signature)")
+        check = bytearray(data[sector_size:sector_size + self.header_size])
+        check[16:20] = bytes(4)
+        if zlib.crc32(check) != header_crc:
+            raise Exception("GPT header CRC mismatch")
+        start = self.entries_lba * sector_size
+        self.entries = bytearray(data[start:start + self.entry_count * self.entry_size])
+        if len(self.entries) != self.entry_count * self.entry_size or zlib.crc32(self.entries) != self.entries_crc:
+            raise Exception("GPT partition entries CRC mismatch")
+        self.extra = bytes(data[sector_size + HEADER_SIZE:sector_size + self.header_size])
+
+    @property
+    def entry_sectors(self):
+        return -(-self.entry_count * self.entry_size // self.sector_size)
+
+    def partitions(self):
+        for index in range(self.entry_count):
+            partition = Partition(index + 1, self.entries[index * self.entry_size:(index + 1) * self.entry_size])
+            if partition.used:
+                yield partition
+
+    def partition(self, number):
+        for partition in self.partitions():
+            if partition.number == number:
+                return partition
+        raise Exception(f"Partition {number} does not exist")
+
+    def set_last_lba(self, number, last_lba):
+        offset = (number - 1) * self.entry_size + 40
+        self.entries[offset:offset + 8] = struct.pack("<Q", last_lba)
+
+    def _header(self, current, backup, entries_lba):
+        header = struct.pack(HEADER_FORMAT, SIGNATURE, self.revision, self.header_size, 0, 0, current, backup,
+                             self.first_usable, self.last_usable, self.disk_guid, entries_lba, self.entry_count,
+                             self.entry_size, zlib.crc32(self.entries)) + self.extra
+        header = header[:16] + struct.pack("<I", zlib.crc32(header)) + header[20:]
+        return header.ljust(self.sector_size, b"\0")
+
+    def resize(self, total_sectors):
+        # Place the backup at the end of a disk of total_sectors.
+        self.backup_lba = total_sectors - 1
+        self.last_usable = total_sectors - 2 - self.entry_sectors
+        # Protective MBR: the 0xEE partition covers the whole disk (capped at 2 TiB)
+        if self.mbr[450] == 0xEE:
+            self.mbr[458:462] = struct.pack("<I", min(total_sectors - 1, 0xFFFFFFFF))
+
+    def writes(self):
+        # (byte offset, data) pairs for the MBR and both copies of the table.
+        sector = self.sector_size
+        backup_entries_lba = self.backup_lba - self.entry_sectors
+        return [
+            (0, bytes(self.mbr)),
+            # The primary entries stay where they are (not always LBA 2)
+            (sector, self._header(1, self.backup_lba, self.entries_lba)),
+            (self.entries_lba * sector, bytes(self.entries)),
+            (backup_entries_lba * sector, bytes(self.entries)),
+            (self.backup_lba * sector, self._header(self.backup_lba, 1, backup_entries_lba)),
+        ]
+
+
+def sector_size(fd):
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        return struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, b"\0" * 4))[0]
+    return 512
+
+
+def read_table(fd):
+    size = sector_size(fd)
+    # MBR, header and the largest common entry array (128 x 128 bytes) at LBA 2
+    data = os.pread(fd, size * 2 + 128 * 128, 0)
+    # The header says where the entries really are; read up to their end if that is further
+    entries_lba, entry_count, entry_size = struct.unpack_from("<QII", data, size + 72)
+    end = entries_lba * size + entry_count * entry_size
+    if end > len(data):
+        data = os.pread(fd, end, 0)
+    return PartitionTable(data, size)
+
+
+def plan_grow(table, total_sectors, number=None):
+    # Grow partition number (default: the last one) to the end of a disk of
+    # total_sectors.  Returns (old last LBA, new last LBA).
+    partitions = sorted(table.partitions(), key=lambda partition: partition.first_lba)
+    if not partitions:
+        raise Exception("The partition table is empty")
+    partition = table.partition(number) if number else partitions[-1]
+    if partition.number != partitions[-1].number:
+        raise Exception(f"Partition {partition.number} is not the last partition, it can't grow")
+    if total_sectors - 1 < table.backup_lba:
+        raise Exception(f"The disk ({total_sectors} sectors) is smaller than the image's partition table")
+    table.resize(total_sectors)
+    if partition.last_lba > table.last_usable:
+        raise Exception(f"Partition {partition.number} would not fit on the disk")
+    table.set_last_lba(partition.number, table.last_usable)
+    return partition.last_lba, table.last_usable
+
+
+def grow(path, number=None, dry_run=False):
+    # Relocate the backup GPT to the end of path and grow a partition to
+    # fill the disk, in one edit.  Returns (old last LBA, new last LBA).
+    fd = os.open(path, os.O_RDONLY if dry_run else os.O_RDWR)
+    try:
+        table = read_table(fd)
+        total_sectors = imagepipe.device_size(fd) // table.sector_size
+        old_last, new_last = plan_grow(table, total_sectors, number)
+        if not dry_run:
+            for offset, data in table.writes():
+                imagepipe.pwrite_all(fd, memoryview(data), offset)
+            os.fsync(fd)
+            if stat.S_ISBLK(os.fstat(fd).st_mode):
+                partition = table.partition(number) if number else max(table.partitions(), key=lambda last: last.first_lba)
+                resize_partition(fd, partition, table.sector_size)
+    finally:
+        os.close(fd)
+    return old_last, new_last
+
+
+def resize_partition(fd, partition, sector_size):
+    # partprobe without the process: update the kernel's idea of one
+    # partition (struct blkpg_partition in a struct blkpg_ioctl_arg).
+    start = partition.first_lba * sector_size
+    length = (partition.last_lba - partition.first_lba + 1) * sector_size
+    data = ctypes.create_string_buffer(struct.pack("qqi64s64s", start, length, partition.number, b"", b"").ljust(152, b"\0"))
+    arg = struct.pack("iiiP", BLKPG_RESIZE_PARTITION, 0, len(data), ctypes.addressof(data))
+    try:
+        fcntl.ioctl(fd, BLKPG, arg)
+    except OSError as e:
+        # Not partitioned by the kernel yet (a fresh loop device, ...): re-read the whole table
+        print(f"Resizing partition {partition.number} in place failed ({e}), re-reading the partition table")
+        fcntl.ioctl(fd, BLKRRPART)
+
+
+def print_table(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        table = read_table(fd)
+    finally:
+        os.close(fd)
+    print(f"{path}: disk {uuid.UUID(bytes_le=table.disk_guid)}, {table.sector_size} byte sectors, "
+          f"usable {table.first_usable}-{table.last_usable}, backup header at {table.backup_lba}")
+    for partition in table.partitions():
+        size = (partition.last_lba - partition.first_lba + 1) * table.sector_size
+        print(f"  {partition.number}: {partition.first_lba}-{partition.last_lba} ({size / 1024 ** 3:.2f} GiB) "
+              f"{partition.name}")
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args:
+        print(f"usage: {sys.argv[0]} DISK_OR_IMAGE [PARTITION] [--dry-run]")
+        exit(1)
+    dry_run = "--dry-run" in sys.argv
+    print_table(args[0])
+    old_last, new_last = grow(args[0], int(args[1]) if len(args) > 1 else None, dry_run)
+    print(f"{'Would grow' if dry_run else 'Grew'} the partition from sector {old_last} to {new_last}")
+    if not dry_run:
+        print_table(args[0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,680 @@
+#
+# Streaming image pipeline shared by the build scripts.
+#
+# Instead of landing the whole compressed image in WORKDIR and only then
+# running xzcat | dd, the download, decompress and write stages each run in
+# their own thread and hand data to each other through bounded queues.  Time
+# to provision a board becomes max(download, decompress, write) instead of the
+# sum, and the compressed image never has to touch the SD card.
+#
+import os
+import lzma
+import mmap
+import stat
+import time
+import zlib
+import fcntl
+import queue
+import struct
+import hashlib
+import digests
+import unpack
+import chunkimg
+import threading
+import requests
+from urllib.parse import urlparse
+
+CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+RING_DEPTH = 8
+POLL_INTERVAL = 0.5
+MIB = 1024 * 1024
+
+# Zero detection granularity for SparseWriter, and the block-layer ioctls
+# from <linux/fs.h> it uses.
+ZERO_GRANULE = 64 * 1024
+SECTOR_SIZE = 512
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+BLKGETSIZE64 = 0x80081272
+
+_ZEROS = bytes(ZERO_GRANULE)
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.idle = 0.0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def stop(self):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def busy(self):
+        return max(self.elapsed - self.idle, 0.0)
+
+    def throughput(self):
+        # Throughput while actually working, so a stage starved by a slower
+        # neighbour still reports what it is capable of.
+        return self.bytes / self.busy if self.busy else 0.0
+
+    def summary(self):
+        return (f"{self.name}: {self.bytes / MIB:.1f} MiB in {self.elapsed:.1f}s, "
+                f"{self.throughput() / MIB:.1f} MiB/s while busy "
+                f"({self.busy:.1f}s busy, {self.idle:.1f}s waiting)")
+
+
+class Block:
+    # One filled buffer from a BufferRing, plus where it belongs on the target.
+    # refs counts the writers still holding it when fanned out to several
+    # targets; the buffer goes back to the ring once the last one releases it.
+    __slots__ = ("buf", "length", "offset", "ring", "refs", "_lock")
+
+    def __init__(self, buf, length, offset, ring=None):
+        self.buf = buf
+        self.length = length
+        self.offset = offset
+        self.ring = ring
+        self.refs = 1
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def view(self):
+        return memoryview(self.buf)[:self.length]
+
+    def release(self):
+        with self._lock:
+            self.refs -= 1
+            if self.refs > 0 or self.ring is None:
+                return
+            ring, self.ring = self.ring, None
+        ring.release(self.buf)
+
+
+class BufferRing:
+    # A fixed pool of large page-aligned buffers (anonymous mmaps are always
+    # page aligned).  The decompress stage blocks when every buffer is queued
+    # or being written, which bounds memory no matter how far ahead the
+    # download gets.
+    def __init__(self, count=RING_DEPTH, size=CHUNK_SIZE):
+        self.size = size
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(mmap.mmap(-1, size))
+
+    def acquire(self, cancelled=None):
+        while True:
+            try:
+                return self._free.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if cancelled is not None and cancelled.is_set():
+                    raise PipelineCancelled()
+
+    def release(self, buf):
+        self._free.put(buf)
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+class Pipeline:
+    def __init__(self, depth=RING_DEPTH):
+        self.depth = depth
+        self.stats = []
+        self.threads = []
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def fail(self, error):
+        if self.error is None and not isinstance(error, PipelineCancelled):
+            self.error = error
+        self.cancelled.set()
+
+    def _put(self, q, item, stats):
+        waited = time.monotonic()
+        while True:
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                if self.cancelled.is_set():
+                    if item is _DONE:
+                        # The consumer has gone, nobody is waiting for it.
+                        break
+                    raise PipelineCancelled()
+        stats.idle += time.monotonic() - waited
+
+    def _drain(self, q, stats):
+        while True:
+            waited = time.monotonic()
+            try:
+                item = q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                stats.idle += time.monotonic() - waited
+                if self.cancelled.is_set():
+                    raise PipelineCancelled()
+                continue
+            stats.idle += time.monotonic() - waited
+            if item is _DONE:
+                return
+            yield item
+
+    def stage(self, name, produce, upstream=None):
+        # Run produce(iterator over upstream items) in its own thread and
+        # return a handle the next stage can consume from.
+        stats = StageStats(name)
+        self.stats.append(stats)
+        q = queue.Queue(self.depth)
+
+        def run():
+            stats.start()
+            try:
+                items = self._drain(upstream, stats) if upstream is not None else None
+                for item in produce(items):
+                    stats.bytes += len(item)
+                    self._put(q, item, stats)
+            except BaseException as e:
+                self.fail(e)
+            finally:
+                stats.stop()
+                try:
+                    self._put(q, _DONE, stats)
+                except PipelineCancelled:
+                    pass
+
+        thread = threading.Thread(target=run, name=f"imagepipe-{name}", daemon=True)
+        self.threads.append(thread)
+        thread.start()
+        return q
+
+    def sink(self, name, upstream, writer):
+        # The final stage runs in the calling thread.
+        stats = StageStats(name)
+        self.stats.append(stats)
+        stats.start()
+        try:
+            for block in self._drain(upstream, stats):
+                try:
+                    writer.write(block)
+                    stats.bytes += len(block)
+                finally:
+                    if isinstance(block, Block):
+                        block.release()
+            if self.error is None:
+                writer.close()
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            stats.stop()
+            for thread in self.threads:
+                thread.join()
+            writer.abort()
+        if self.error is not None:
+            raise self.error
+
+    def fan_out(self, name, upstream, writers, verify=True):
+        # Feed one decoded stream to several writers, each in its own thread
+        # with its own queue and stats.  A failing writer is dropped (it keeps
+        # draining so the others are not stalled) instead of aborting the run.
+        # Returns {key: None or the exception that target failed with}.
+        stats = StageStats(name)
+        self.stats.append(stats)
+        digest = hashlib.sha256()
+        length = 0
+        outlets = {}
+
+        for key, writer in writers.items():
+            outlet = TargetOutlet(self, f"{name} {key}", writer)
+            self.stats.append(outlet.stats)
+            outlets[key] = outlet
+            outlet.start()
+
+        stats.start()
+        try:
+            for block in self._drain(upstream, stats):
+                digest.update(block.view())
+                length = max(length, block.offset + block.length)
+                stats.bytes += len(block)
+                block.refs = len(outlets)
+                for outlet in outlets.values():
+                    outlet.put(block, stats)
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            stats.stop()
+            for outlet in outlets.values():
+                outlet.finish(stats)
+            for thread in self.threads:
+                thread.join()
+            for outlet in outlets.values():
+                outlet.thread.join()
+        if self.error is not None:
+            raise self.error
+
+        results = {}
+        for key, outlet in outlets.items():
+            if outlet.error is None and verify and not outlet.writer.verifies:
+                try:
+                    print(f"Verifying {outlet.writer.path}")
+                    if digests.device_digest(outlet.writer.path, length) != digest.hexdigest():
+                        raise Exception(f"Readback of {outlet.writer.path} does not match the image")
+                except Exception as e:
+                    outlet.error = e
+            results[key] = outlet.error
+        return results
+
+    def report(self):
+        for stats in self.stats:
+            print(stats.summary())
+
+
+class TargetOutlet:
+    # One writer thread of Pipeline.fan_out()
+    def __init__(self, pipe, name, writer):
+        self.pipe = pipe
+        self.writer = writer
+        self.stats = StageStats(name)
+        self.queue = queue.Queue(pipe.depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=f"imagepipe-{name}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, block, stats):
+        self.pipe._put(self.queue, block, stats)
+
+    def finish(self, stats):
+        try:
+            self.pipe._put(self.queue, _DONE, stats)
+        except PipelineCancelled:
+            pass
+
+    def run(self):
+        self.stats.start()
+        try:
+            for block in self.pipe._drain(self.queue, self.stats):
+                try:
+                    if self.error is None:
+                        self.writer.write(block)
+                        self.stats.bytes += len(block)
+                except Exception as e:
+                    self.error = e
+                    print(f"Writing {self.writer.path} failed, dropping it from the batch: {e}")
+                finally:
+                    block.release()
+            if self.error is None and not self.pipe.cancelled.is_set():
+                self.writer.close()
+        except PipelineCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self.stats.stop()
+            self.writer.abort()
+
+
+def is_url(location):
+    return urlparse(location).scheme in ("http", "https")
+
+
+def http_source(url, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    def produce(_):
+        with requests.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+    return produce
+
+
+def file_source(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    def produce(_):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+    return produce
+
+
+class Decoder:
+    # Incremental xz/gz/raw decoder.  Output is produced in pieces of at most
+    # `limit` bytes because the zero-filled regions of a disk image expand
+    # by several orders of magnitude.
+    def __init__(self, name, limit=CHUNK_SIZE):
+        name = name.lower()
+        if name.endswith(".xz"):
+            self.kind = "xz"
+        elif name.endswith(".gz"):
+            self.kind = "gz"
+        else:
+            self.kind = "raw"
+        self.limit = limit
+        self._d = self._new()
+
+    def _new(self):
+        if self.kind == "xz":
+            return lzma.LZMADecompressor()
+        if self.kind == "gz":
+            return zlib.decompressobj(wbits=47)
+        return None
+
+    def feed(self, data):
+        if self._d is None:
+            if data:
+                yield data
+            return
+        while data:
+            if self._d.eof:
+                # Concatenated xz streams / gzip members, with or without
+                # zero padding between them, or trailing padding.
+                data = data.lstrip(b"\0")
+                if not data:
+                    return
+                self._d = self._new()
+            if self.kind == "xz":
+                out = self._d.decompress(data, self.limit)
+                if out:
+                    yield out
+                while not self._d.eof and not self._d.needs_input:
+                    out = self._d.decompress(b"", self.limit)
+                    if out:
+                        yield out
+            else:
+                out = self._d.decompress(data, self.limit)
+                if out:
+                    yield out
+                while self._d.unconsumed_tail:
+                    out = self._d.decompress(self._d.unconsumed_tail, self.limit)
+                    if out:
+                        yield out
+            data = self._d.unused_data if self._d.eof else b""
+
+    def finish(self):
+        if self._d is not None and not self._d.eof:
+            raise Exception(f"Compressed {self.kind} stream ended unexpectedly")
+
+
+def fill_blocks(pieces, ring, cancelled=None, offset=0):
+    # Pack arbitrarily sized pieces into full ring buffers, the first one
+    # belonging at offset on the target.
+    buf = None
+    used = 0
+    for piece in pieces:
+        view = memoryview(piece)
+        while view:
+            if buf is None:
+                buf = ring.acquire(cancelled)
+                used = 0
+            take = min(len(view), ring.size - used)
+            buf[used:used + take] = view[:take]
+            used += take
+            view = view[take:]
+            if used == ring.size:
+                yield Block(buf, used, offset, ring)
+                offset += used
+                buf = None
+    if buf is not None:
+        if used:
+            yield Block(buf, used, offset, ring)
+        else:
+            ring.release(buf)
+
+
+def decode(name, ring, cancelled=None, workers=None, offset=0):
+    # Multi-block xz images and chunked images are decoded on every core (see
+    # unpack.py and chunkimg.py), everything else sequentially in this stage's
+    # thread.  offset is where the decoded data starts on the target.
+    def sequential(chunks):
+        decoder = Decoder(name, ring.size)
+        for chunk in chunks:
+            yield from decoder.feed(chunk)
+        decoder.finish()
+
+    def produce(chunks):
+        if name.lower().endswith(".xz"):
+            pieces = unpack.xz_pieces(chunks, sequential, workers, ring.size)
+        elif chunkimg.is_chunked(name):
+            pieces = chunkimg.pieces(chunks, workers)
+        else:
+            pieces = sequential(chunks)
+        yield from fill_blocks(pieces, ring, cancelled, offset)
+    return produce
+
+
+def pwrite_all(fd, view, offset):
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def device_size(fd):
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        return struct.unpack("Q", fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8))[0]
+    return os.fstat(fd).st_size
+
+
+def zero_runs(view, granule=ZERO_GRANULE):
+    # Split a buffer into alternating (start, end, is_zero) runs.  Each
+    # granule is checked with a single memcmp against a zero buffer, which
+    # is what keeps this fast enough to sit in front of an NVMe drive.
+    zeros = _ZEROS if granule == ZERO_GRANULE else bytes(granule)
+    run_start = 0
+    run_zero = None
+    for start in range(0, len(view), granule):
+        piece = view[start:start + granule]
+        is_zero = zeros.startswith(piece)
+        if run_zero is None:
+            run_zero = is_zero
+        elif is_zero != run_zero:
+            yield run_start, start, run_zero
+            run_start = start
+            run_zero = is_zero
+    if run_zero is not None:
+        yield run_start, len(view), run_zero
+
+
+class DeviceWriter:
+    # True for a writer that reads back what it wrote itself, so fan_out() doesn't read the device again.
+    verifies = False
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def write(self, block):
+        self.write_data(block.view(), block.offset)
+
+    def write_data(self, view, offset):
+        # Every data write goes through here, so a subclass can change how it reaches the device.
+        pwrite_all(self.fd, view, offset)
+
+    def close(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def abort(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SparseWriter(DeviceWriter):
+    # Writes only the non-zero parts of an image.  Zero runs are handled
+    # according to mode:
+    #   zeroout - BLKZEROOUT the range (NVMe Write Zeroes, no data transfer)
+    #   discard - BLKDISCARD the whole device up front, then skip zero runs
+    #   seek    - just skip; a regular file is truncated first so skipped
+    #             ranges become holes, a device is assumed to already be zero
+    # The default is zeroout for block devices and seek for files.
+    MODES = ("zeroout", "discard", "seek")
+
+    def __init__(self, path, mode=None):
+        super().__init__(path)
+        self.block_device = stat.S_ISBLK(os.fstat(self.fd).st_mode)
+        if mode is None:
+            mode = "zeroout" if self.block_device else "seek"
+        if mode not in self.MODES:
+            raise Exception(f"Unknown zero handling mode {mode}, expected one of {', '.join(self.MODES)}")
+        if mode in ("zeroout", "discard") and not self.block_device:
+            mode = "seek"
+        self.mode = mode
+        self.written = 0
+        self.skipped = 0
+        self.end = 0
+        self._pending = None
+
+        if not self.block_device:
+            os.ftruncate(self.fd, 0)
+        elif mode == "discard":
+            fcntl.ioctl(self.fd, BLKDISCARD, struct.pack("QQ", 0, device_size(self.fd)))
+
+    def write(self, block):
+        view = block.view()
+        for start, end, is_zero in zero_runs(view):
+            offset = block.offset + start
+            if is_zero:
+                self._zero(offset, end - start)
+                self.skipped += end - start
+            else:
+                self._flush_zero()
+                self.write_data(view[start:end], offset)
+                self.written += end - start
+        self.end = max(self.end, block.offset + block.length)
+
+    def _zero(self, offset, length):
+        # Adjacent zero runs are merged so one ioctl covers the whole gap.
+        if self._pending and self._pending[0] + self._pending[1] == offset:
+            self._pending = (self._pending[0], self._pending[1] + length)
+        else:
+            self._flush_zero()
+            self._pending = (offset, length)
+
+    def _flush_zero(self):
+        if self._pending is None:
+            return
+        offset, length = self._pending
+        self._pending = None
+        if self.mode != "zeroout":
+            return
+        aligned = length - length % SECTOR_SIZE if offset % SECTOR_SIZE == 0 else 0
+        if aligned:
+            fcntl.ioctl(self.fd, BLKZEROOUT, struct.pack("QQ", offset, aligned))
+        if aligned < length:
+            self.write_data(memoryview(bytes(length - aligned)), offset + aligned)
+
+    def close(self):
+        if self.fd is not None:
+            self._flush_zero()
+            if not self.block_device:
+                os.ftruncate(self.fd, self.end)
+        super().close()
+
+    def summary(self):
+        return (f"wrote {self.written / MIB:.1f} MiB, skipped {self.skipped / MIB:.1f} MiB "
+                f"of zeros ({self.mode})")
+
+
+def hash_blocks(*hashers):
+    def produce(blocks):
+        for block in blocks:
+            for hasher in hashers:
+                hasher.update(block.view())
+            yield block
+    return produce
+
+
+def stream_image(location, target, depth=RING_DEPTH, chunk_size=CHUNK_SIZE, zero_mode=None, source=None,
+                 expect=None, writer=None, observer=None, workers=None, offset=0, tap=None):
+    # location is an http(s) URL or a local path; the decompressor is picked
+    # from the file extension.  source overrides how the bytes are fetched
+    # (e.g. through the artifact cache).  expect holds digests of the
+    # decompressed image, which are computed in their own stage while it is
+    # written and checked at the end.  observer is called with the finished
+    # (or failed) Pipeline, e.g. to record its stage timings.  workers caps
+    # the threads decoding a multi-block xz image (default: one per core).
+    # offset is where the image data starts on target, for a write resumed
+    # partway through a chunked image (chunkimg.write).  tap is fed the
+    # decompressed image like the expect digests (anything with update(data)).
+    name = urlparse(location).path if is_url(location) else location
+    if source is None:
+        source = http_source(location) if is_url(location) else file_source(location)
+
+    if writer is None:
+        writer = SparseWriter(target, zero_mode)
+    pipe = Pipeline(depth)
+    ring = BufferRing(depth, chunk_size)
+    downloaded = pipe.stage("download" if is_url(location) else "read", source)
+    decoded = pipe.stage("decompress", decode(name, ring, pipe.cancelled, workers, offset), downloaded)
+    hasher = digests.Hasher(expect)
+    hashers = ([hasher] if hasher.expected else []) + ([tap] if tap is not None else [])
+    if hashers:
+        decoded = pipe.stage("hash", hash_blocks(*hashers), decoded)
+    try:
+        pipe.sink("write", decoded, writer)
+    finally:
+        pipe.report()
+        if observer is not None:
+            observer(pipe)
+        if hasattr(writer, "summary"):
+            print(f"{target}: {writer.summary()}")
+    hasher.verify(f"{location} (decompressed)")
+    return pipe
+
+
+def stream_to_targets(location, targets, depth=RING_DEPTH, chunk_size=CHUNK_SIZE, zero_mode=None, verify=True, source=None,
+                      observer=None, workers=None, make_writer=None, tap=None):
+    # Decode one image once and write it to every device in targets.
+    # Returns {device: None or the exception that device failed with}.
+    # make_writer(device) replaces the default SparseWriter; tap is fed the
+    # decompressed image, as in stream_image().
+    name = urlparse(location).path if is_url(location) else location
+    if source is None:
+        source = http_source(location) if is_url(location) else file_source(location)
+
+    writers = {}
+    failed = {}
+    for target in targets:
+        try:
+            writers[target] = make_writer(target) if make_writer else SparseWriter(target, zero_mode)
+        except Exception as e:
+            print(f"Unable to open {target}, dropping it from the batch: {e}")
+            failed[target] = e
+    if not writers:
+        return failed
+
+    pipe = Pipeline(depth)
+    ring = BufferRing(depth, chunk_size)
+    downloaded = pipe.stage("download" if is_url(location) else "read", source)
+    decoded = pipe.stage("decompress", decode(name, ring, pipe.cancelled, workers), downloaded)
+    if tap is not None:
+        decoded = pipe.stage("hash", hash_blocks(tap), decoded)
+    try:
+        results = pipe.fan_out("fan-out", decoded, writers, verify)
+    finally:
+        pipe.report()
+        if observer is not None:
+            observer(pipe)
+        for target, writer in writers.items():
+            print(f"{target}: {writer.summary()}")
+    results.update(failed)
+    return results
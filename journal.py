@@ -0,0 +1,162 @@
+#
+# Checkpoint journal for resumable provisioning runs.
+#
+# Every completed step is recorded in a small JSON file under WORKDIR along
+# with digests of what it produced.  A rerun with the same settings skips the
+# steps whose outputs still check out and picks up at the first one that
+# failed or no longer verifies.  Anything recorded after a step that has to
+# be redone is dropped as well, since it was built on top of it.  (Downloads
+# resume on their own from the artifact cache's partial files.)  A journal is
+# removed once its run has finished, so the next run starts from scratch.
+#
+import os
+import json
+import time
+import struct
+import hashlib
+import threading
+import gpt
+import digests
+
+# Protective MBR plus the primary GPT header and partition entries
+PARTITION_TABLE_BYTES = 34 * 512
+
+
+class Journal:
+    def __init__(self, path, settings, restart=False):
+        # settings: everything the recorded steps depend on.  A journal
+        # written with different settings is ignored.
+        self.path = path
+        self.fingerprint = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        self.steps = {}
+        # Steps of one journal may finish concurrently (taskgraph)
+        self._lock = threading.Lock()
+        if restart:
+            self.clear()
+        else:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable journal {self.path}: {e}")
+            return
+        if data.get("settings") != self.fingerprint:
+            print(f"Settings changed since {self.path} was written, starting over")
+            return
+        self.steps = data.get("steps", {})
+        if self.steps:
+            print(f"Resuming from {self.path}: {', '.join(self.steps)} already done")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"settings": self.fingerprint, "steps": self.steps}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def done(self, name, verify=None):
+        # True if name was recorded and verify(outputs), if given, still agrees.
+        entry = self.steps.get(name)
+        if entry is None:
+            return False
+        if verify is not None:
+            try:
+                ok = verify(entry["outputs"])
+            except Exception as e:
+                print(f"{name}: checking the recorded result failed: {e}")
+                ok = False
+            if not ok:
+                print(f"{name}: recorded result no longer checks out, redoing it")
+                return False
+        print(f"{name}: already done {time.ctime(entry['finished'])}, skipping")
+        return True
+
+    def record(self, name, outputs=None):
+        with self._lock:
+            self.steps[name] = {"finished": time.time(), "outputs": outputs or {}}
+            self._save()
+
+    def forget(self, name):
+        # Drop name and every step recorded after it.
+        with self._lock:
+            if name not in self.steps:
+                return
+            names = list(self.steps)
+            for later in names[names.index(name):]:
+                del self.steps[later]
+            self._save()
+
+    def run(self, name, action, verify=None, outputs=None):
+        # Run action() unless it is already done; outputs(result) returns the
+        # digests to record for it.  Returns whether action() ran.
+        if self.done(name, verify):
+            return False
+        self.forget(name)
+        result = action()
+        self.record(name, outputs(result) if outputs else None)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.steps = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def file_digest(path):
+    return digests.device_digest(path, os.path.getsize(path))
+
+
+def partition_table_digest(disk):
+    return digests.device_digest(disk, PARTITION_TABLE_BYTES)
+
+
+class ImageDigest:
+    # SHA-256 and size of a disk image, leaving out its first skip bytes
+    # (the partition table, which fix_partitions() rewrites).  Fed the image
+    # as it is written (imagepipe's tap) or read back from the disk.  With
+    # partition, everything up to the end of that partition is left out
+    # instead, as the image's own GPT says once its start has streamed past.
+    def __init__(self, skip=PARTITION_TABLE_BYTES, partition=None):
+        self.skip = None if partition else skip
+        self.partition = partition
+        self.head = bytearray()
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def _partition_end(self):
+        # None until the head of the image holds the GPT header and its entries.
+        sector = 512
+        if len(self.head) < sector * 2:
+            return None
+        entries_lba, entry_count, entry_size = struct.unpack_from("<QII", self.head, sector + 72)
+        if len(self.head) < entries_lba * sector + entry_count * entry_size:
+            return None
+        table = gpt.PartitionTable(bytes(self.head), sector)
+        return (table.partition(self.partition).last_lba + 1) * sector
+
+    def update(self, data):
+        if self.skip is None:
+            self.head += data
+            self.skip = self._partition_end()
+            if self.skip is None:
+                return
+            data, self.head = self.head, None
+        data = memoryview(data)
+        start = min(max(self.skip - self.size, 0), len(data))
+        self.hash.update(data[start:])
+        self.size += len(data)
+
+    def outputs(self):
+        if self.skip is None:
+            raise Exception("The image ended before its partition table")
+        return {"size": self.size, "skip": self.skip, "sha256": self.hash.hexdigest()}
+
+
+def image_digest(disk, size, skip=PARTITION_TABLE_BYTES):
+    return digests.read_device(disk, size, ImageDigest(skip)).hash.hexdigest()
@@ -0,0 +1,171 @@
+#
+# Declarative provisioning profiles.
+#
+# A profile file (TOML, or YAML when PyYAML is installed) describes the images
+# and digests, packages, kernel debs and a list of boards with their disk,
+# interface and address, so a batch can run unattended without get_inputs().
+# See example-profile.toml.  Anything the profile leaves out keeps the
+# defaults passed in by the build script.
+#
+import os
+import re
+import ipaddress
+import targets
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11 (Ubuntu 22.04 ships 3.10)
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class ProfileError(Exception):
+    pass
+
+
+# (section, key) -> (Profile attribute, type)
+SCHEMA = {
+    ("image", "url"): ("image_url", str),
+    ("image", "sha256"): ("image_sha256", str),
+    ("image", "mirrors"): ("image_mirrors", list),
+    ("spi", "zero_url"): ("zero_url", str),
+    ("spi", "zero_md5"): ("zero_md5", str),
+    ("spi", "zero_md5_unzipped"): ("zero_md5_unzipped", str),
+    ("spi", "zero_sha256"): ("zero_sha256", str),
+    ("spi", "zero_sha256_unzipped"): ("zero_sha256_unzipped", str),
+    ("spi", "zero_mirrors"): ("zero_mirrors", list),
+    ("spi", "bootloader_url"): ("bootloader_url", str),
+    ("spi", "bootloader_md5"): ("bootloader_md5", str),
+    ("spi", "bootloader_sha256"): ("bootloader_sha256", str),
+    ("spi", "bootloader_mirrors"): ("bootloader_mirrors", list),
+    ("packages", "apt"): ("apt_packages", list),
+    ("packages", "pip"): ("pip_packages", list),
+    ("kernel", "image"): ("kernel_package", str),
+    ("kernel", "headers"): ("kernel_headers", str),
+    ("kernel", "libc_dev"): ("kernel_libc_dev", str),
+    ("devicetree", "source"): ("dt_source", str),
+    ("devicetree", "patch"): ("dt_patch", str),
+    ("devicetree", "mode"): ("dt_mode", str),
+    ("devicetree", "output"): ("dt_output", str),
+}
+
+BOARD_KEYS = {"name", "disk", "bootpart", "rootpart", "interface", "address", "gateway"}
+
+
+class Board:
+    def __init__(self, disk, interface, address="dhcp", gateway="dhcp", bootpart=None, rootpart=None, name=None):
+        self.disk = disk
+        self.interface = interface
+        self.address = address
+        self.gateway = gateway
+        self.bootpart = bootpart
+        self.rootpart = rootpart
+        self.name = name or os.path.basename(disk)
+
+    def target(self, mountpoint):
+        return targets.Target(self.disk, self.bootpart, self.rootpart, mountpoint,
+                              self.interface, self.address, self.gateway, self.name)
+
+
+class Profile:
+    def __init__(self, defaults):
+        # defaults holds a value for every attribute in SCHEMA plus "interface".
+        for attribute, kind in SCHEMA.values():
+            setattr(self, attribute, _coerce(defaults.get(attribute), kind, attribute))
+        self.interface = defaults.get("interface")
+        self.boards = []
+
+    def update(self, data, source="profile"):
+        for section, values in data.items():
+            if section == "board":
+                continue
+            if not isinstance(values, dict):
+                raise ProfileError(f"{source}: [{section}] must be a table")
+            for key, value in values.items():
+                if (section, key) not in SCHEMA:
+                    raise ProfileError(f"{source}: unknown setting {section}.{key}")
+                attribute, kind = SCHEMA[(section, key)]
+                setattr(self, attribute, _coerce(value, kind, f"{section}.{key}"))
+
+        seen = set()
+        names = set()
+        for index, board in enumerate(data.get("board", []), 1):
+            unknown = set(board) - BOARD_KEYS
+            if unknown:
+                raise ProfileError(f"{source}: board {index} has unknown settings {', '.join(sorted(unknown))}")
+            if "disk" not in board:
+                raise ProfileError(f"{source}: board {index} has no disk")
+            if board["disk"] in seen:
+                raise ProfileError(f"{source}: disk {board['disk']} is listed twice")
+            seen.add(board["disk"])
+            name = board.get("name")
+            if name is not None:
+                # Names the board's journal file
+                if not isinstance(name, str) or not re.fullmatch(r"[A-Za-z0-9._-]+", name) or name.startswith("."):
+                    raise ProfileError(f"{source}: board {index} name must be letters, digits, '.', '_' or '-'")
+                if name in names:
+                    raise ProfileError(f"{source}: board name {name} is used twice")
+                names.add(name)
+            address = str(board.get("address", "dhcp"))
+            gateway = str(board.get("gateway", "dhcp"))
+            _check_address(address, gateway, f"{source}: board {index}")
+            self.boards.append(Board(board["disk"], board.get("interface", self.interface), address, gateway,
+                                     board.get("bootpart"), board.get("rootpart"), name))
+
+    def targets(self, mount_root):
+        # One Target per board, each with its own mount point under mount_root.
+        return [board.target(os.path.join(mount_root, os.path.basename(board.disk))) for board in self.boards]
+
+
+def _coerce(value, kind, what):
+    if value is None:
+        return [] if kind is list else ""
+    if kind is list:
+        if isinstance(value, str):
+            return value.split()
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            return value
+    elif isinstance(value, str):
+        return value
+    raise ProfileError(f"{what} must be a {'list of strings' if kind is list else 'string'}")
+
+
+def _check_address(address, gateway, what):
+    if address == "dhcp":
+        return
+    if gateway == "dhcp":
+        # netplan has no use for "gateway4: dhcp", the board would come up without networking
+        raise ProfileError(f"{what}: static address {address} needs a gateway")
+    try:
+        interface = ipaddress.ip_interface(address)
+        if "/" not in address:
+            raise ValueError("missing prefix length")
+        if ipaddress.ip_address(gateway) not in interface.network:
+            raise ProfileError(f"{what}: gateway {gateway} is not in {interface.network}")
+    except ValueError as e:
+        raise ProfileError(f"{what}: invalid address {address} ({e}), use slash notation or dhcp")
+
+
+def read(path):
+    with open(path, "rb") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ProfileError("YAML profiles need PyYAML (apt install python3-yaml), or use TOML")
+            return yaml.safe_load(f) or {}
+        if tomllib is None:
+            raise ProfileError("TOML profiles need Python 3.11 or tomli (apt install python3-tomli), or use YAML")
+        return tomllib.load(f)
+
+
+def load(path, defaults):
+    profile = Profile(defaults)
+    profile.update(read(path), path)
+    return profile
@@ -0,0 +1,203 @@
+#
+# Host-side apt/pip package cache shared by every chroot provisioning run.
+#
+# The first board fills the cache and the following ones install from it:
+#   - the pip cache directory is bind-mounted over /root/.cache/pip in the target
+#   - for a single board the apt archive directory is bind-mounted over
+#     /var/cache/apt/archives, and apt is told to keep what it downloads
+#   - several chroots (or boards on the LAN) can instead share one caching
+#     HTTP proxy for apt, since concurrent apt runs can't share one archive
+#     directory:  python3 pkgcache.py serve [PORT] [CACHE_DIR]
+#   - with a proxy, pip in the chroot uses it as its package index as well:
+#     /pypi/simple/ passes PyPI's index pages through with their file links
+#     pointed back at the proxy, and /pypi/files/ caches the wheels and
+#     sdists, so every board after the first installs them over the LAN
+#
+import os
+import sys
+import threading
+import subprocess
+import http.server
+import requests
+from urllib.parse import urlparse
+from artifacts import ArtifactCache
+
+DEFAULT_PORT = 3142
+APT_CONF = "etc/apt/apt.conf.d/01provision-cache"
+PIP_CONF = "etc/pip.conf"
+PIP_CONF_MARKER = "# Written by pkgcache.py, removed again after provisioning\n"
+PYPI_INDEX = "https://pypi.org/simple/"
+PYPI_FILES = "https://files.pythonhosted.org/"
+PROXY_MAX_BYTES = 16 * 1024 * 1024 * 1024
+
+# Package files never change once published, so they can be cached forever.
+# Indexes (Release, Packages, ...) are always passed through.
+CACHEABLE_SUFFIXES = (".deb", ".udeb", ".ddeb", ".whl")
+PASSTHROUGH_HEADERS = ("Content-Type", "Content-Length", "Last-Modified", "ETag", "Date")
+
+
+class PackageCache:
+    def __init__(self, root, proxy=None):
+        self.root = root
+        self.proxy = proxy
+        self.apt_dir = os.path.join(root, "apt")
+        self.pip_dir = os.path.join(root, "pip")
+
+    def _mounts(self, target):
+        mounts = [(self.pip_dir, target.path("root/.cache/pip"))]
+        if not self.proxy:
+            mounts.append((self.apt_dir, target.path("var/cache/apt/archives")))
+        return mounts
+
+    def bind(self, target):
+        for source, mountpoint in self._mounts(target):
+            os.makedirs(source, exist_ok=True)
+            os.makedirs(mountpoint, exist_ok=True)
+            subprocess.run(["mount", "--bind", source, mountpoint], check=True)
+        os.makedirs(os.path.join(self.apt_dir, "partial"), exist_ok=True)
+
+        # Keep downloaded .debs, and download them as root: the target's _apt
+        # user does not own the host directory.
+        apt_conf = 'Binary::apt::APT::Keep-Downloaded-Packages "true";\n'
+        apt_conf += 'APT::Keep-Downloaded-Packages "true";\n'
+        apt_conf += 'APT::Sandbox::User "root";\n'
+        if self.proxy:
+            apt_conf += f'Acquire::http::Proxy "{self.proxy}";\n'
+        with open(target.path(APT_CONF), "w") as f:
+            f.write(apt_conf)
+
+        if self.proxy:
+            if os.path.exists(target.path(PIP_CONF)):
+                print(f"{target.path(PIP_CONF)} exists, pip in the chroot won't use the package proxy")
+            else:
+                with open(target.path(PIP_CONF), "w") as f:
+                    f.write(f"{PIP_CONF_MARKER}[global]\nindex-url = {self.proxy}/pypi/simple/\n"
+                            f"trusted-host = {urlparse(self.proxy).hostname}\n")
+
+    def unbind(self, target):
+        if os.path.exists(target.path(APT_CONF)):
+            os.remove(target.path(APT_CONF))
+        if os.path.exists(target.path(PIP_CONF)):
+            with open(target.path(PIP_CONF)) as f:
+                ours = f.readline() == PIP_CONF_MARKER
+            if ours:
+                os.remove(target.path(PIP_CONF))
+        for _, mountpoint in reversed(self._mounts(target)):
+            if os.path.ismount(mountpoint):
+                subprocess.run(["umount", mountpoint], check=True)
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        url = self.path
+        if url.startswith("/pypi/"):
+            self._send_pypi(url[len("/pypi/"):])
+            return
+        if urlparse(url).scheme != "http":
+            self.send_error(400, "Only plain http proxy requests are supported")
+            return
+        try:
+            if urlparse(url).path.endswith(CACHEABLE_SUFFIXES):
+                self._send_cached(url)
+            else:
+                self._send_passthrough(url)
+        except requests.HTTPError as e:
+            self.send_error(e.response.status_code)
+        except (requests.RequestException, OSError) as e:
+            self.log_error("%s: %s", url, e)
+
+    def _send_cached(self, url):
+        chunks = self.cache.stream(url)
+        # Pull the first chunk before answering so upstream errors still
+        # become a proper status code.
+        first = next(chunks, b"")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        path = self.cache.lookup(url)
+        if path is not None:
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        self.wfile.write(first)
+        for chunk in chunks:
+            self.wfile.write(chunk)
+
+    def _send_pypi(self, path):
+        # pip's index: pages from PyPI with their file links pointing here, files from the cache
+        try:
+            if path.startswith("files/"):
+                self._send_cached(PYPI_FILES + path[len("files/"):])
+            elif path.startswith("simple/"):
+                response = requests.get(PYPI_INDEX + path[len("simple/"):], headers={"Accept": "text/html"},
+                                        timeout=60)
+                response.raise_for_status()
+                page = response.text.replace(PYPI_FILES, f"http://{self.headers['Host']}/pypi/files/")
+                body = page.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(404)
+        except requests.HTTPError as e:
+            self.send_error(e.response.status_code)
+        except (requests.RequestException, OSError) as e:
+            self.log_error("%s: %s", path, e)
+
+    def _send_passthrough(self, url):
+        headers = {"Accept-Encoding": "identity"}
+        for name in ("If-Modified-Since", "If-None-Match", "Range"):
+            if self.headers.get(name):
+                headers[name] = self.headers[name]
+        with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+            self.send_response(response.status_code)
+            for name in PASSTHROUGH_HEADERS:
+                if name in response.headers:
+                    self.send_header(name, response.headers[name])
+            self.end_headers()
+            if response.status_code != 304:
+                for chunk in response.raw.stream(64 * 1024, decode_content=False):
+                    self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CachingProxy:
+    def __init__(self, root, port=DEFAULT_PORT, host="0.0.0.0", max_bytes=PROXY_MAX_BYTES):
+        handler = type("CachingProxyHandler", (ProxyHandler,), {"cache": ArtifactCache(root, max_bytes)})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{'127.0.0.1' if host == '0.0.0.0' else host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="pkgcache-proxy", daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != "serve":
+        print(f"usage: {sys.argv[0]} serve [PORT] [CACHE_DIR]")
+        exit(1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+    root = sys.argv[3] if len(sys.argv) > 3 else os.path.join(os.path.expanduser("~"), "flash", "packages", "proxy")
+    proxy = CachingProxy(root, port)
+    print(f"Caching apt proxy listening on port {port}, cache in {root}")
+    try:
+        proxy.server.serve_forever()
+    except KeyboardInterrupt:
+        proxy.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#
+# Target probing and write tuning, cached per device model and serial.
+#
+# The right block size and number of writes in flight differ a lot between
+# an NVMe drive, a USB SATA bridge and the SPI NOR behind /dev/mtdblock0.
+# On the flash anything smaller than an erase block means a read, erase and
+# reprogram of the whole erase block for every write, which is why dd's 512
+# byte default made each SPI pass take minutes.  probe() collects what the
+# kernel knows about a target: the block queue limits from sysfs (logical
+# and physical block size, minimum and optimal I/O size, rotational, discard
+# and write-zeroes support) and, for MTD devices, the erase and write size
+# from /sys/class/mtd.  tune() turns that into a block size, alignment and
+# queue depth for directio.  For disks it can also time short O_DIRECT
+# writes to a scratch region for a few block size and queue depth
+# combinations and keep the fastest.  The region is the end of the disk, which
+# install_os() is about to overwrite, or for a stand-in file a scratch file
+# next to it.  Flash is never calibrated: it wears, and the erase size
+# already says what to use.
+#
+# Results are cached under ~/flash/probe, one JSON file per model and serial,
+# so a calibration runs once per device.
+#
+#   python3 probe.py /dev/nvme0n1 [--calibrate] [--refresh]
+#
+import os
+import re
+import sys
+import json
+import stat
+import time
+import directio
+import imagepipe
+
+PROBE_DIR = os.path.join(os.path.expanduser("~"), "flash", "probe")
+# Part of every cache entry: bump when tune() would pick differently for the same device.
+CACHE_VERSION = 1
+# Bytes written per calibration candidate
+CALIBRATION_SIZE = 16 * 1024 * 1024
+BLOCK_SIZES = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+QUEUE_DEPTHS = (1, 4, 8)
+ROTATIONAL_QUEUE_DEPTHS = (1, 2)
+# Among candidates within this fraction of the fastest, the one with the least in flight wins.
+CALIBRATION_TOLERANCE = 0.05
+
+QUEUE_LIMITS = ("logical_block_size", "physical_block_size", "minimum_io_size", "optimal_io_size",
+                "max_sectors_kb", "rotational", "discard_max_bytes", "write_zeroes_max_bytes")
+
+
+def _safe_name(value):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value).strip("_")
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _read_int(path):
+    value = _read(path)
+    return int(value) if value.isdigit() else None
+
+
+def sysfs_dir(path):
+    # /sys/devices/... of the whole disk behind a block device (or one of its partitions).
+    rdev = os.stat(path).st_rdev
+    directory = os.path.realpath(f"/sys/dev/block/{os.major(rdev)}:{os.minor(rdev)}")
+    if os.path.exists(os.path.join(directory, "partition")):
+        directory = os.path.dirname(directory)
+    return directory
+
+
+def probe(path):
+    # What the kernel knows about path, as a dict; kind is "disk", "mtd" or "file".
+    real = os.path.realpath(path)
+    mode = os.stat(real).st_mode
+    if not stat.S_ISBLK(mode):
+        st = os.stat(os.path.dirname(real) or ".")
+        return {"path": path, "kind": "file", "model": "file",
+                "serial": f"{os.major(st.st_dev)}:{os.minor(st.st_dev)}",
+                "logical_block_size": 512, "physical_block_size": st.st_blksize, "minimum_io_size": st.st_blksize,
+                "optimal_io_size": 0, "rotational": 0, "size": os.path.getsize(real)}
+
+    directory = sysfs_dir(real)
+    info = {"path": path, "kind": "disk"}
+    for limit in QUEUE_LIMITS:
+        info[limit] = _read_int(os.path.join(directory, "queue", limit))
+    info["size"] = (_read_int(os.path.join(directory, "size")) or 0) * imagepipe.SECTOR_SIZE
+
+    match = re.search(r"mtdblock(\d+)$", real)
+    if match:
+        mtd = f"/sys/class/mtd/mtd{match.group(1)}"
+        info.update(kind="mtd", model=_read(f"{mtd}/name") or "mtd", serial=_read(f"{mtd}/type"),
+                    erase_size=_read_int(f"{mtd}/erasesize"), write_size=_read_int(f"{mtd}/writesize"),
+                    size=_read_int(f"{mtd}/size") or info["size"])
+        return info
+
+    info["model"] = next((value for value in (_read(os.path.join(directory, attribute))
+                                              for attribute in ("device/model", "device/name")) if value),
+                         os.path.basename(directory))
+    info["serial"] = next((value for value in (_read(os.path.join(directory, attribute))
+                                               for attribute in ("device/serial", "wwid", "device/wwid",
+                                                                 "loop/backing_file")) if value),
+                          os.path.basename(directory))
+    return info
+
+
+def cache_key(info):
+    # A flash chip has no serial; its name, type and size stand in for one.
+    suffix = f"-{info['size']}" if info["kind"] == "mtd" else ""
+    return _safe_name(f"{info['kind']}-{info['model']}-{info['serial']}{suffix}")
+
+
+def from_limits(info):
+    # Tuning from the probed limits alone.
+    if info["kind"] == "mtd":
+        # Whole erase blocks, one at a time: mtdblock serializes writes anyway
+        erase_size = info.get("erase_size") or 64 * 1024
+        block_size = -(-erase_size // directio.ALIGNMENT) * directio.ALIGNMENT
+        return {"block_size": block_size, "queue_depth": 1, "alignment": erase_size}
+    optimal = info.get("optimal_io_size") or 0
+    block_size = max(directio.BLOCK_SIZE, optimal)
+    block_size = -(-block_size // directio.ALIGNMENT) * directio.ALIGNMENT
+    return {"block_size": block_size, "queue_depth": 1 if info.get("rotational") else directio.QUEUE_DEPTH,
+            "alignment": max(info.get("physical_block_size") or 0, info.get("minimum_io_size") or 0) or None}
+
+
+def scratch_region(info):
+    # (path, offset) to calibrate against, and whether path is a scratch file.
+    if info["kind"] == "file":
+        return f"{info['path']}.calibrate", 0, True
+    offset = (info["size"] - CALIBRATION_SIZE) // max(BLOCK_SIZES) * max(BLOCK_SIZES)
+    if offset < CALIBRATION_SIZE:
+        return None, 0, False
+    return info["path"], offset, False
+
+
+def measure(path, offset, data, block_size, queue_depth, alignment=None):
+    # MiB/s of writing data at offset with O_DIRECT, flushed.
+    engine = directio.DirectIO(path, block_size, queue_depth, alignment)
+    try:
+        started = time.monotonic()
+        engine.submit(memoryview(data), offset)
+        engine.wait()
+        os.fsync(engine.fd)
+        return len(data) / (time.monotonic() - started) / imagepipe.MIB
+    finally:
+        engine.close()
+
+
+def calibrate(info, base):
+    # base tuned by timing writes to a scratch region; None if there is none.
+    path, offset, scratch = scratch_region(info)
+    if path is None:
+        return None
+    if scratch:
+        with open(path, "wb") as f:
+            f.truncate(CALIBRATION_SIZE)
+    data = os.urandom(CALIBRATION_SIZE)
+    depths = ROTATIONAL_QUEUE_DEPTHS if info.get("rotational") else QUEUE_DEPTHS
+    measurements = []
+    try:
+        for block_size in BLOCK_SIZES:
+            for queue_depth in depths:
+                rate = measure(path, offset, data, block_size, queue_depth, base["alignment"])
+                measurements.append({"block_size": block_size, "queue_depth": queue_depth, "mib_s": round(rate, 1)})
+    finally:
+        if scratch:
+            os.remove(path)
+    fastest = max(measurement["mib_s"] for measurement in measurements)
+    chosen = min((measurement for measurement in measurements
+                  if measurement["mib_s"] >= fastest * (1 - CALIBRATION_TOLERANCE)),
+                 key=lambda measurement: (measurement["block_size"] * measurement["queue_depth"],
+                                          measurement["queue_depth"]))
+    return dict(base, block_size=chosen["block_size"], queue_depth=chosen["queue_depth"],
+                measurements=measurements)
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get("version") == CACHE_VERSION else None
+
+
+def save(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp, path)
+
+
+def tune(path, calibrate_writes=False, cache_dir=PROBE_DIR, refresh=False):
+    # {"block_size", "queue_depth", "alignment", "calibrated", "info", ...} for
+    # writing to path.  calibrate_writes allows the destructive calibration
+    # on a disk; a cached calibration is reused either way.
+    info = probe(path)
+    cache_file = os.path.join(cache_dir, f"{cache_key(info)}.json")
+    entry = None if refresh else load(cache_file)
+    if entry is not None and (entry["calibrated"] or not calibrate_writes or info["kind"] == "mtd"):
+        return entry
+
+    entry = from_limits(info)
+    entry.update(version=CACHE_VERSION, calibrated=False, info=info)
+    if calibrate_writes and info["kind"] != "mtd":
+        print(f"Calibrating writes to {path} ({info['model']})")
+        calibrated = calibrate(info, entry)
+        if calibrated is not None:
+            entry = dict(calibrated, calibrated=True)
+    save(cache_file, entry)
+    return entry
+
+
+def describe(entry):
+    info = entry["info"]
+    limits = ", ".join(f"{name} {info[name]}" for name in ("logical_block_size", "physical_block_size",
+                                                            "optimal_io_size", "erase_size", "rotational")
+                       if info.get(name) is not None)
+    return (f"{info['path']} ({info['kind']}, {info['model']} {info['serial']}): {limits}; "
+            f"writing {entry['block_size'] // 1024} KiB x {entry['queue_depth']} in flight"
+            f"{', calibrated' if entry['calibrated'] else ''}")
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 1:
+        print(f"usage: {sys.argv[0]} DEVICE_OR_FILE [--calibrate] [--refresh]")
+        exit(1)
+    entry = tune(args[0], "--calibrate" in sys.argv, refresh="--refresh" in sys.argv)
+    print(describe(entry))
+    for measurement in entry.get("measurements", []):
+        print(f"  {measurement['block_size'] // 1024:>5} KiB x {measurement['queue_depth']}: {measurement['mib_s']} MiB/s")
+
+if __name__ == '__main__':
+    main()
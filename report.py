@@ -0,0 +1,138 @@
+#
+# Stage timing and machine-readable run reports.
+#
+# Every provisioning stage and sub-step is wrapped in Report.stage(), which
+# records wall time, bytes moved and throughput.  Each record is appended to a
+# JSON-lines file as soon as the step ends (so a crashed run still leaves a
+# report behind) and can also be exported as a Prometheus textfile for
+# node_exporter, to compare boards and spot regressions between image versions.
+#
+import os
+import json
+import time
+import socket
+import threading
+import subprocess
+from contextlib import contextmanager
+
+METRIC_PREFIX = "rock5b_provision"
+
+
+class Step:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.bytes = 0
+
+
+class Report:
+    def __init__(self, path, prometheus_path=None, **labels):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.run_id = time.strftime("%Y%m%dT%H%M%S")
+        self.labels = dict(labels, host=socket.gethostname())
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        step = Step(name, labels)
+        started = time.time()
+        clock = time.monotonic()
+        error = None
+        try:
+            yield step
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.record(name, time.monotonic() - clock, step.bytes, started=started, error=error, **labels)
+
+    def run(self, name, command, **kwargs):
+        # subprocess.run() timed as a step of its own
+        labels = kwargs.pop("labels", {})
+        with self.stage(name, **labels):
+            return subprocess.run(command, **kwargs)
+
+    def record(self, name, seconds, nbytes=0, started=None, error=None, extra=None, **labels):
+        entry = {
+            "run": self.run_id,
+            "stage": name,
+            "labels": dict(self.labels, **labels),
+            "started": round(started if started is not None else time.time() - seconds, 3),
+            "seconds": round(seconds, 3),
+            "bytes": nbytes,
+            "bytes_per_second": round(nbytes / seconds) if seconds and nbytes else 0,
+            "ok": error is None,
+        }
+        if extra:
+            entry.update(extra)
+        if error is not None:
+            entry["error"] = f"{type(error).__name__}: {error}"
+        with self._lock:
+            self.records.append(entry)
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def add_pipeline(self, name, pipe, **labels):
+        # Per-stage numbers from an imagepipe.Pipeline (download, decompress, write, ...)
+        # Fan-out writer stages are named "<stage> <device>".
+        for stats in pipe.stats:
+            stage, _, disk = stats.name.partition(" ")
+            stage_labels = dict(labels, disk=disk) if disk else labels
+            self.record(f"{name}.{stage}", stats.elapsed, stats.bytes,
+                        extra={"busy_seconds": round(stats.busy, 3)}, **stage_labels)
+
+    def write_prometheus(self, path=None):
+        path = path or self.prometheus_path
+        if not path:
+            return
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_seconds Wall time of a provisioning stage",
+            f"# TYPE {METRIC_PREFIX}_stage_seconds gauge",
+        ]
+        byte_lines = [
+            f"# HELP {METRIC_PREFIX}_stage_bytes Bytes moved by a provisioning stage",
+            f"# TYPE {METRIC_PREFIX}_stage_bytes gauge",
+        ]
+        ok_lines = [
+            f"# HELP {METRIC_PREFIX}_stage_success Whether a provisioning stage succeeded",
+            f"# TYPE {METRIC_PREFIX}_stage_success gauge",
+        ]
+        with self._lock:
+            records = list(self.records)
+        # A stage that ran more than once with the same labels (the SPI flash writes
+        # two images) is one series: node_exporter rejects a file with duplicates.
+        series = {}
+        for entry in records:
+            labels = dict(entry["labels"], stage=entry["stage"])
+            text = ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+            seconds, nbytes, ok = series.get(text, (0, 0, True))
+            series[text] = (seconds + entry["seconds"], nbytes + entry["bytes"], ok and entry["ok"])
+        for text, (seconds, nbytes, ok) in series.items():
+            lines.append(f"{METRIC_PREFIX}_stage_seconds{{{text}}} {round(seconds, 3)}")
+            byte_lines.append(f"{METRIC_PREFIX}_stage_bytes{{{text}}} {nbytes}")
+            ok_lines.append(f"{METRIC_PREFIX}_stage_success{{{text}}} {1 if ok else 0}")
+
+        # node_exporter may read the file at any moment, so replace it atomically.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines + byte_lines + ok_lines) + "\n")
+        os.replace(tmp, path)
+
+    def summary(self):
+        print(f"Stage timings (report: {self.path})")
+        with self._lock:
+            records = list(self.records)
+        for entry in records:
+            disk = entry["labels"].get("disk")
+            rate = f", {entry['bytes_per_second'] / 1024 / 1024:.1f} MiB/s" if entry["bytes_per_second"] else ""
+            status = "" if entry["ok"] else " FAILED"
+            print(f"  {entry['stage']}{f' [{disk}]' if disk else ''}: {entry['seconds']:.1f}s{rate}{status}")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
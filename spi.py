@@ -0,0 +1,107 @@
+#
+# Differential SPI NOR flashing.
+#
+# Writing a full image to /dev/mtdblock0 takes minutes because every erase
+# block is erased and reprogrammed, even when a reflash only changes a few of
+# them.  This reads the current flash erase block by erase block, compares it
+# with the target image and rewrites only the blocks that differ.  Anything
+# past the end of the image is compared against zeros, which is what the old
+# zero.img pass used to leave there, so that pass is no longer needed.
+#
+# Works against a plain file standing in for the flash (or an mtdram device):
+#   python3 spi.py rkspi_loader.img /tmp/fake-spi.img --dry-run
+#
+import os
+import re
+import sys
+import imagepipe
+
+DEFAULT_DEVICE = "/dev/mtdblock0"
+DEFAULT_ERASE_SIZE = 64 * 1024
+
+
+def erase_size(device):
+    # /dev/mtdblockN -> /sys/class/mtd/mtdN/erasesize
+    match = re.search(r"mtdblock(\d+)$", device)
+    if match:
+        try:
+            with open(f"/sys/class/mtd/mtd{match.group(1)}/erasesize") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            pass
+    return DEFAULT_ERASE_SIZE
+
+
+def diff_flash(image, device=DEFAULT_DEVICE, block_size=None, dry_run=False):
+    # image is the full target contents as bytes.  Returns a report dict with
+    # the erase block size, the number of blocks compared and the offsets of
+    # the blocks that differed (and, unless dry_run, were rewritten).
+    block_size = block_size or erase_size(device)
+    fd = os.open(device, os.O_RDONLY if dry_run else os.O_RDWR)
+    try:
+        size = imagepipe.device_size(fd)
+        if len(image) > size:
+            raise Exception(f"{device} holds {size} bytes, image is {len(image)} bytes")
+
+        changed = []
+        for offset in range(0, size, block_size):
+            length = min(block_size, size - offset)
+            wanted = image[offset:offset + length].ljust(length, b"\0")
+            if os.pread(fd, length, offset) != wanted:
+                changed.append(offset)
+                if not dry_run:
+                    imagepipe.pwrite_all(fd, memoryview(wanted), offset)
+
+        if changed and not dry_run:
+            os.fsync(fd)
+            # Read the rewritten blocks back from the media, not the page cache.
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            for offset in changed:
+                length = min(block_size, size - offset)
+                wanted = image[offset:offset + length].ljust(length, b"\0")
+                if os.pread(fd, length, offset) != wanted:
+                    raise Exception(f"{device}: erase block at {offset:#x} did not read back as written")
+    finally:
+        os.close(fd)
+
+    return {
+        "device": device,
+        "block_size": block_size,
+        "blocks": (size + block_size - 1) // block_size,
+        "changed": changed,
+        "dry_run": dry_run,
+    }
+
+
+def changed_ranges(report):
+    # Merge adjacent changed blocks into (start, end) byte ranges.
+    ranges = []
+    for offset in report["changed"]:
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1][1] = offset + report["block_size"]
+        else:
+            ranges.append([offset, offset + report["block_size"]])
+    return ranges
+
+
+def print_report(report):
+    changed = len(report["changed"])
+    verb = "would rewrite" if report["dry_run"] else "rewrote"
+    print(f"{report['device']}: {verb} {changed} of {report['blocks']} erase blocks "
+          f"({changed * report['block_size'] // 1024} KiB, {report['block_size'] // 1024} KiB blocks)")
+    for start, end in changed_ranges(report):
+        print(f"  {start:#08x}-{end - 1:#08x}")
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args:
+        print(f"usage: {sys.argv[0]} IMAGE [DEVICE] [--dry-run]")
+        exit(1)
+    with open(args[0], "rb") as f:
+        image = f.read()
+    device = args[1] if len(args) > 1 else DEFAULT_DEVICE
+    print_report(diff_flash(image, device, dry_run="--dry-run" in sys.argv))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#
+# Per-board provisioning targets.
+#
+# A Target bundles everything install_os() and customize_os() need to know
+# about one disk, so several disks can be provisioned from one run instead of
+# through the DISK/BOOTPART/ROOTPART module globals.
+#
+import os
+import re
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Target:
+    def __init__(self, disk, bootpart=None, rootpart=None, mountpoint="/mnt",
+                 interface="enP4p65s0", ipaddress="dhcp", gateway="dhcp", name=None):
+        self.disk = disk
+        self.bootpart = bootpart or partition_path(disk, 1)
+        self.rootpart = rootpart or partition_path(disk, 2)
+        self.mountpoint = mountpoint
+        self.interface = interface
+        self.ipaddress = ipaddress
+        self.gateway = gateway
+        # Names the target's journal and work files: the board name from a profile, or the disk's
+        self.name = name or os.path.basename(disk)
+
+    def path(self, *parts):
+        # Path inside the mounted target, e.g. target.path("etc/resolv.conf")
+        return os.path.join(self.mountpoint, *parts)
+
+    def __repr__(self):
+        return f"Target({self.disk})"
+
+
+def partition_path(disk, number):
+    # /dev/nvme0n1 -> /dev/nvme0n1p1, /dev/mmcblk0 -> /dev/mmcblk0p1,
+    # /dev/loop0 -> /dev/loop0p1, /dev/sda -> /dev/sda1
+    if re.search(r"\d$", disk):
+        return f"{disk}p{number}"
+    return f"{disk}{number}"
+
+
+def expand_devices(specs):
+    # specs is a comma separated string or a list of device paths and globs
+    # such as /dev/nvme*n1.  Order is preserved and duplicates dropped.
+    if isinstance(specs, str):
+        specs = [spec for spec in specs.split(",") if spec]
+    devices = []
+    for spec in specs:
+        matches = sorted(glob.glob(spec)) if glob.has_magic(spec) else [spec]
+        for device in matches:
+            if device not in devices:
+                devices.append(device)
+    return devices
+
+
+def for_each(batch, action, description=None):
+    # Run action(target) for every target concurrently.  A target that raises
+    # is reported and left out of the returned list instead of stopping the
+    # others.  description names the action in that report (default: its
+    # __name__, which a lambda doesn't have a useful one of).
+    if not batch:
+        return []
+    with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+        futures = [(target, pool.submit(action, target)) for target in batch]
+    succeeded = []
+    for target, future in futures:
+        error = future.exception()
+        if error is None:
+            succeeded.append(target)
+        else:
+            print(f"{target.disk}: {description or action.__name__} failed: {error}")
+    return succeeded
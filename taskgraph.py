@@ -0,0 +1,221 @@
+#
+# Dependency-aware scheduling of provisioning stages.
+#
+# run() used to call prefetch, update_packages, flash_spi, install_os and
+# customize_os one after the other, although most of them have nothing to
+# do with each other: the SPI flash and the NVMe disk are different devices,
+# host packages don't touch either, and the kernel debs customize_os needs
+# can download while the image is being written.  A TaskGraph takes the
+# stages as tasks that declare what they consume (inputs), what they produce
+# (outputs) and which devices they need to themselves (locks).  A task
+# depends on the producer of each of its inputs and on anything named in
+# after; tasks sharing a lock never overlap.  Every task whose dependencies
+# are done and whose locks are free starts in a thread of its own, so the
+# run takes about as long as its longest chain instead of the sum of all
+# stages.
+#
+# When a task fails, the tasks depending on it are skipped and the rest
+# still run (their progress is journaled, so a rerun resumes after them).
+# run() then raises the first failure.  Either way summary() prints each
+# task's timing and the critical path: the chain of tasks, each waiting on
+# the one before it, that decided the total time.
+#
+#   graph = TaskGraph(REPORT)
+#   graph.add("prefetch", prefetch, outputs=["kernel_debs"])
+#   graph.add("install_os", install, locks=[disk])
+#   graph.add("customize_os", customize, inputs=["kernel_debs"], after=["install_os"], locks=[disk])
+#   graph.run()
+#
+import time
+import threading
+
+
+class TaskSkipped(Exception):
+    pass
+
+
+class Task:
+    def __init__(self, name, action, inputs=(), outputs=(), locks=(), after=(), stage=None, labels=None):
+        self.name = name
+        self.stage = stage or name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.locks = list(locks)
+        self.after = list(after)
+        self.labels = labels or {}
+        self.needs = []
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def state(self):
+        if self.finished is not None:
+            if isinstance(self.error, TaskSkipped):
+                return "skipped"
+            return "failed" if self.error is not None else "done"
+        return "running" if self.started is not None else "waiting"
+
+    @property
+    def seconds(self):
+        if self.started is None or self.finished is None:
+            return 0
+        return self.finished - self.started
+
+
+class TaskGraph:
+    def __init__(self, report=None, max_parallel=None):
+        # report: optional report.Report, each task is recorded as a stage of it.
+        # max_parallel=1 runs the tasks one at a time, in the order they were added.
+        self.report = report
+        self.max_parallel = max_parallel
+        self.tasks = {}
+        self.condition = threading.Condition()
+        self.held = set()
+        self.started = None
+        self.finished = None
+
+    def add(self, name, action, inputs=(), outputs=(), locks=(), after=(), stage=None, **labels):
+        # stage names the task in the report (default: its name), labels are added to its record.
+        if name in self.tasks:
+            raise Exception(f"Task {name} was added twice")
+        task = self.tasks[name] = Task(name, action, inputs, outputs, locks, after, stage, labels)
+        return task
+
+    def result(self, name):
+        # What the task's action returned.
+        return self.tasks[name].result
+
+    def resolve(self):
+        # Fill in every task's dependencies and check there is no cycle.
+        producers = {}
+        for task in self.tasks.values():
+            for output in task.outputs:
+                if output in producers:
+                    raise Exception(f"{output} is an output of both {producers[output]} and {task.name}")
+                producers[output] = task.name
+        for task in self.tasks.values():
+            needs = []
+            for name in [producers.get(wanted) for wanted in task.inputs] + task.after:
+                if name is None:
+                    missing = [wanted for wanted in task.inputs if wanted not in producers]
+                    raise Exception(f"{task.name}: no task produces {', '.join(missing)}")
+                if name not in self.tasks:
+                    raise Exception(f"{task.name}: unknown task {name}")
+                if name not in needs:
+                    needs.append(name)
+            task.needs = needs
+
+        # Kahn's algorithm: whatever is never freed of dependencies sits on a cycle
+        remaining = {task.name: len(task.needs) for task in self.tasks.values()}
+        ready = [name for name, count in remaining.items() if count == 0]
+        while ready:
+            name = ready.pop()
+            for task in self.tasks.values():
+                if name in task.needs:
+                    remaining[task.name] -= 1
+                    if remaining[task.name] == 0:
+                        ready.append(task.name)
+        cycle = [name for name, count in remaining.items() if count]
+        if cycle:
+            raise Exception(f"Tasks depend on each other in a cycle: {', '.join(cycle)}")
+
+    def _runnable(self):
+        # The next task that can start now, in the order they were added.
+        running = sum(task.state == "running" for task in self.tasks.values())
+        if self.max_parallel and running >= self.max_parallel:
+            return None
+        for task in self.tasks.values():
+            if task.state != "waiting":
+                continue
+            states = [self.tasks[name].state for name in task.needs]
+            if any(state in ("failed", "skipped") for state in states):
+                failed = [name for name in task.needs if self.tasks[name].state in ("failed", "skipped")]
+                task.started = task.finished = time.monotonic()
+                task.error = TaskSkipped(f"{task.name} skipped, {', '.join(failed)} did not complete")
+                print(task.error)
+                return self._runnable()
+            if all(state == "done" for state in states) and not self.held.intersection(task.locks):
+                return task
+        return None
+
+    def _work(self, task):
+        try:
+            if self.report is not None:
+                with self.report.stage(task.stage, **task.labels):
+                    task.result = task.action()
+            else:
+                task.result = task.action()
+        except BaseException as e:
+            # exit() in a stage must not just end this thread
+            task.error = e
+            print(f"{task.name} failed: {e!r}")
+        finally:
+            with self.condition:
+                task.finished = time.monotonic()
+                self.held.difference_update(task.locks)
+                self.condition.notify_all()
+
+    def run(self):
+        # Run every task; returns {name: result}.  Raises the first failure
+        # once everything that could run has finished.
+        self.resolve()
+        self.started = time.monotonic()
+        with self.condition:
+            while True:
+                task = self._runnable()
+                if task is not None:
+                    task.started = time.monotonic()
+                    self.held.update(task.locks)
+                    threading.Thread(target=self._work, args=(task,), name=f"task-{task.name}", daemon=True).start()
+                    continue
+                if all(task.finished is not None for task in self.tasks.values()):
+                    break
+                self.condition.wait()
+        self.finished = time.monotonic()
+
+        failures = [task for task in self.tasks.values()
+                    if task.error is not None and not isinstance(task.error, TaskSkipped)]
+        if failures:
+            raise min(failures, key=lambda task: task.finished).error
+        return {task.name: task.result for task in self.tasks.values()}
+
+    def critical_path(self):
+        # The tasks that decided the run's wall time, first to last.  Walks
+        # back from the task that finished last, each time to the dependency
+        # or lock holder it was waiting for: the one that finished last
+        # before it started.
+        ran = [task for task in self.tasks.values() if task.finished is not None and task.seconds]
+        if not ran:
+            return []
+        path = [max(ran, key=lambda task: task.finished)]
+        while True:
+            task = path[-1]
+            blockers = [other for other in ran if other is not task and other.finished <= task.started
+                        and (other.name in task.needs or set(other.locks).intersection(task.locks))]
+            if not blockers:
+                break
+            path.append(max(blockers, key=lambda other: other.finished))
+        return path[::-1]
+
+    def summary(self):
+        if self.started is None:
+            return
+        print("Task schedule (seconds from start)")
+        for task in sorted(self.tasks.values(), key=lambda task: task.started or 0):
+            if task.state == "skipped" or task.started is None:
+                print(f"  {task.name}: {task.state}")
+                continue
+            end = task.finished if task.finished is not None else time.monotonic()
+            print(f"  {task.name}: {task.started - self.started:.1f}s - {end - self.started:.1f}s "
+                  f"({end - task.started:.1f}s){' FAILED' if task.state == 'failed' else ''}")
+        path = self.critical_path()
+        if not path:
+            return
+        wall = (self.finished or time.monotonic()) - self.started
+        total = sum(task.seconds for task in self.tasks.values())
+        print(f"Critical path: {' -> '.join(f'{task.name} ({task.seconds:.1f}s)' for task in path)}")
+        print(f"  {sum(task.seconds for task in path):.1f}s of {wall:.1f}s wall time; "
+              f"the stages add up to {total:.1f}s")
@@ -0,0 +1,264 @@
+#
+# Multi-threaded xz decompression for the image pipeline.
+#
+# xz -T (the default since xz 5.4) splits its input into independent blocks
+# and records each block's compressed and uncompressed size in the block
+# header.  Such a block can be cut out of the download as it arrives, wrapped
+# in a one-block xz stream of its own and decoded on any core: liblzma drops
+# the GIL while it works, so a thread pool is enough.  Decoded blocks are
+# handed on strictly in stream order, so the writer never sees the difference.
+#
+# Streams whose blocks carry no sizes (single-threaded xz, or a single block)
+# and gzip, which has no block boundaries at all, are decoded sequentially in
+# the pipeline's decompress thread, overlapping with download and write.
+# That also goes for the rest of the input when a later concatenated stream
+# turns out to have no sizes, and for any single block too large to decode
+# in memory, which is streamed through the sequential decoder in its place.
+#
+import os
+import lzma
+import zlib
+import struct
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+HEADER_MAGIC = b"\xfd7zXZ\x00"
+FOOTER_MAGIC = b"YZ"
+STREAM_HEADER_SIZE = 12
+STREAM_FOOTER_SIZE = 12
+
+# Size of the integrity check for each check type, from the xz file format spec.
+CHECK_SIZES = (0, 4, 4, 4, 8, 8, 8, 16, 16, 16, 32, 32, 32, 64, 64, 64)
+
+# A block is decoded into memory in one go, so huge blocks (xz -9 writes
+# 192 MiB ones, or xz --block-size) are left to the sequential decoder.
+MAX_PARALLEL_BLOCK = 128 * 1024 * 1024
+# Most compressed plus decoded bytes of the blocks in flight at once, well
+# within the 4 GiB of the smallest board whatever the block size and cores.
+MAX_IN_FLIGHT = 512 * 1024 * 1024
+# Compressed bytes read at a time when streaming to the sequential decoder
+READ_SIZE = 1024 * 1024
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def _varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise Exception("Corrupt xz stream: invalid variable-length integer")
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _index(records):
+    # Index field for (unpadded size, uncompressed size) records.
+    index = b"\0" + _encode_varint(len(records))
+    for unpadded, uncompressed in records:
+        index += _encode_varint(unpadded) + _encode_varint(uncompressed)
+    index += b"\0" * (-len(index) % 4)
+    return index + struct.pack("<I", zlib.crc32(index))
+
+
+def _footer(flags, index_size):
+    body = struct.pack("<I", index_size // 4 - 1) + flags
+    return struct.pack("<I", zlib.crc32(body)) + body + FOOTER_MAGIC
+
+
+def block_stream(flags, block, unpadded, uncompressed):
+    # Wrap one block in a complete xz stream, so liblzma still checks the
+    # block's integrity check and sizes.
+    index = _index([(unpadded, uncompressed)])
+    header = HEADER_MAGIC + flags + struct.pack("<I", zlib.crc32(flags))
+    return header + block + index + _footer(flags, len(index))
+
+
+def decode_block(stream, limit):
+    # Decoded in pieces of at most limit bytes, like imagepipe.Decoder.
+    decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    pieces = [decompressor.decompress(stream, limit)]
+    while not decompressor.eof and not decompressor.needs_input:
+        pieces.append(decompressor.decompress(b"", limit))
+    if not decompressor.eof:
+        raise Exception("Corrupt xz stream: block ended unexpectedly")
+    return pieces
+
+
+class _Reader:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = bytearray()
+
+    def fill(self, size):
+        # False if the input ends before size bytes are buffered.
+        while len(self.buf) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.buf += chunk
+        return True
+
+    def take(self, size):
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def rest(self):
+        # Everything not consumed yet, buffered bytes first.
+        if self.buf:
+            yield bytes(self.buf)
+        yield from self.chunks
+
+    def stream(self, size):
+        # The next size bytes, as they arrive.
+        while size > 0:
+            if not self.fill(min(size, READ_SIZE)):
+                raise Exception("Corrupt xz stream: truncated block")
+            data = self.take(min(size, READ_SIZE))
+            size -= len(data)
+            yield data
+
+
+def _block_sizes(header, check_size):
+    # Parse a block header.  Returns (total size, unpadded size, uncompressed
+    # size), all None when the header doesn't record the sizes.
+    if struct.unpack("<I", header[-4:])[0] != zlib.crc32(header[:-4]):
+        raise Exception("Corrupt xz stream: block header checksum mismatch")
+    flags = header[1]
+    if not (flags & 0x40 and flags & 0x80):
+        return None, None, None
+    compressed, pos = _varint(header, 2)
+    uncompressed, pos = _varint(header, pos)
+    unpadded = len(header) + compressed + check_size
+    total = len(header) + compressed + (-compressed % 4) + check_size
+    return total, unpadded, uncompressed
+
+
+def _splittable(reader):
+    # Peek at the first block: does the stream carry the sizes we need?
+    if not reader.fill(STREAM_HEADER_SIZE + 1) or not reader.buf.startswith(HEADER_MAGIC):
+        return False
+    header_size = (reader.buf[STREAM_HEADER_SIZE] + 1) * 4
+    if reader.buf[STREAM_HEADER_SIZE] == 0 or not reader.fill(STREAM_HEADER_SIZE + header_size):
+        # No blocks at all, or junk: leave it to the sequential decoder
+        return False
+    check_size = CHECK_SIZES[reader.buf[7] & 0x0f]
+    total = _block_sizes(reader.buf[STREAM_HEADER_SIZE:STREAM_HEADER_SIZE + header_size], check_size)[0]
+    return total is not None
+
+
+def _sequential_block(flags, reader, total, unpadded, uncompressed):
+    # A huge block as a one-block stream that is read from reader while it is decoded.
+    index = _index([(unpadded, uncompressed)])
+    yield HEADER_MAGIC + flags + struct.pack("<I", zlib.crc32(flags))
+    yield from reader.stream(total)
+    yield index + _footer(flags, len(index))
+
+
+def split_blocks(reader):
+    # Yield one self-contained xz stream per block, in order, checking every
+    # stream's index and footer against the blocks that were seen.  Each
+    # item is (stream, uncompressed size, None) for a block to decode in
+    # parallel, or (None, 0, chunks) for input that has to go through the
+    # sequential decoder, in place and in full, before the next item is
+    # asked for.
+    while True:
+        if not reader.fill(STREAM_HEADER_SIZE):
+            raise Exception("Corrupt xz stream: truncated stream header")
+        header = reader.take(STREAM_HEADER_SIZE)
+        flags = header[6:8]
+        if not header.startswith(HEADER_MAGIC) or struct.unpack("<I", header[8:])[0] != zlib.crc32(flags):
+            raise Exception("Corrupt xz stream: bad stream header")
+        check_size = CHECK_SIZES[flags[1] & 0x0f]
+
+        records = []
+        while True:
+            if not reader.fill(1):
+                raise Exception("Corrupt xz stream: stream ended inside a block")
+            if reader.buf[0] == 0:
+                break
+            header_size = (reader.buf[0] + 1) * 4
+            if not reader.fill(header_size):
+                raise Exception("Corrupt xz stream: truncated block header")
+            total, unpadded, uncompressed = _block_sizes(reader.buf[:header_size], check_size)
+            if total is None:
+                if records:
+                    # The stream's earlier blocks are decoded already and gone, so liblzma
+                    # can't check its index any more; no xz encoder writes such streams.
+                    raise Exception("Unsupported xz stream: a block without size fields after blocks with them")
+                # A concatenated stream from single-threaded xz: this stream and
+                # everything after it is decoded sequentially.
+                yield None, 0, itertools.chain([header], reader.rest())
+                return
+            if uncompressed > MAX_PARALLEL_BLOCK:
+                yield None, 0, _sequential_block(flags, reader, total, unpadded, uncompressed)
+            else:
+                if not reader.fill(total):
+                    raise Exception("Corrupt xz stream: truncated block")
+                yield block_stream(flags, reader.take(total), unpadded, uncompressed), uncompressed, None
+            records.append((unpadded, uncompressed))
+
+        index = _index(records)
+        if not reader.fill(len(index) + STREAM_FOOTER_SIZE):
+            raise Exception("Corrupt xz stream: truncated index")
+        if reader.take(len(index)) != index or reader.take(STREAM_FOOTER_SIZE) != _footer(flags, len(index)):
+            raise Exception("Corrupt xz stream: index does not match its blocks")
+
+        # Stream padding, then either the end of the input or another stream.
+        while reader.fill(1) and reader.buf[0] == 0:
+            reader.take(len(reader.buf) - len(reader.buf.lstrip(b"\0")))
+        if not reader.buf:
+            return
+
+
+def xz_pieces(chunks, fallback, workers=None, limit=4 * 1024 * 1024):
+    # Decoded pieces of an xz stream, in order.  fallback(chunks) is the
+    # sequential decoder used when the stream can't be split into blocks.
+    workers = workers or default_workers()
+    reader = _Reader(chunks)
+    if workers < 2 or not _splittable(reader):
+        yield from fallback(reader.rest())
+        return
+
+    # Enough blocks in flight to keep every worker busy while the oldest one
+    # is being written, without holding more than MAX_IN_FLIGHT bytes of them.
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xz")
+    pending = collections.deque()
+    in_flight = 0
+    try:
+        for stream, uncompressed, sequential in split_blocks(reader):
+            if sequential is not None:
+                while pending:
+                    future, size = pending.popleft()
+                    in_flight -= size
+                    yield from future.result()
+                yield from fallback(sequential)
+                continue
+            size = len(stream) + uncompressed
+            while pending and (len(pending) >= workers * 2 or in_flight + size > MAX_IN_FLIGHT):
+                future, done = pending.popleft()
+                in_flight -= done
+                yield from future.result()
+            pending.append((pool.submit(decode_block, stream, limit), size))
+            in_flight += size
+        while pending:
+            yield from pending.popleft()[0].result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)